@@ -0,0 +1,244 @@
+"""
+AMZScout account pool for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+import logging
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Any
+from weakref import WeakKeyDictionary
+
+logger = logging.getLogger(__package__)
+
+# How many searches a fresh account is good for before AMZScout stops showing data
+DEFAULT_QUOTA = 15
+# An account that was checked out and never given back is handed out again after this long
+DEFAULT_CHECKOUT_SECONDS = 6 * 60 * 60
+# An account whose session couldn't be restored sits out this long, twice as long after every failure in a row
+DEFAULT_FAILURE_COOLDOWN_SECONDS = 5 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL UNIQUE,
+    cookies TEXT NOT NULL,
+    storage TEXT NOT NULL,
+    uses_remaining INTEGER NOT NULL,
+    created REAL NOT NULL,
+    checked_out_until REAL,
+    retired TEXT,
+    failures INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+@dataclass
+class Account:
+    """
+    A registered AMZScout account and the browser state that keeps it signed in.
+    """
+
+    id: int
+    email: str
+    cookies: list[dict[str, Any]]
+    storage: dict[str, Any]
+    uses_remaining: int
+
+
+class AccountPool:
+    """
+    Accounts registered ahead of time, stored in SQLite so they survive restarts and can be shared between processes.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        checkout_seconds: float = DEFAULT_CHECKOUT_SECONDS,
+        failure_cooldown_seconds: float = DEFAULT_FAILURE_COOLDOWN_SECONDS,
+    ) -> None:
+        self.path = Path(path)
+        self.checkout_seconds = checkout_seconds
+        self.failure_cooldown_seconds = failure_cooldown_seconds
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(accounts)")}
+        if "failures" not in columns:
+            # pools made before failures were counted
+            self._connection.execute(
+                "ALTER TABLE accounts ADD COLUMN failures INTEGER NOT NULL DEFAULT 0"
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "AccountPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def add(
+        self,
+        email: str,
+        cookies: list[dict[str, Any]],
+        storage: dict[str, Any],
+        *,
+        quota: int = DEFAULT_QUOTA,
+    ) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO accounts (email, cookies, storage, uses_remaining, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (email, json.dumps(cookies), json.dumps(storage), quota, time()),
+            )
+        logger.info(f"Added account {email} to the pool.")
+
+    def checkout(self) -> Account | None:
+        """
+        Take the oldest account that still has quota left and isn't in use.
+
+        Returns:
+            The account, or None if the pool is empty.
+        """
+        now = time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute(
+                    "SELECT id, email, cookies, storage, uses_remaining FROM accounts "
+                    "WHERE retired IS NULL AND uses_remaining > 0 "
+                    "AND (checked_out_until IS NULL OR checked_out_until < ?) "
+                    "ORDER BY created LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE accounts SET checked_out_until = ? WHERE id = ?",
+                        (now + self.checkout_seconds, row[0]),
+                    )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        if row is None:
+            return None
+        account_id, email, cookies, storage, uses_remaining = row
+        return Account(account_id, email, json.loads(cookies), json.loads(storage), uses_remaining)
+
+    def record_use(self, account_id: int, uses: int = 1) -> int:
+        """
+        Count searches against an account's quota. Accounts that run out are retired.
+
+        A search means the account's session works, so it also forgets the failures before it.
+
+        Returns:
+            The quota left on the account.
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE accounts SET uses_remaining = MAX(uses_remaining - ?, 0), failures = 0 "
+                "WHERE id = ?",
+                (uses, account_id),
+            )
+            (remaining,) = self._connection.execute(
+                "SELECT uses_remaining FROM accounts WHERE id = ?", (account_id,)
+            ).fetchone()
+        if remaining == 0:
+            self.retire(account_id, "quota exhausted")
+        return remaining
+
+    def release(self, account_id: int) -> None:
+        """
+        Give an account back so that another driver can use what's left of its quota.
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE accounts SET checked_out_until = NULL WHERE id = ?", (account_id,)
+            )
+
+    def record_failure(self, account_id: int, reason: str) -> float:
+        """
+        Give an account back after its session couldn't be restored, but keep it from being handed out for a while.
+
+        The failure may have been the browser's rather than the account's, so the account isn't retired. Every failure
+        in a row doubles how long it sits out, up to the checkout time.
+
+        Returns:
+            How many seconds the account sits out.
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE accounts SET failures = failures + 1 WHERE id = ?", (account_id,)
+            )
+            (failures,) = self._connection.execute(
+                "SELECT failures FROM accounts WHERE id = ?", (account_id,)
+            ).fetchone()
+            cooldown = min(
+                self.failure_cooldown_seconds * 2 ** (failures - 1), self.checkout_seconds
+            )
+            self._connection.execute(
+                "UPDATE accounts SET checked_out_until = ? WHERE id = ?",
+                (time() + cooldown, account_id),
+            )
+        logger.info(
+            f"Account #{account_id} failed {failures} time(s) in a row, sitting out {cooldown:.0f}s: {reason}"
+        )
+        return cooldown
+
+    def retire(self, account_id: int, reason: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "UPDATE accounts SET retired = ?, checked_out_until = NULL WHERE id = ?",
+                (reason, account_id),
+            )
+        logger.info(f"Retired account #{account_id}: {reason}")
+
+    def ready_count(self) -> int:
+        """
+        How many accounts could be checked out right now.
+        """
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM accounts WHERE retired IS NULL AND uses_remaining > 0 "
+                "AND (checked_out_until IS NULL OR checked_out_until < ?)",
+                (time(),),
+            ).fetchone()
+        return count
+
+
+# Which account each live driver is signed in with
+_BOUND: "WeakKeyDictionary[Any, Account]" = WeakKeyDictionary()
+
+
+def bind_account(driver: Any, account: Account) -> None:
+    _BOUND[driver] = account
+
+
+def account_of(driver: Any) -> Account | None:
+    return _BOUND.get(driver)
+
+
+__all__ = ("Account", "AccountPool", "bind_account", "account_of", "DEFAULT_QUOTA")
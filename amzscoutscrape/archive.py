@@ -0,0 +1,127 @@
+"""
+Raw snapshot archive for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Any, Iterator
+
+logger = logging.getLogger(__package__)
+
+MANIFEST = "manifest.jsonl"
+
+
+@dataclass
+class QuerySnapshot:
+    """
+    The raw inputs of one query: everything needed to produce its rows again without a browser.
+
+    Every field but ``query`` and ``time`` holds object hashes, see ``SnapshotArchive.get``.
+    """
+
+    query: str
+    time: float
+    listing: str | None = None  # the AMZScout panel's HTML
+    responses: str | None = None  # the panel's API responses, as JSON
+    # product URL -> the product page's sections
+    products: dict[str, str] = field(default_factory=dict)
+    # image URL -> (hash, content type)
+    images: dict[str, tuple[str, str]] = field(default_factory=dict)
+
+
+class SnapshotArchive:
+    """
+    A content-addressed store of raw scrape inputs.
+
+    Every object is gzipped and named after the hash of its contents, so a product page that turns up under many
+    queries is only stored once. A manifest lists the objects that make up each query.
+    Several processes may write to the same archive.
+    """
+
+    def __init__(self, root: str | Path, *, level: int = 6) -> None:
+        self.root = Path(root)
+        self.level = level
+        self._lock = Lock()
+        (self.root / "objects").mkdir(parents=True, exist_ok=True)
+
+    def _object_path(self, digest: str) -> Path:
+        return self.root / "objects" / digest[:2] / digest[2:]
+
+    def put(self, data: bytes) -> str:
+        """
+        Store an object, unless it is already stored.
+
+        Returns:
+            Its hash.
+        """
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        path = self._object_path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # write somewhere else first, so that nobody ever reads half an object
+            fd, temporary = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(gzip.compress(data, compresslevel=self.level))
+            os.replace(temporary, path)
+        return digest
+
+    def put_text(self, text: str) -> str:
+        return self.put(text.encode("utf-8"))
+
+    def get(self, digest: str) -> bytes:
+        return gzip.decompress(self._object_path(digest).read_bytes())
+
+    def get_text(self, digest: str) -> str:
+        return self.get(digest).decode("utf-8")
+
+    def begin(self, query: str) -> QuerySnapshot:
+        return QuerySnapshot(query, time())
+
+    def commit(self, snapshot: QuerySnapshot) -> None:
+        """
+        Add a finished snapshot to the manifest.
+        """
+        line = json.dumps(snapshot.__dict__, separators=(",", ":")) + "\n"
+        with self._lock, open(self.root / MANIFEST, "a", encoding="utf-8") as fp:
+            # one write per line, so lines from other processes don't interleave
+            fp.write(line)
+
+    def snapshots(self) -> Iterator[QuerySnapshot]:
+        """
+        Every snapshot in the archive, oldest first.
+        """
+        manifest = self.root / MANIFEST
+        if not manifest.exists():
+            return
+        with open(manifest, encoding="utf-8") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                record: dict[str, Any] = json.loads(line)
+                record["images"] = {url: tuple(image) for url, image in record["images"].items()}
+                yield QuerySnapshot(**record)
+
+
+__all__ = ("QuerySnapshot", "SnapshotArchive")
@@ -0,0 +1,117 @@
+"""
+Network resource blocking for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+from typing import Iterable, Sequence
+
+from selenium.webdriver.remote.webdriver import WebDriver
+
+logger = logging.getLogger(__package__)
+
+
+def _extensions(*extensions: str) -> tuple[str, ...]:
+    # "*.js*" would also match .json and .jsx, so each extension has to end the path or come right before the query
+    return tuple(
+        pattern for extension in extensions for pattern in (f"*.{extension}", f"*.{extension}?*")
+    )
+
+
+# Network.setBlockedURLs only understands URL wildcards, so each resource type is approximated by the URLs it uses.
+# Amazon serves its scripts and stylesheets out of /images/ paths, so we go by extension and never by path.
+RESOURCE_TYPE_PATTERNS: dict[str, tuple[str, ...]] = {
+    "image": _extensions("jpg", "jpeg", "png", "gif", "webp", "avif", "svg", "ico"),
+    "media": _extensions("mp4", "webm", "m3u8", "m4s", "mp3"),
+    "font": _extensions("woff", "woff2", "ttf", "otf", "eot"),
+    "stylesheet": _extensions("css"),
+    "script": _extensions("js"),
+    "ads": (
+        "*amazon-adsystem.com*",
+        "*doubleclick.net*",
+        "*googlesyndication.com*",
+        "*adservice.google.com*",
+    ),
+    "tracking": (
+        "*fls-na.amazon.com*",
+        "*unagi.amazon.com*",
+        "*unagi-na.amazon.com*",
+        "*google-analytics.com*",
+        "*googletagmanager.com*",
+    ),
+}
+# The deep scrape only reads text that is in the page's HTML, so none of these are needed to get it.
+DEFAULT_BLOCKED_RESOURCE_TYPES = ("image", "media", "font", "ads", "tracking")
+
+
+def parse_resource_types(spec: str) -> tuple[str, ...]:
+    """
+    Parse a comma-separated list of resource types, like "image,font".
+
+    Raises:
+        ValueError: If a resource type is unknown
+    """
+    resource_types = tuple(part.strip() for part in spec.split(",") if part.strip())
+    for resource_type in resource_types:
+        if resource_type not in RESOURCE_TYPE_PATTERNS:
+            raise ValueError(
+                f"Unknown resource type {resource_type!r}, "
+                f"expected some of {', '.join(RESOURCE_TYPE_PATTERNS)}"
+            )
+    return resource_types
+
+
+def blocked_url_patterns(
+    resource_types: Iterable[str] = DEFAULT_BLOCKED_RESOURCE_TYPES,
+    extra_patterns: Iterable[str] = (),
+) -> tuple[str, ...]:
+    """
+    Build the list of URL patterns to block from resource types and any extra patterns.
+    """
+    patterns: list[str] = []
+    for resource_type in resource_types:
+        patterns.extend(RESOURCE_TYPE_PATTERNS[resource_type])
+    patterns.extend(extra_patterns)
+    return tuple(dict.fromkeys(patterns))  # dedupe, keep order
+
+
+def apply_url_blocklist(driver: WebDriver, patterns: Sequence[str]) -> bool:
+    """
+    Block requests matching any of the patterns in the driver's current tab.
+
+    DevTools commands only go to the tab that is focused, so other tabs (like the one hosting the AMZScout panel)
+    keep loading everything. The blocklist goes away when the tab is closed.
+
+    Returns:
+        Whether the blocklist was applied. Only Chromium-based drivers support it.
+    """
+    if not patterns:
+        return False
+    if not hasattr(driver, "execute_cdp_cmd"):
+        logger.debug(f"{type(driver).__name__} doesn't speak DevTools, not blocking anything.")
+        return False
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(patterns)})
+    return True
+
+
+__all__ = (
+    "RESOURCE_TYPE_PATTERNS",
+    "DEFAULT_BLOCKED_RESOURCE_TYPES",
+    "parse_resource_types",
+    "blocked_url_patterns",
+    "apply_url_blocklist",
+)
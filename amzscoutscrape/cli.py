@@ -23,8 +23,12 @@ import csv
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Optional, cast
+from queue import Queue
+from typing import Any, Callable, Iterable, List, Optional, Sequence, cast
 
 import typer
 from _csv import Writer
@@ -32,9 +36,58 @@ from rich.logging import RichHandler
 from rich.progress import track
 from selenium.webdriver.remote.webdriver import WebDriver
 
-from . import AmzscoutscrapeAssets, __copyright__, __title__, __version__, metadata
-from .driver import Driver, create_fresh_driver
-from .scrape import search_and_write_amazon, search_and_write_amzscout
+from . import __copyright__, __title__, __version__, metadata
+from .accounts import AccountPool, account_of
+from .archive import SnapshotArchive
+from .blocking import DEFAULT_BLOCKED_RESOURCE_TYPES, blocked_url_patterns, parse_resource_types
+from .compaction import DEFAULT_MAX_OPEN_RUNS
+from .compaction import compact as compact_files
+from .coordinator import (
+    DEFAULT_LEASE_SECONDS,
+    DEFAULT_MAX_ATTEMPTS,
+    LeaseQueue,
+    LeaseWriter,
+    default_worker_id,
+)
+from .driver import (
+    LAUNCH_PROFILES,
+    PAGE_LOAD_STRATEGIES,
+    AccountProvisioner,
+    Driver,
+    create_fresh_driver,
+    driver_memory,
+    register_account,
+)
+from .httpclient import DEFAULT_POOL_MAXSIZE, client_stats, configure_clients
+from .lanes import BrowserHost, Lane
+from .output import has_content, open_output
+from .pagetrace import NetworkTracer
+from .pipeline import StageMetrics
+from .postprocess import DEFAULT_DROPPED_COLUMNS, postprocess
+from .processes import MemoryUsage, available_memory, mark_session
+from .queries import parse_shard, query_stream
+from .reparse import reparse as reparse_archive
+from .server import DEFAULT_HOST, DEFAULT_PORT, DriverPool, ScrapeServer
+from .scheduler import (
+    DEFAULT_QUERY_ATTEMPTS,
+    DEFAULT_RETRY_BACKOFF,
+    QueryHistory,
+    QueryScheduler,
+    read_priorities,
+)
+from .scrape import EXTRACTION_MODES, search_and_write_amazon, search_and_write_amzscout
+from .store import ProductStore, StoreWriter
+from .supervisor import DEFAULT_HEARTBEAT_TIMEOUT, SessionReporter, Supervisor
+from .thumbnails import THUMBNAIL_FORMATS, ThumbnailTranscoder
+from .tracing import CommandTracer
+from .twopass import (
+    DEFAULT_DEEP_WORKERS,
+    HarvestStore,
+    HarvestWriter,
+    deep_scrape_pass,
+    scrape_product_page,
+)
+from .utils import DeadlineExceeded, deadline
 
 logger = logging.getLogger(__package__)
 cli = typer.Typer()
@@ -68,34 +121,7 @@ def info(n_seconds: float = 0.01, verbose: bool = False) -> None:
     typer.echo(f"Processed {total} things.")
 
 
-@cli.command()
-def generate(
-    filename: str = "amzscout.csv",
-    verbosity: int = 0,
-    headful: bool = False,
-    driver_type: str = "default",
-    queries: int = -1,
-    skip: int = 0,
-    timeout: Optional[float] = None,
-    proxy: Optional[str] = None,
-    extension: bool = True,
-) -> None:
-    """
-    Generate a basic csv from AMZScout data.
-    Returns:
-
-
-    Args:
-        skip: How many queries to skip ahead
-        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
-        queries: The number of queries to run. Defaults to None, which means all queries.
-        filename: The filename to write to. Defaults to "amzscout.csv".
-        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
-        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
-        timeout: The number of seconds to wait for the page to load before giving up.
-        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
-        extension: Use the legacy scraper. This is slower, but more reliable.
-    """
+def _configure_logging(verbosity: int) -> None:
     log_level = logging.ERROR
     match verbosity:
         case 0:
@@ -109,6 +135,8 @@ def generate(
 
     logging.basicConfig(level=log_level, handlers=[RichHandler()])
 
+
+def _resolve_driver_type(driver_type: str, extension: bool) -> Driver:
     driver_enum_value: Driver = Driver.U_CHROME
     match driver_type:
         case "default":
@@ -133,32 +161,854 @@ def generate(
             driver_enum_value = Driver.U_CHROME
         case _:
             logger.warning(f"Invalid driver {driver_type!r}")
+    return driver_enum_value
+
+
+def _parse_shard_option(shard: str | None) -> tuple[int, int] | None:
+    if shard is None:
+        return None
+    try:
+        return parse_shard(shard)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--shard") from None
+
+
+def _blocked_urls(block_resources: str, block_pattern: list[str]) -> tuple[str, ...]:
+    try:
+        resource_types = parse_resource_types(block_resources)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--block-resources") from None
+    return blocked_url_patterns(resource_types, block_pattern)
+
+
+def _quit_driver(driver: WebDriver, account_pool: AccountPool | None) -> None:
+    # hand the account back so whatever quota it has left isn't wasted
+    if account_pool is not None and (account := account_of(driver)) is not None:
+        account_pool.release(account.id)
+    driver.quit()
+
+
+def _spend_account_use(driver: WebDriver, account_pool: AccountPool | None) -> bool:
+    """
+    Count a search against the driver's account.
+
+    Returns:
+        True if the account is used up and the driver should be replaced.
+    """
+    if account_pool is None or (account := account_of(driver)) is None:
+        return False
+    return account_pool.record_use(account.id) == 0
+
+
+class _BufferedWriter:
+    """
+    A stand-in for a CSV writer that collects the rows of one query, so they can be written all at once.
+    """
+
+    def __init__(self, *, expect_header: bool = False) -> None:
+        self.expect_header = expect_header
+        self.header: list[str] | None = None
+        self.rows: list[list[str]] = []
 
-    with AmzscoutscrapeAssets.path("amazon_products.txt").open("r", encoding="utf-8") as fp:
-        potential_queries = [line.strip() for line in fp.readlines()][skip:queries]
+    def writerow(self, row: Sequence[str]) -> None:
+        if self.expect_header:
+            self.expect_header = False
+            self.header = list(row)
+            return
+        self.rows.append(list(row))
+
+
+class _SessionWriter(_BufferedWriter):
+    """
+    Collects the rows of one query in a supervised session.
+
+    Every row is a heartbeat, so a session is only killed once rows stop coming.
+    """
+
+    def __init__(self, reporter: SessionReporter, *, expect_header: bool = False) -> None:
+        super().__init__(expect_header=expect_header)
+        self.reporter = reporter
+
+    def writerow(self, row: Sequence[str]) -> None:
+        self.reporter.beat()
+        super().writerow(row)
+
+
+def _scrape_session(
+    queries: Sequence[str],
+    reporter: SessionReporter,
+    *,
+    write_headers: bool,
+    extension: bool,
+    driver_options: dict[str, Any],
+    scrape_options: dict[str, Any],
+    thumbnail_options: dict[str, Any],
+    accounts: str | None,
+    archive: str | None,
+    query_budget: float | None,
+) -> None:
+    # runs in a child process of the supervisor, so it opens its own everything
+    account_pool = AccountPool(accounts) if accounts is not None else None
+    snapshot_archive = SnapshotArchive(archive) if archive is not None else None
+    driver: WebDriver | None = None
+    try:
+        with ThumbnailTranscoder(**thumbnail_options) as transcoder:
+            for query in queries:
+                reporter.started(query)
+                while driver is None:
+                    logger.info("Attempting to create a new driver...")
+                    driver = create_fresh_driver(account_pool=account_pool, **driver_options)
+                    reporter.beat()
+                writer = _SessionWriter(reporter, expect_header=write_headers)
+                query_metrics: list[StageMetrics] = []
+                try:
+                    logger.info(f"Starting {query!r}...")
+                    with deadline(query_budget) as budget:
+                        if extension:
+                            query_metrics = search_and_write_amazon(
+                                driver,
+                                cast(Writer, writer),
+                                query,
+                                write_headers=writer.expect_header,
+                                thumbnail_transcoder=transcoder,
+                                archive=snapshot_archive,
+                                budget=budget,
+                                **scrape_options,
+                            )
+                        else:
+                            search_and_write_amzscout(
+                                driver,
+                                cast(Writer, writer),
+                                query,
+                                write_headers=writer.expect_header,
+                                proxy=scrape_options["proxy"],
+                            )
+                except DeadlineExceeded as e:
+                    logger.warning(f"Abandoned {query!r}: {e}")
+                    reporter.failed(query, repr(e))
+                except Exception as e:
+                    logger.exception(f"Error while processing query {query!r}: {e}")
+                    reporter.failed(query, repr(e))
+                else:
+                    reporter.done(query, (writer.header, writer.rows, query_metrics))
+                    write_headers = write_headers and writer.header is None
+                if _spend_account_use(driver, account_pool):
+                    logger.info("Account used up, killing driver...")
+                    _quit_driver(driver, account_pool)
+                    driver = None
+    finally:
+        if driver is not None:
+            _quit_driver(driver, account_pool)
+        if account_pool is not None:
+            account_pool.close()
+
+
+def _generate_supervised(
+    supervisor: Supervisor,
+    potential_queries: Iterable[str],
+    filepath: Path,
+    *,
+    append: bool,
+    compression_level: int | None,
+    session_size: int,
+    total: int | None,
+) -> None:
+    with open_output(filepath, append=append, level=compression_level) as fp:
+        csv_writer = cast(Writer, csv.writer(fp, dialect="excel"))
+        typer.echo(f"Writing to {filepath.absolute()}")
+
+        stage_totals: dict[str, StageMetrics] = {}
+        header_written = append
+        fails = 0
+        completed = 0
+        for result in track(
+            supervisor.run(potential_queries, session_size),
+            description="Scraping (this WILL take a while)...",
+            total=total,
+        ):
+            completed += 1
+            if result.error is not None:
+                fails += 1
+                logger.info(f"Skipped {result.item!r} ({result.error}), {fails} fails so far...")
+                continue
+            header, rows, query_metrics = result.result
+            if header is not None and not header_written:
+                csv_writer.writerow(header)
+                header_written = True
+            # a query's rows arrive all at once, so a killed session never leaves half a query behind
+            csv_writer.writerows(rows)
+            fp.flush()
+            for stage_metrics in query_metrics:
+                stage_totals.setdefault(
+                    stage_metrics.name, StageMetrics(stage_metrics.name, stage_metrics.workers)
+                ).merge(stage_metrics)
+        logger.info(f"Completed lookup of {completed} queries." f" {fails} failed.")
+        if completed:
+            logger.info(f"Fail rate: {fails / completed * 100:.2f}%")
+        for stage_metrics in stage_totals.values():
+            logger.info(f"Stage {stage_metrics}")
+        if supervisor.interventions:
+            typer.echo(f"The supervisor stepped in {len(supervisor.interventions)} times:")
+            for intervention in supervisor.interventions:
+                typer.echo(f"  {intervention}")
+
+
+def _generate_lanes(
+    potential_queries: Iterable[str],
+    filepath: Path,
+    *,
+    append: bool,
+    compression_level: int | None,
+    lanes: int,
+    new_driver: Callable[[], WebDriver],
+    account_pool: AccountPool | None,
+    capture_network: bool,
+    thumbnail_options: dict[str, Any],
+    scrape_options: dict[str, Any],
+    query_budget: float | None,
+) -> None:
+    with open_output(filepath, append=append, level=compression_level) as fp, ThumbnailTranscoder(
+        **thumbnail_options
+    ) as transcoder:
+        csv_writer = cast(Writer, csv.writer(fp, dialect="excel"))
+        typer.echo(f"Writing to {filepath.absolute()} with {lanes} lanes per browser")
+
+        header_written = append
+        fails = 0
+        completed = 0
+        remaining = iter(potential_queries)
+        # a browser serves as many queries as a driver would, its lanes just share them out
+        while batch := list(islice(remaining, USES_OF_EXTENSION)):
+            driver: WebDriver | None = None
+            while driver is None:
+                logger.info("Attempting to create a new browser...")
+                driver = new_driver()
+            try:
+                with BrowserHost(driver, capture_network=capture_network) as host:
+                    free_lanes: Queue[Lane] = Queue()
+                    for _ in range(min(lanes, len(batch))):
+                        free_lanes.put(host.open_lane())
+
+                    def scrape(query: str) -> _BufferedWriter:
+                        lane = free_lanes.get()
+                        try:
+                            logger.info(f"Starting {query!r}...")
+                            writer = _BufferedWriter(expect_header=not header_written)
+                            with deadline(query_budget) as budget:
+                                search_and_write_amazon(
+                                    lane.driver,
+                                    cast(Writer, writer),
+                                    query,
+                                    write_headers=writer.expect_header,
+                                    thumbnail_transcoder=transcoder,
+                                    budget=budget,
+                                    **scrape_options,
+                                )
+                            return writer
+                        finally:
+                            free_lanes.put(lane)
+
+                    with ThreadPoolExecutor(lanes, thread_name_prefix="Lane") as executor:
+                        futures = {executor.submit(scrape, query): query for query in batch}
+                        # rows are written from here as each query finishes, so the lanes never share the file
+                        for future in as_completed(futures):
+                            query = futures[future]
+                            completed += 1
+                            _spend_account_use(driver, account_pool)
+                            try:
+                                writer = future.result()
+                            except DeadlineExceeded as e:
+                                fails += 1
+                                logger.warning(f"Abandoned {query!r}, {fails} fails so far: {e}")
+                                continue
+                            except Exception as e:
+                                fails += 1
+                                logger.exception(f"Error while processing query {query!r}: {e}")
+                                continue
+                            if writer.header is not None and not header_written:
+                                csv_writer.writerow(writer.header)
+                                header_written = True
+                            csv_writer.writerows(writer.rows)
+                            fp.flush()
+            finally:
+                _quit_driver(driver, account_pool)
+        logger.info(f"Completed lookup of {completed} queries." f" {fails} failed.")
+        if completed:
+            logger.info(f"Fail rate: {fails / completed * 100:.2f}%")
+
+
+def _retire_served_driver(driver: WebDriver, uses: int, account_pool: AccountPool | None) -> bool:
+    # pooled accounts last as long as their quota, anything else as long as a generate driver would
+    if _spend_account_use(driver, account_pool):
+        return True
+    return account_of(driver) is None and uses >= USES_OF_EXTENSION
+
+
+def _scrape_served_query(
+    driver: WebDriver,
+    writer: Any,
+    query: str,
+    *,
+    transcoder: ThumbnailTranscoder,
+    query_budget: float | None,
+    scrape_options: dict[str, Any],
+) -> None:
+    with deadline(query_budget) as budget:
+        search_and_write_amazon(
+            driver,
+            cast(Writer, writer),
+            query,
+            write_headers=True,
+            thumbnail_transcoder=transcoder,
+            budget=budget,
+            **scrape_options,
+        )
+
+
+def _listings_path(filepath: Path) -> Path:
+    # amzscout.csv.gz -> amzscout.listings.csv.gz, so it is compressed the same way
+    base, dot, suffixes = filepath.name.partition(".")
+    return filepath.with_name(f"{base}.listings{dot}{suffixes}")
+
+
+def _generate_two_pass(
+    scheduler: QueryScheduler,
+    filepath: Path,
+    *,
+    append: bool,
+    compression_level: int | None,
+    new_driver: Callable[[], WebDriver],
+    new_page_driver: Callable[[], WebDriver],
+    account_pool: AccountPool | None,
+    deep_workers: int,
+    harvest_database: str | None,
+    thumbnail_options: dict[str, Any],
+    scrape_options: dict[str, Any],
+    blocked_urls: Sequence[str],
+    query_budget: float | None,
+) -> None:
+    listings_path = _listings_path(filepath)
+    with HarvestStore(harvest_database) as store:
+        typer.echo(f"Harvesting listings into {listings_path}")
+        listings_exist = has_content(listings_path)
+        with open_output(
+            listings_path, append=listings_exist, level=compression_level
+        ) as fp, ThumbnailTranscoder(**thumbnail_options) as transcoder:
+            listings = cast(Writer, csv.writer(fp, dialect="excel"))
+            if not listings_exist and (header := store.header()) is not None:
+                listings.writerow(header)
+                listings_exist = True
+            driver: WebDriver | None = None
+            generation = 0
+            uses = 0
+            fails = 0
+            try:
+                for task in scheduler:
+                    query = task.query
+                    if store.harvested(query):
+                        logger.info(f"{query!r} was already harvested, skipping...")
+                        continue
+                    if driver is not None and (
+                        task.avoid == generation
+                        or (uses >= USES_OF_EXTENSION and account_of(driver) is None)
+                    ):
+                        _quit_driver(driver, account_pool)
+                        driver = None
+                    while driver is None:
+                        logger.info("Attempting to create a new driver...")
+                        driver = new_driver()
+                        generation += 1
+                        scheduler.worker = generation
+                        uses = 0
+                    writer = HarvestWriter(
+                        store,
+                        query,
+                        expect_header=store.header() is None,
+                        listings=listings,
+                        listings_header=not listings_exist,
+                    )
+                    uses += 1
+                    try:
+                        logger.info(f"Harvesting {query!r}, attempt {task.attempt}...")
+                        with deadline(query_budget) as budget:
+                            search_and_write_amazon(
+                                driver,
+                                cast(Writer, writer),
+                                query,
+                                write_headers=writer.expect_header,
+                                thumbnail_transcoder=transcoder,
+                                budget=budget,
+                                deep_scrape=False,
+                                **scrape_options,
+                            )
+                    except Exception as e:
+                        logger.warning(f"Error while harvesting {query!r}: {e!r}")
+                        if not scheduler.failed(task, repr(e), generation):
+                            fails += 1
+                    else:
+                        scheduler.succeeded(task, writer.commit())
+                        listings_exist = True
+                        fp.flush()
+                    if _spend_account_use(driver, account_pool):
+                        logger.info("Account used up, killing driver...")
+                        _quit_driver(driver, account_pool)
+                        driver = None
+            finally:
+                if driver is not None:
+                    _quit_driver(driver, account_pool)
+        listed, products = store.counts()
+        typer.echo(
+            f"First pass done: {listed} listing rows, {products} distinct products, {fails} queries failed."
+        )
+
+        result = deep_scrape_pass(
+            store,
+            new_driver=new_page_driver,
+            scrape_page=partial(scrape_product_page, blocked_urls=blocked_urls),
+            workers=deep_workers,
+        )
+        typer.echo(
+            f"Second pass done: {result.scraped} product pages scraped, {result.failed} failed,"
+            f" {listed - products} repeat scrapes saved."
+        )
+
+        with open_output(filepath, append=append, level=compression_level) as fp:
+            written = store.write_joined(
+                cast(Writer, csv.writer(fp, dialect="excel")), write_header=not append
+            )
+        typer.echo(f"Wrote {written} rows to {filepath}")
+
+
+@cli.command()
+def provision(
+    database: str = "amzscout-accounts.sqlite3",
+    count: int = 5,
+    verbosity: int = 0,
+    headful: bool = False,
+    driver_type: str = "default",
+    timeout: Optional[float] = None,
+    proxy: Optional[str] = None,
+    launch_profile: str = "default",
+) -> None:
+    """
+    Register AMZScout accounts ahead of time so that scrapes can start signed in.
+
+    Args:
+        database: The SQLite database that holds the accounts.
+        count: Register accounts until this many are ready to be used.
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
+        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
+        timeout: The number of seconds to wait for the page to load before giving up.
+        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
+        launch_profile: "low-memory" launches Chromium without the subsystems a scrape doesn't need.
+    """
+    _configure_logging(verbosity)
+    driver_enum_value = _resolve_driver_type(driver_type, True)
+    if launch_profile not in LAUNCH_PROFILES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(LAUNCH_PROFILES)}", param_hint="--launch-profile"
+        )
+
+    with AccountPool(database) as account_pool:
+        typer.echo(f"Provisioning accounts in {account_pool.path.absolute()}")
+        while (ready := account_pool.ready_count()) < count:
+            logger.info(f"{ready} of {count} accounts ready, registering another...")
+            register_account(
+                account_pool,
+                headless=not headful,
+                driver_type=driver_enum_value,
+                timeout=timeout,
+                proxy=proxy,
+                launch_profile=launch_profile,
+            )
+        typer.echo(f"{account_pool.ready_count()} accounts ready.")
+
+
+@cli.command()
+def generate(
+    filename: str = "amzscout.csv",
+    verbosity: int = 0,
+    headful: bool = False,
+    driver_type: str = "default",
+    queries: int = -1,
+    skip: int = 0,
+    queries_file: Optional[str] = None,
+    shard: Optional[str] = None,
+    dedupe: bool = True,
+    timeout: Optional[float] = None,
+    proxy: Optional[str] = None,
+    extension: bool = True,
+    block_resources: str = ",".join(DEFAULT_BLOCKED_RESOURCE_TYPES),
+    block_pattern: List[str] = typer.Option([]),
+    page_load_strategy: str = "normal",
+    launch_profile: str = "default",
+    thumbnail_format: str = "passthrough",
+    thumbnail_size: int = 160,
+    thumbnail_quality: int = 60,
+    thumbnail_workers: Optional[int] = None,
+    compression_level: Optional[int] = None,
+    image_workers: int = 4,
+    transform_workers: int = 2,
+    queue_size: int = 8,
+    accounts: Optional[str] = None,
+    provision_accounts: int = 0,
+    extraction: str = "dom",
+    trace: bool = False,
+    archive: Optional[str] = None,
+    supervise: bool = False,
+    heartbeat_timeout: float = DEFAULT_HEARTBEAT_TIMEOUT,
+    query_budget: Optional[float] = None,
+    lanes: int = 1,
+    attempts: int = DEFAULT_QUERY_ATTEMPTS,
+    retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+    priorities: Optional[str] = None,
+    history: Optional[str] = None,
+    two_pass: bool = False,
+    deep_workers: int = DEFAULT_DEEP_WORKERS,
+    harvest_database: Optional[str] = None,
+    http_pool_size: int = DEFAULT_POOL_MAXSIZE,
+    network_trace: Optional[str] = None,
+) -> None:
+    """
+    Generate a basic csv from AMZScout data.
+    Returns:
+
+
+    Args:
+        skip: How many queries to skip ahead
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        queries: The number of queries to run. Defaults to -1, which means all queries.
+        queries_file: A file with one query per line to use instead of the bundled list. "-" reads from stdin.
+        shard: Only run the queries in shard i of n, written as "i/n" (e.g. "0/4"). Shards never overlap.
+        dedupe: Skip queries that already came up earlier in the list.
+        filename: The filename to write to. Defaults to "amzscout.csv".
+        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
+        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
+        timeout: The number of seconds to wait for the page to load before giving up.
+        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
+        extension: Scrape Amazon's search pages through the AMZScout extension. Without it, the AMZScout database is searched directly over HTTP, and the browser is only used to sign in.
+        block_resources: Comma-separated resource types that product pages may not load. Pass "" to load everything.
+        block_pattern: Extra URL patterns (with * wildcards) that product pages may not load. Can be repeated.
+        page_load_strategy: When navigation returns: "normal" (load event), "eager" (DOMContentLoaded) or "none".
+        launch_profile: "low-memory" launches Chromium without the subsystems a scrape doesn't need, so more drivers fit on a host. See the memory command.
+        thumbnail_format: Re-encode thumbnails as "webp" or "jpeg", or keep Amazon's original with "passthrough".
+        thumbnail_size: The largest width or height a re-encoded thumbnail may have, in pixels.
+        thumbnail_quality: The encoder quality (0-100) for re-encoded thumbnails.
+        thumbnail_workers: How many processes re-encode thumbnails. Defaults to one per CPU.
+        compression_level: The level to compress at when the filename ends in .gz or .zst.
+        image_workers: How many thumbnails are downloaded at once.
+        transform_workers: How many rows are encoded at once.
+        queue_size: How many rows may wait in front of each stage of the scrape.
+        accounts: A SQLite database of accounts registered with the provision command. Drivers start signed in to one of them instead of signing up.
+        provision_accounts: Keep this many accounts ready in the background while scraping. Needs --accounts.
+        extraction: "dom" reads the AMZScout panel's table. "api" builds the rows from the responses it is filled from instead, keeps them in the "API Data" column, and finishes as soon as they arrive. Chromium only.
+        trace: Time every command sent to the browser and print where the time went at the end.
+        archive: A directory to save the raw pages in, so the reparse command can produce the rows again offline.
+        supervise: Run each driver session in a child process that is killed and replaced if it stops making progress, and clean up browsers that dead sessions leave behind.
+        heartbeat_timeout: With --supervise, how many seconds a session may go without progress before it is killed.
+        query_budget: The most seconds a query may take in all. Every wait, page load and download gets what is left of it, and a query that runs over is abandoned. Unlimited by default.
+        lanes: Scrape this many queries at once in one browser, each in its own tab with its own WebDriver session. Chromium only.
+        attempts: How many times a failing query is tried before it is given up on. Retries run on a fresh driver.
+        retry_backoff: How many seconds a failed query waits before it is retried, doubling with every attempt.
+        priorities: A file of "query<TAB>priority" lines. Higher priorities are scraped first.
+        history: A SQLite database of how queries did in earlier runs. Queries that yield more rows and haven't been scraped in a while go first.
+        two_pass: Read every query's listing first, into a ".listings" csv next to the output, then scrape every product page once and write the joined rows. Products that come up in several queries are only deep scraped once.
+        deep_workers: With --two-pass, how many drivers scrape product pages at once. They don't need the extension.
+        harvest_database: With --two-pass, keep the harvest in this SQLite database instead of a temporary one.
+        http_pool_size: How many connections to keep open to each host for thumbnails. They are reused from query to query.
+        network_trace: Record the bytes, requests and load times of every page into this file, one JSON object per line, and print what each kind of page, query and proxy cost at the end. Chromium only.
+    """
+    _configure_logging(verbosity)
+    mark_session()
+    configure_clients(pool_maxsize=max(http_pool_size, image_workers))
+    driver_enum_value = _resolve_driver_type(driver_type, extension)
+    command_tracer = CommandTracer() if trace else None
+    snapshot_archive = SnapshotArchive(archive) if archive is not None else None
+    blocked_urls = _blocked_urls(block_resources, block_pattern)
+    if page_load_strategy not in PAGE_LOAD_STRATEGIES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(PAGE_LOAD_STRATEGIES)}", param_hint="--page-load-strategy"
+        )
+    if launch_profile not in LAUNCH_PROFILES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(LAUNCH_PROFILES)}", param_hint="--launch-profile"
+        )
+    if extraction not in EXTRACTION_MODES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(EXTRACTION_MODES)}", param_hint="--extraction"
+        )
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(THUMBNAIL_FORMATS)}", param_hint="--thumbnail-format"
+        )
+    if supervise and trace:
+        raise typer.BadParameter(
+            "supervised drivers run in other processes and can't be traced", param_hint="--trace"
+        )
+    if lanes > 1 and (supervise or not extension or driver_enum_value is Driver.FIREFOX):
+        raise typer.BadParameter(
+            "lanes need the extension and a Chromium browser, and can't be supervised",
+            param_hint="--lanes",
+        )
+    if two_pass and (supervise or lanes > 1 or not extension or archive is not None):
+        raise typer.BadParameter(
+            "two passes need the extension, and can't be combined with --supervise, --lanes or --archive",
+            param_hint="--two-pass",
+        )
+    if network_trace is not None and (
+        supervise or lanes > 1 or two_pass or not extension or driver_enum_value is Driver.FIREFOX
+    ):
+        raise typer.BadParameter(
+            "network traces need the extension and a Chromium browser, and only work on a plain run",
+            param_hint="--network-trace",
+        )
+
+    try:
+        user_priorities = read_priorities(priorities) if priorities is not None else None
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--priorities") from None
+
+    potential_queries = query_stream(
+        queries_file,
+        skip=skip,
+        limit=queries,
+        shard=_parse_shard_option(shard),
+        dedupe=dedupe,
+    )
 
     filepath = Path(filename).absolute()
 
-    exists = filepath.exists()
-    with filepath.open("w" if not exists else "a", newline="", encoding="utf-8") as fp:
+    account_pool = AccountPool(accounts) if accounts is not None and extension else None
+    provisioner: AccountProvisioner | None = None
+    if account_pool is not None and provision_accounts > 0:
+        provisioner = AccountProvisioner(
+            account_pool,
+            provision_accounts,
+            headless=not headful,
+            driver_type=driver_enum_value,
+            timeout=timeout,
+            proxy=proxy,
+            launch_profile=launch_profile,
+        )
+        provisioner.start()
+
+    exists = has_content(filepath)
+    if supervise:
+        supervisor = Supervisor(
+            partial(
+                _scrape_session,
+                write_headers=not exists,
+                extension=extension,
+                driver_options=dict(
+                    headless=not headful,
+                    timeout=timeout,
+                    driver_type=driver_enum_value,
+                    proxy=proxy,
+                    load_extension=extension,
+                    page_load_strategy=page_load_strategy,
+                    launch_profile=launch_profile,
+                    capture_network=extraction == "api",
+                ),
+                scrape_options=dict(
+                    proxy=proxy,
+                    blocked_urls=blocked_urls,
+                    image_workers=image_workers,
+                    transform_workers=transform_workers,
+                    queue_size=queue_size,
+                    extraction=extraction,
+                ),
+                thumbnail_options=dict(
+                    fmt=thumbnail_format,
+                    max_size=thumbnail_size,
+                    quality=thumbnail_quality,
+                    workers=thumbnail_workers,
+                ),
+                accounts=accounts if extension else None,
+                archive=archive,
+                query_budget=query_budget,
+            ),
+            heartbeat_timeout=heartbeat_timeout,
+            log_level=logging.getLogger().level,
+        )
+        try:
+            _generate_supervised(
+                supervisor,
+                potential_queries,
+                filepath,
+                append=exists,
+                compression_level=compression_level,
+                session_size=USES_OF_DEDICATED if not extension else USES_OF_EXTENSION,
+                total=queries if queries >= 0 else None,
+            )
+        finally:
+            if provisioner is not None:
+                provisioner.stop()
+            if account_pool is not None:
+                account_pool.close()
+        typer.echo("Done! Enjoy your freshly-picked data!")
+        return
+    if lanes > 1:
+        try:
+            _generate_lanes(
+                potential_queries,
+                filepath,
+                append=exists,
+                compression_level=compression_level,
+                lanes=lanes,
+                new_driver=partial(
+                    create_fresh_driver,
+                    headless=not headful,
+                    timeout=timeout,
+                    driver_type=driver_enum_value,
+                    proxy=proxy,
+                    load_extension=True,
+                    page_load_strategy=page_load_strategy,
+                    launch_profile=launch_profile,
+                    account_pool=account_pool,
+                    capture_network=extraction == "api",
+                ),
+                account_pool=account_pool,
+                capture_network=extraction == "api",
+                thumbnail_options=dict(
+                    fmt=thumbnail_format,
+                    max_size=thumbnail_size,
+                    quality=thumbnail_quality,
+                    workers=thumbnail_workers,
+                ),
+                scrape_options=dict(
+                    proxy=proxy,
+                    blocked_urls=blocked_urls,
+                    image_workers=image_workers,
+                    transform_workers=transform_workers,
+                    queue_size=queue_size,
+                    extraction=extraction,
+                    archive=snapshot_archive,
+                ),
+                query_budget=query_budget,
+            )
+        finally:
+            if provisioner is not None:
+                provisioner.stop()
+            if account_pool is not None:
+                account_pool.close()
+        typer.echo("Done! Enjoy your freshly-picked data!")
+        return
+    if two_pass:
+        query_history = QueryHistory(history) if history is not None else None
+        try:
+            _generate_two_pass(
+                QueryScheduler(
+                    potential_queries,
+                    history=query_history,
+                    priorities=user_priorities,
+                    max_attempts=attempts,
+                    retry_backoff=retry_backoff,
+                ),
+                filepath,
+                append=exists,
+                compression_level=compression_level,
+                new_driver=partial(
+                    create_fresh_driver,
+                    headless=not headful,
+                    timeout=timeout,
+                    driver_type=driver_enum_value,
+                    proxy=proxy,
+                    page_load_strategy=page_load_strategy,
+                    launch_profile=launch_profile,
+                    account_pool=account_pool,
+                    capture_network=extraction == "api",
+                ),
+                new_page_driver=partial(
+                    create_fresh_driver,
+                    headless=not headful,
+                    timeout=timeout,
+                    driver_type=driver_enum_value,
+                    proxy=proxy,
+                    load_extension=False,
+                    page_load_strategy=page_load_strategy,
+                    launch_profile=launch_profile,
+                ),
+                account_pool=account_pool,
+                deep_workers=deep_workers,
+                harvest_database=harvest_database,
+                thumbnail_options=dict(
+                    fmt=thumbnail_format,
+                    max_size=thumbnail_size,
+                    quality=thumbnail_quality,
+                    workers=thumbnail_workers,
+                ),
+                scrape_options=dict(
+                    proxy=proxy,
+                    blocked_urls=blocked_urls,
+                    image_workers=image_workers,
+                    transform_workers=transform_workers,
+                    queue_size=queue_size,
+                    extraction=extraction,
+                    archive=snapshot_archive,
+                ),
+                blocked_urls=blocked_urls,
+                query_budget=query_budget,
+            )
+        finally:
+            if provisioner is not None:
+                provisioner.stop()
+            if account_pool is not None:
+                account_pool.close()
+            if query_history is not None:
+                query_history.close()
+        typer.echo("Done! Enjoy your freshly-picked data!")
+        return
+
+    with open_output(filepath, append=exists, level=compression_level) as fp, ThumbnailTranscoder(
+        thumbnail_format,
+        max_size=thumbnail_size,
+        quality=thumbnail_quality,
+        workers=thumbnail_workers,
+    ) as transcoder:
         csv_writer = cast(Writer, csv.writer(fp, dialect="excel"))
 
         typer.echo(f"Writing to {filepath.absolute()}")
 
         driver: WebDriver | None = None
+        network_trace_file = (
+            open(network_trace, "a", encoding="utf-8") if network_trace is not None else None
+        )
+        network_tracer = (
+            NetworkTracer(network_trace_file) if network_trace_file is not None else None
+        )
+        # counts the drivers started, so a retry can tell it would be running on the driver it failed on
+        generation = 0
+        stage_totals: dict[str, StageMetrics] = {}
+        query_history = QueryHistory(history) if history is not None else None
+        scheduler = QueryScheduler(
+            potential_queries,
+            history=query_history,
+            priorities=user_priorities,
+            max_attempts=attempts,
+            retry_backoff=retry_backoff,
+        )
 
         try:
             fails = 0
-            for i, query in track(
-                enumerate(potential_queries),
+            completed = 0
+            header_written = exists
+            for i, task in track(
+                enumerate(scheduler),
                 description="Scraping (this WILL take a while)...",
-                total=len(potential_queries),
+                total=queries if queries >= 0 else None,
             ):
+                query = task.query
                 # Every 14 queries, restart the browser to avoid getting blocked out.
+                # Drivers signed in to a pooled account last as long as the account's quota instead.
                 use_count = USES_OF_DEDICATED if not extension else USES_OF_EXTENSION
-                if i % use_count == 0 and driver is not None:
+                if i % use_count == 0 and driver is not None and account_of(driver) is None:
                     logger.info("Driver expired, killing...")
-                    driver.quit()
+                    _quit_driver(driver, account_pool)
+                    driver = None
+                if driver is not None and task.avoid == generation:
+                    logger.info(f"{query!r} failed on this driver before, switching drivers...")
+                    _quit_driver(driver, account_pool)
                     driver = None
                 while driver is None:
                     logger.info("Attempting to create a new driver...")
@@ -168,33 +1018,451 @@ def generate(
                         driver_type=driver_enum_value,
                         proxy=proxy,
                         load_extension=extension,
+                        page_load_strategy=page_load_strategy,
+                        launch_profile=launch_profile,
+                        account_pool=account_pool,
+                        capture_network=extraction == "api" or network_tracer is not None,
+                        command_tracer=command_tracer,
                     )
+                    generation += 1
+                    scheduler.worker = generation
+                rows: int | None = None
+                # a failed attempt is retried, so nothing it wrote may reach the file
+                writer = _BufferedWriter(expect_header=not header_written)
                 try:
-                    logger.info(f"Starting {query!r}, #{i + skip}...")
-                    if extension:
+                    logger.info(f"Starting {query!r}, attempt {task.attempt}...")
+                    with deadline(query_budget) as budget:
+                        if extension:
+                            query_metrics = search_and_write_amazon(
+                                driver,
+                                cast(Writer, writer),
+                                query,
+                                write_headers=writer.expect_header,
+                                proxy=proxy,
+                                blocked_urls=blocked_urls,
+                                thumbnail_transcoder=transcoder,
+                                image_workers=image_workers,
+                                transform_workers=transform_workers,
+                                queue_size=queue_size,
+                                extraction=extraction,
+                                archive=snapshot_archive,
+                                budget=budget,
+                                network_tracer=network_tracer,
+                            )
+                            for stage_metrics in query_metrics:
+                                stage_totals.setdefault(
+                                    stage_metrics.name,
+                                    StageMetrics(stage_metrics.name, stage_metrics.workers),
+                                ).merge(stage_metrics)
+                            if query_metrics:
+                                rows = query_metrics[-1].processed
+                            if command_tracer is not None and rows is not None:
+                                command_tracer.count_rows(rows)
+                        else:
+                            rows = search_and_write_amzscout(
+                                driver,
+                                cast(Writer, writer),
+                                query,
+                                write_headers=writer.expect_header,
+                                proxy=proxy,
+                            )
+                except DeadlineExceeded as e:
+                    logger.warning(f"Abandoned {query!r}: {e}")
+                    if not scheduler.failed(task, repr(e), generation):
+                        fails += 1
+                        completed += 1
+                except Exception as e:
+                    logger.exception(f"Error while processing query {query!r}: {e}")
+                    if not scheduler.failed(task, repr(e), generation):
+                        fails += 1
+                        completed += 1
+                        logger.info(f"Skipping {query!r}, {fails} fails so far...")
+                else:
+                    if writer.header is not None and not header_written:
+                        csv_writer.writerow(writer.header)
+                        header_written = True
+                    csv_writer.writerows(writer.rows)
+                    scheduler.succeeded(task, rows)
+                    completed += 1
+                if _spend_account_use(driver, account_pool):
+                    logger.info("Account used up, killing driver...")
+                    _quit_driver(driver, account_pool)
+                    driver = None
+                fp.flush()  # so a crash doesn't take the whole compressed frame with it
+            logger.info(f"Completed lookup of {completed} queries." f" {fails} failed.")
+            if completed:
+                logger.info(f"Fail rate: {fails / completed * 100:.2f}%")
+            for stage_metrics in stage_totals.values():
+                logger.info(f"Stage {stage_metrics}")
+            for client_proxy, stats in client_stats().items():
+                logger.info(f"HTTP through {client_proxy or 'the system proxy'}: {stats}")
+            if command_tracer is not None:
+                typer.echo(str(command_tracer.report()))
+            if network_tracer is not None:
+                typer.echo(str(network_tracer.report()))
+        finally:
+            if driver is not None:
+                logger.info("Closing driver...")
+                _quit_driver(driver, account_pool)
+            if network_trace_file is not None:
+                network_trace_file.close()
+            if provisioner is not None:
+                provisioner.stop()
+            if account_pool is not None:
+                account_pool.close()
+            if query_history is not None:
+                query_history.close()
+
+        typer.echo("Done! Enjoy your freshly-picked data!")
+
+
+@cli.command()
+def coordinate(
+    database: str = "amzscout-queue.sqlite3",
+    filename: str = "amzscout.csv",
+    verbosity: int = 0,
+    queries: int = -1,
+    skip: int = 0,
+    queries_file: Optional[str] = None,
+    shard: Optional[str] = None,
+    dedupe: bool = True,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    poll_interval: float = 5.0,
+    compression_level: Optional[int] = None,
+    shared_database: bool = False,
+) -> None:
+    """
+    Own the query list, lease queries out to workers and collect their rows into a csv.
+
+    Args:
+        database: The SQLite database that holds the queue. Workers must be able to reach it.
+        filename: The filename to write to. Defaults to "amzscout.csv".
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        queries: The number of queries to run. Defaults to -1, which means all queries.
+        skip: How many queries to skip ahead
+        queries_file: A file with one query per line to use instead of the bundled list. "-" reads from stdin.
+        shard: Only queue the queries in shard i of n, written as "i/n" (e.g. "0/4").
+        dedupe: Skip queries that already came up earlier in the list.
+        lease_seconds: How long a worker may hold a query without progress before it is re-issued.
+        max_attempts: How many times a query is leased before it is given up on.
+        poll_interval: How many seconds to wait between collecting rows.
+        compression_level: The level to compress at when the filename ends in .gz or .zst.
+        shared_database: The database is on a network filesystem that workers on other hosts use too. Every worker must pass it as well.
+    """
+    _configure_logging(verbosity)
+
+    potential_queries = query_stream(
+        queries_file,
+        skip=skip,
+        limit=queries,
+        shard=_parse_shard_option(shard),
+        dedupe=dedupe,
+    )
+
+    filepath = Path(filename).absolute()
+    exists = has_content(filepath)
+
+    with LeaseQueue(
+        database,
+        lease_seconds=lease_seconds,
+        max_attempts=max_attempts,
+        shared=shared_database,
+    ) as queue, open_output(filepath, append=exists, level=compression_level) as fp:
+        csv_writer = cast(Writer, csv.writer(fp, dialect="excel"))
+        added = queue.add(potential_queries)
+        typer.echo(f"Queued {added} new queries in {queue.path.absolute()}")
+        typer.echo(f"Writing to {filepath}")
+
+        header_written = exists
+        while True:
+            queue.reissue_expired()
+            counts = queue.counts()
+            finished = counts["pending"] + counts["leased"] == 0
+            if not header_written and (header := queue.header()) is not None:
+                csv_writer.writerow(header)
+                header_written = True
+            if header_written:
+                while rows := queue.export_rows():
+                    csv_writer.writerows(rows)
+                fp.flush()
+            logger.info(", ".join(f"{count} {state}" for state, count in counts.items()))
+            if finished:
+                break
+            time.sleep(poll_interval)
+
+        typer.echo(f"{counts['done']} queries done, {counts['failed']} failed.")
+        typer.echo("Done! Enjoy your freshly-picked data!")
+
+
+@cli.command()
+def work(
+    database: str = "amzscout-queue.sqlite3",
+    verbosity: int = 0,
+    headful: bool = False,
+    driver_type: str = "default",
+    timeout: Optional[float] = None,
+    proxy: Optional[str] = None,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    poll_interval: float = 5.0,
+    exit_when_empty: bool = True,
+    block_resources: str = ",".join(DEFAULT_BLOCKED_RESOURCE_TYPES),
+    block_pattern: List[str] = typer.Option([]),
+    page_load_strategy: str = "normal",
+    launch_profile: str = "default",
+    accounts: Optional[str] = None,
+    extraction: str = "dom",
+    archive: Optional[str] = None,
+    query_budget: Optional[float] = None,
+    shared_database: bool = False,
+) -> None:
+    """
+    Lease queries from a coordinator's queue, scrape them and send the rows back.
+
+    Args:
+        database: The SQLite database that holds the queue.
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
+        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
+        timeout: The number of seconds to wait for the page to load before giving up.
+        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
+        lease_seconds: How long a query may be held without progress before it is re-issued.
+        max_attempts: How many times a query is leased before it is given up on.
+        poll_interval: How many seconds to wait for more work when the queue is empty.
+        exit_when_empty: Stop once every query is done instead of waiting for more.
+        block_resources: Comma-separated resource types that product pages may not load. Pass "" to load everything.
+        block_pattern: Extra URL patterns (with * wildcards) that product pages may not load. Can be repeated.
+        page_load_strategy: When navigation returns: "normal" (load event), "eager" (DOMContentLoaded) or "none".
+        launch_profile: "low-memory" launches Chromium without the subsystems a scrape doesn't need, so more drivers fit on a host. See the memory command.
+        accounts: A SQLite database of accounts registered with the provision command. Drivers start signed in to one of them instead of signing up.
+        extraction: "dom" reads the AMZScout panel's table. "api" builds the rows from the responses it is filled from instead, keeps them in the "API Data" column, and finishes as soon as they arrive. Chromium only.
+        archive: A directory to save the raw pages in, so the reparse command can produce the rows again offline.
+        query_budget: The most seconds a query may take in all. Every wait, page load and download gets what is left of it, and a query that runs over is abandoned. Unlimited by default.
+        shared_database: The database is on a network filesystem that the coordinator and workers on other hosts use too.
+    """
+    _configure_logging(verbosity)
+    mark_session()
+    driver_enum_value = _resolve_driver_type(driver_type, True)
+    snapshot_archive = SnapshotArchive(archive) if archive is not None else None
+    blocked_urls = _blocked_urls(block_resources, block_pattern)
+    if page_load_strategy not in PAGE_LOAD_STRATEGIES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(PAGE_LOAD_STRATEGIES)}", param_hint="--page-load-strategy"
+        )
+    if launch_profile not in LAUNCH_PROFILES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(LAUNCH_PROFILES)}", param_hint="--launch-profile"
+        )
+    if extraction not in EXTRACTION_MODES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(EXTRACTION_MODES)}", param_hint="--extraction"
+        )
+    worker = default_worker_id()
+    account_pool = AccountPool(accounts) if accounts is not None else None
+
+    with LeaseQueue(
+        database, lease_seconds=lease_seconds, max_attempts=max_attempts, shared=shared_database
+    ) as queue:
+        typer.echo(f"Working on {queue.path.absolute()} as {worker}")
+
+        driver: WebDriver | None = None
+        uses = 0
+        done = 0
+
+        try:
+            while True:
+                query = queue.lease(worker)
+                if query is None:
+                    if exit_when_empty and queue.finished():
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                if uses >= USES_OF_EXTENSION and driver is not None and account_of(driver) is None:
+                    logger.info("Driver expired, killing...")
+                    _quit_driver(driver, account_pool)
+                    driver = None
+                while driver is None:
+                    logger.info("Attempting to create a new driver...")
+                    driver = create_fresh_driver(
+                        headless=not headful,
+                        timeout=timeout,
+                        driver_type=driver_enum_value,
+                        proxy=proxy,
+                        page_load_strategy=page_load_strategy,
+                        launch_profile=launch_profile,
+                        account_pool=account_pool,
+                        capture_network=extraction == "api",
+                    )
+                    uses = 0
+
+                writer = LeaseWriter(queue, query, worker, expect_header=queue.header() is None)
+                try:
+                    logger.info(f"Starting {query!r}...")
+                    uses += 1
+                    with deadline(query_budget) as budget:
                         search_and_write_amazon(
                             driver,
-                            csv_writer,
-                            query,
-                            write_headers=i == 0 and not exists,
-                            proxy=proxy,
-                        )
-                    else:
-                        search_and_write_amzscout(
-                            driver,
-                            csv_writer,
+                            cast(Writer, writer),
                             query,
-                            write_headers=i == 0 and not exists,
+                            write_headers=writer.expect_header,
                             proxy=proxy,
+                            blocked_urls=blocked_urls,
+                            extraction=extraction,
+                            archive=snapshot_archive,
+                            budget=budget,
                         )
+                except DeadlineExceeded as e:
+                    logger.warning(f"Abandoned {query!r}: {e}")
+                    queue.fail(query, worker, repr(e))
                 except Exception as e:
-                    fails += 1
                     logger.exception(f"Error while processing query {query!r}: {e}")
-                    logger.info(f"Skipping {query!r}, {fails} fails so far...")
-            logger.info(
-                f"Completed lookup of {len(potential_queries)} queries." f" {fails} failed."
-            )
-            logger.info(f"Fail rate: {fails / len(potential_queries) * 100:.2f}%")
+                    queue.fail(query, worker, repr(e))
+                else:
+                    if writer.commit():
+                        done += 1
+                if _spend_account_use(driver, account_pool):
+                    logger.info("Account used up, killing driver...")
+                    _quit_driver(driver, account_pool)
+                    driver = None
+        finally:
+            if driver is not None:
+                logger.info("Closing driver...")
+                _quit_driver(driver, account_pool)
+            if account_pool is not None:
+                account_pool.close()
+
+        typer.echo(f"Finished {done} queries.")
+
+
+@cli.command()
+def refresh(
+    database: str = "amzscout-products.sqlite3",
+    filename: str = "amzscout.csv",
+    verbosity: int = 0,
+    headful: bool = False,
+    driver_type: str = "default",
+    queries: int = -1,
+    skip: int = 0,
+    queries_file: Optional[str] = None,
+    shard: Optional[str] = None,
+    dedupe: bool = True,
+    timeout: Optional[float] = None,
+    proxy: Optional[str] = None,
+    block_resources: str = ",".join(DEFAULT_BLOCKED_RESOURCE_TYPES),
+    block_pattern: List[str] = typer.Option([]),
+    page_load_strategy: str = "normal",
+    launch_profile: str = "default",
+    deep_scrape_ttl_days: float = 30.0,
+    interval: float = 0.0,
+    compression_level: Optional[int] = None,
+    query_budget: Optional[float] = None,
+) -> None:
+    """
+    Bring a dataset up to date: re-read every query's listing, but only deep scrape products that have gone stale.
+
+    Every product is kept once in a database, keyed by its ASIN, and the csv is rewritten from it after each pass.
+
+    Args:
+        database: The SQLite database that keeps the latest row of every product.
+        filename: The csv to rewrite after each pass. Defaults to "amzscout.csv".
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
+        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
+        queries: The number of queries to run. Defaults to -1, which means all queries.
+        skip: How many queries to skip ahead
+        queries_file: A file with one query per line to use instead of the bundled list. "-" reads from stdin.
+        shard: Only run the queries in shard i of n, written as "i/n" (e.g. "0/4"). Shards never overlap.
+        dedupe: Skip queries that already came up earlier in the list.
+        timeout: The number of seconds to wait for the page to load before giving up.
+        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
+        block_resources: Comma-separated resource types that product pages may not load. Pass "" to load everything.
+        block_pattern: Extra URL patterns (with * wildcards) that product pages may not load. Can be repeated.
+        page_load_strategy: When navigation returns: "normal" (load event), "eager" (DOMContentLoaded) or "none".
+        launch_profile: "low-memory" launches Chromium without the subsystems a scrape doesn't need, so more drivers fit on a host. See the memory command.
+        deep_scrape_ttl_days: How old a product's description may get before it is deep scraped again.
+        interval: Seconds to wait before starting the next pass. 0 stops after one pass.
+        compression_level: The level to compress at when the filename ends in .gz or .zst.
+        query_budget: The most seconds a query may take in all. Every wait, page load and download gets what is left of it, and a query that runs over is abandoned. Unlimited by default.
+    """
+    _configure_logging(verbosity)
+    driver_enum_value = _resolve_driver_type(driver_type, True)
+    blocked_urls = _blocked_urls(block_resources, block_pattern)
+    if page_load_strategy not in PAGE_LOAD_STRATEGIES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(PAGE_LOAD_STRATEGIES)}", param_hint="--page-load-strategy"
+        )
+    if launch_profile not in LAUNCH_PROFILES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(LAUNCH_PROFILES)}", param_hint="--launch-profile"
+        )
+    ttl = deep_scrape_ttl_days * 24 * 60 * 60
+    filepath = Path(filename).absolute()
+
+    with ProductStore(database) as store:
+        typer.echo(f"Refreshing {store.path.absolute()} into {filepath}")
+        driver: WebDriver | None = None
+        try:
+            while True:
+                uses = 0
+                fails = 0
+                reused = 0
+                for query in query_stream(
+                    queries_file,
+                    skip=skip,
+                    limit=queries,
+                    shard=_parse_shard_option(shard),
+                    dedupe=dedupe,
+                ):
+                    if uses >= USES_OF_EXTENSION and driver is not None:
+                        logger.info("Driver expired, killing...")
+                        driver.quit()
+                        driver = None
+                    while driver is None:
+                        logger.info("Attempting to create a new driver...")
+                        driver = create_fresh_driver(
+                            headless=not headful,
+                            timeout=timeout,
+                            driver_type=driver_enum_value,
+                            proxy=proxy,
+                            page_load_strategy=page_load_strategy,
+                            launch_profile=launch_profile,
+                        )
+                        uses = 0
+
+                    writer = StoreWriter(
+                        store, query, ttl=ttl, expect_header=store.header() is None
+                    )
+                    try:
+                        logger.info(f"Refreshing {query!r}...")
+                        uses += 1
+                        with deadline(query_budget) as budget:
+                            search_and_write_amazon(
+                                driver,
+                                cast(Writer, writer),
+                                query,
+                                write_headers=writer.expect_header,
+                                proxy=proxy,
+                                blocked_urls=blocked_urls,
+                                cached_sections=writer.cached_sections,
+                                budget=budget,
+                            )
+                    except DeadlineExceeded as e:
+                        fails += 1
+                        logger.warning(f"Abandoned {query!r}: {e}")
+                    except Exception as e:
+                        fails += 1
+                        logger.exception(f"Error while refreshing query {query!r}: {e}")
+                    reused += writer.reused
+
+                exported = store.export(filepath, level=compression_level)
+                typer.echo(
+                    f"Pass done: {exported} products, {reused} deep scrapes reused, {fails} queries failed."
+                )
+                if interval <= 0:
+                    break
+                time.sleep(interval)
         finally:
             if driver is not None:
                 logger.info("Closing driver...")
@@ -203,5 +1471,318 @@ def generate(
         typer.echo("Done! Enjoy your freshly-picked data!")
 
 
+@cli.command()
+def compact(
+    sources: List[str] = typer.Argument(..., help="The files to merge, oldest first."),
+    destination: str = "amzscout-compact.csv",
+    verbosity: int = 0,
+    memory_limit_mb: int = 256,
+    max_open_runs: int = DEFAULT_MAX_OPEN_RUNS,
+    compression_level: Optional[int] = None,
+) -> None:
+    """
+    Merge output files into one, dropping duplicate rows and keeping the newest row of every product.
+
+    Products are deduplicated across queries, since output files don't say which query found a row.
+
+    Args:
+        sources: The files to merge, oldest first. They may be compressed, but must all have the same columns.
+        destination: Where to write the merged file.
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        memory_limit_mb: Roughly how many megabytes of rows to hold in memory. The rest is sorted on disk.
+        max_open_runs: How many files sorted on disk are merged at once. Keep it under the open file limit.
+        compression_level: The level to compress at when the destination ends in .gz or .zst.
+    """
+    _configure_logging(verbosity)
+    try:
+        report = compact_files(
+            sources,
+            destination,
+            memory_limit=memory_limit_mb * 1024 * 1024,
+            max_open_runs=max_open_runs,
+            level=compression_level,
+        )
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="SOURCES") from e
+    typer.echo(str(report))
+    typer.echo(f"Wrote {Path(destination).absolute()}")
+
+
+@cli.command()
+def reparse(
+    archive: str,
+    filename: str = "amzscout-reparsed.csv",
+    verbosity: int = 0,
+    processes: Optional[int] = None,
+    compression_level: Optional[int] = None,
+    thumbnail_format: str = "passthrough",
+    thumbnail_size: int = 160,
+    thumbnail_quality: int = 60,
+) -> None:
+    """
+    Produce the rows again from an archive written with generate --archive, without a browser or the network.
+
+    Args:
+        archive: The archive's directory.
+        filename: The filename to write to.
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        processes: How many processes parse at once. Defaults to one per CPU.
+        compression_level: The level to compress at when the filename ends in .gz or .zst.
+        thumbnail_format: Re-encode thumbnails as "webp" or "jpeg", or keep them as they were with "passthrough".
+        thumbnail_size: The largest width or height a re-encoded thumbnail may have, in pixels.
+        thumbnail_quality: The encoder quality (0-100) for re-encoded thumbnails.
+    """
+    _configure_logging(verbosity)
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(THUMBNAIL_FORMATS)}", param_hint="--thumbnail-format"
+        )
+    try:
+        queries, rows = reparse_archive(
+            archive,
+            filename,
+            processes=processes,
+            level=compression_level,
+            thumbnail_format=thumbnail_format,
+            thumbnail_size=thumbnail_size,
+            thumbnail_quality=thumbnail_quality,
+        )
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="ARCHIVE") from e
+    typer.echo(f"Reparsed {rows} rows from {queries} queries into {Path(filename).absolute()}")
+
+
+@cli.command(name="postprocess")
+def postprocess_command(
+    source: str = "amzscout.csv",
+    destination: str = "amzscout.parquet",
+    verbosity: int = 0,
+    chunksize: int = 100_000,
+    drop: List[str] = typer.Option(list(DEFAULT_DROPPED_COLUMNS)),
+    compression_level: Optional[int] = None,
+) -> None:
+    """
+    Turn the display text of a generated csv (prices, abbreviated sales, ranks...) into typed numbers.
+
+    Args:
+        source: The csv written by generate. It may be compressed.
+        destination: Where to write. A .parquet file keeps the types, anything else is written as a csv.
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        chunksize: How many rows are processed at a time. Lower it if memory is tight.
+        drop: Columns to leave out. Can be repeated. Defaults to the thumbnails.
+        compression_level: The level to compress at when the destination ends in .gz or .zst.
+    """
+    _configure_logging(verbosity)
+    report = postprocess(
+        source,
+        destination,
+        chunksize=chunksize,
+        drop=drop,
+        compression_level=compression_level,
+    )
+    typer.echo(str(report))
+    typer.echo(f"Wrote {Path(destination).absolute()}")
+
+
+@cli.command()
+def memory(
+    verbosity: int = 0,
+    headful: bool = False,
+    driver_type: str = "default",
+    timeout: Optional[float] = None,
+    proxy: Optional[str] = None,
+    launch_profile: str = "default",
+    queries: int = 3,
+    queries_file: Optional[str] = None,
+    block_resources: str = ",".join(DEFAULT_BLOCKED_RESOURCE_TYPES),
+) -> None:
+    """
+    Measure how much memory a driver takes up while it scrapes, to size worker counts from real numbers.
+
+    One driver is started and runs a few queries. Its whole process tree is measured after it starts and after every
+    query. The rows are thrown away.
+
+    Args:
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
+        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
+        timeout: The number of seconds to wait for the page to load before giving up.
+        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
+        launch_profile: The launch profile to measure, "default" or "low-memory".
+        queries: How many queries to run while measuring.
+        queries_file: A file with one query per line to use instead of the bundled list. "-" reads from stdin.
+        block_resources: Comma-separated resource types that product pages may not load. Pass "" to load everything.
+    """
+    _configure_logging(verbosity)
+    mark_session()
+    driver_enum_value = _resolve_driver_type(driver_type, True)
+    if launch_profile not in LAUNCH_PROFILES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(LAUNCH_PROFILES)}", param_hint="--launch-profile"
+        )
+    blocked_urls = _blocked_urls(block_resources, [])
+
+    driver = create_fresh_driver(
+        headless=not headful,
+        timeout=timeout,
+        driver_type=driver_enum_value,
+        proxy=proxy,
+        launch_profile=launch_profile,
+    )
+    samples: list[MemoryUsage] = []
+    try:
+        samples.append(driver_memory(driver))
+        typer.echo(f"Started: {samples[-1]}")
+        with open(os.devnull, "w", newline="") as fp:
+            csv_writer = cast(Writer, csv.writer(fp, dialect="excel"))
+            for query in query_stream(queries_file, limit=queries):
+                try:
+                    search_and_write_amazon(
+                        driver,
+                        csv_writer,
+                        query,
+                        write_headers=False,
+                        proxy=proxy,
+                        blocked_urls=blocked_urls,
+                    )
+                except Exception as e:
+                    logger.exception(f"Error while processing query {query!r}: {e}")
+                samples.append(driver_memory(driver))
+                typer.echo(f"After {query!r}: {samples[-1]}")
+    finally:
+        driver.quit()
+
+    # PSS if we have it, since RSS counts the memory Chromium's processes share once per process
+    measure = "PSS" if all(sample.pss is not None for sample in samples) else "RSS"
+    peak = max((sample.pss if measure == "PSS" else sample.rss) or 0 for sample in samples)
+    typer.echo(f"Peak: {peak / 2**20:.0f} MiB {measure} for one {launch_profile} driver")
+    if peak and (available := available_memory()) is not None:
+        typer.echo(
+            f"{available / 2**20:.0f} MiB available now, enough for about {available // peak} more drivers"
+        )
+
+
+@cli.command()
+def serve(
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    drivers: int = 1,
+    verbosity: int = 0,
+    headful: bool = False,
+    driver_type: str = "default",
+    timeout: Optional[float] = None,
+    proxy: Optional[str] = None,
+    block_resources: str = ",".join(DEFAULT_BLOCKED_RESOURCE_TYPES),
+    block_pattern: List[str] = typer.Option([]),
+    page_load_strategy: str = "normal",
+    launch_profile: str = "default",
+    thumbnail_format: str = "passthrough",
+    thumbnail_size: int = 160,
+    thumbnail_quality: int = 60,
+    thumbnail_workers: Optional[int] = None,
+    accounts: Optional[str] = None,
+    extraction: str = "dom",
+    archive: Optional[str] = None,
+    query_budget: Optional[float] = None,
+) -> None:
+    """
+    Keep warm drivers running and scrape queries sent over HTTP.
+
+    POST {"queries": ["..."]} to /queries to get the rows back as newline-delimited JSON while they are scraped.
+    GET /status for the queue depth, throughput and the health of every driver.
+
+    Args:
+        host: The address to listen on. Only this machine can reach the default.
+        port: The port to listen on.
+        drivers: How many drivers to keep running. Each one scrapes a query at a time.
+        verbosity: How verbose the program should be. 0 is default (errors), 1 is warnings, 2 is info, 3 is debug.
+        headful: Weather or not a Chrome window should be opened. This is only useful for debugging.
+        driver_type: The driver to use. Defaults to "default", which is the best match for your OS. Options include "chrome", "edge", "firefox", and "undetected".
+        timeout: The number of seconds to wait for the page to load before giving up.
+        proxy: A proxy to use. If left unspecified, the system proxy will be utilized. If set to "direct://" no proxy will be used.
+        block_resources: Comma-separated resource types that product pages may not load. Pass "" to load everything.
+        block_pattern: Extra URL patterns (with * wildcards) that product pages may not load. Can be repeated.
+        page_load_strategy: When navigation returns: "normal" (load event), "eager" (DOMContentLoaded) or "none".
+        launch_profile: "low-memory" launches Chromium without the subsystems a scrape doesn't need, so more drivers fit on a host. See the memory command.
+        thumbnail_format: Re-encode thumbnails as "webp" or "jpeg", or keep Amazon's original with "passthrough".
+        thumbnail_size: The largest width or height a re-encoded thumbnail may have, in pixels.
+        thumbnail_quality: The encoder quality (0-100) for re-encoded thumbnails.
+        thumbnail_workers: How many processes re-encode thumbnails. Defaults to one per CPU.
+        accounts: A SQLite database of accounts registered with the provision command. Drivers start signed in to one of them instead of signing up.
+        extraction: "dom" reads the AMZScout panel's table. "api" builds the rows from the responses it is filled from instead, keeps them in the "API Data" column, and finishes as soon as they arrive. Chromium only.
+        archive: A directory to save the raw pages in, so the reparse command can produce the rows again offline.
+        query_budget: The most seconds a query may take in all. Every wait, page load and download gets what is left of it, and a query that runs over is abandoned. Unlimited by default.
+    """
+    _configure_logging(verbosity)
+    mark_session()
+    driver_enum_value = _resolve_driver_type(driver_type, True)
+    snapshot_archive = SnapshotArchive(archive) if archive is not None else None
+    blocked_urls = _blocked_urls(block_resources, block_pattern)
+    if page_load_strategy not in PAGE_LOAD_STRATEGIES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(PAGE_LOAD_STRATEGIES)}", param_hint="--page-load-strategy"
+        )
+    if launch_profile not in LAUNCH_PROFILES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(LAUNCH_PROFILES)}", param_hint="--launch-profile"
+        )
+    if extraction not in EXTRACTION_MODES:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(EXTRACTION_MODES)}", param_hint="--extraction"
+        )
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise typer.BadParameter(
+            f"expected one of {', '.join(THUMBNAIL_FORMATS)}", param_hint="--thumbnail-format"
+        )
+    account_pool = AccountPool(accounts) if accounts is not None else None
+
+    with ThumbnailTranscoder(
+        thumbnail_format,
+        max_size=thumbnail_size,
+        quality=thumbnail_quality,
+        workers=thumbnail_workers,
+    ) as transcoder:
+        pool = DriverPool(
+            drivers,
+            new_driver=partial(
+                create_fresh_driver,
+                headless=not headful,
+                timeout=timeout,
+                driver_type=driver_enum_value,
+                proxy=proxy,
+                page_load_strategy=page_load_strategy,
+                launch_profile=launch_profile,
+                account_pool=account_pool,
+                capture_network=extraction == "api",
+            ),
+            scrape=partial(
+                _scrape_served_query,
+                transcoder=transcoder,
+                query_budget=query_budget,
+                scrape_options=dict(
+                    proxy=proxy,
+                    blocked_urls=blocked_urls,
+                    extraction=extraction,
+                    archive=snapshot_archive,
+                ),
+            ),
+            retire=partial(_retire_served_driver, account_pool=account_pool),
+            close_driver=partial(_quit_driver, account_pool=account_pool),
+        )
+        pool.start()
+        server = ScrapeServer(pool, host, port)
+        typer.echo(f"Serving on {server.url} with {drivers} drivers, press Ctrl+C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            typer.echo("Stopping...")
+            server.server_close()
+            pool.close()
+            if account_pool is not None:
+                account_pool.close()
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,211 @@
+"""
+Merging and deduplicating output files for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+import heapq
+import logging
+import tempfile
+from dataclasses import dataclass
+from itertools import groupby
+from pathlib import Path
+from typing import Iterable, Iterator, Sequence
+
+from .output import open_input, open_output
+from .store import product_key
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+# How many sorted runs are merged at once. Each is an open file, so this stays well under the usual limit of 1024
+DEFAULT_MAX_OPEN_RUNS = 64
+# What a row costs on top of its text, roughly: the list, the strings' headers and the sort key
+_ROW_OVERHEAD = 200
+_FIELD_OVERHEAD = 50
+
+# A sorted run holds the key and the row's age in front of the row itself
+_KEY_FIELDS = 3
+
+
+@dataclass
+class CompactReport:
+    rows_read: int = 0
+    rows_written: int = 0
+    runs: int = 0
+    merge_passes: int = 0
+    malformed_rows: int = 0  # rows without as many fields as the header, which are skipped
+
+    def __str__(self) -> str:
+        report = (
+            f"{self.rows_read} rows read, {self.rows_read - self.rows_written} duplicates dropped, "
+            f"{self.rows_written} rows written ({self.runs} sorted runs, {self.merge_passes} merge passes)"
+        )
+        if self.malformed_rows:
+            report += f", {self.malformed_rows} malformed rows skipped"
+        return report
+
+
+def _key_columns(header: Sequence[str]) -> tuple[int, int | None]:
+    try:
+        url_column = header.index("URL")
+    except ValueError:
+        raise ValueError("Can't compact a file without a URL column") from None
+    query_column = header.index("Query") if "Query" in header else None
+    return url_column, query_column
+
+
+def _sort_key(row: tuple[str, str, int, list[str]]) -> tuple[str, str, int]:
+    return row[:3]
+
+
+def _write_run(rows: Iterable[tuple[str, str, int, list[str]]], path: Path) -> Path:
+    with open(path, "w", newline="", encoding="utf-8") as fp:
+        csv_writer = csv.writer(fp)
+        for product, query, seq, row in rows:
+            csv_writer.writerow([product, query, seq, *row])
+    return path
+
+
+def _read_run(path: Path) -> Iterator[tuple[str, str, int, list[str]]]:
+    with open(path, newline="", encoding="utf-8") as fp:
+        for record in csv.reader(fp):
+            yield record[0], record[1], int(record[2]), record[_KEY_FIELDS:]
+
+
+def _merge_runs(runs: list[Path], directory: Path, max_open_runs: int) -> tuple[list[Path], int]:
+    """
+    Merge runs into fewer, larger ones until there are fewer than ``max_open_runs`` left.
+
+    Returns:
+        The remaining runs, and how many passes it took.
+    """
+    passes = 0
+    while len(runs) >= max_open_runs:
+        passes += 1
+        merged: list[Path] = []
+        for start in range(0, len(runs), max_open_runs):
+            group = runs[start : start + max_open_runs]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            path = directory / f"pass-{passes}-run-{len(merged)}.csv"
+            _write_run(heapq.merge(*map(_read_run, group), key=_sort_key), path)
+            for run in group:
+                run.unlink()
+            merged.append(path)
+        logger.debug(f"Merge pass #{passes} left {len(merged)} runs")
+        runs = merged
+    return runs, passes
+
+
+def compact(
+    sources: Sequence[str | Path],
+    destination: str | Path,
+    *,
+    memory_limit: int = DEFAULT_MEMORY_LIMIT,
+    max_open_runs: int = DEFAULT_MAX_OPEN_RUNS,
+    level: int | None = None,
+) -> CompactReport:
+    """
+    Merge output files into one, keeping only the newest row of every product.
+
+    Rows are keyed by the product's ASIN (or URL), plus its query if the files have a Query column. The files the
+    scraper writes have none, so a product that several queries found is kept once, with whichever row is newest.
+    Later files are taken to be newer than earlier ones, and later rows newer than earlier rows in the same file.
+    Rows without as many fields as the header, like the last line of a file that was cut off, are skipped and counted.
+
+    This is an external merge sort: rows are sorted in runs that fit in ``memory_limit`` and spilled to disk, then the
+    runs are merged at most ``max_open_runs`` at a time, so files much larger than memory can be compacted.
+
+    Args:
+        sources: The files to merge, oldest first. They may be compressed, but must all have the same columns.
+        destination: Where to write the result. It is sorted by key.
+        memory_limit: Roughly how many bytes of rows to hold in memory at once.
+        max_open_runs: How many sorted runs may be open at once. At least 2.
+        level: The level to compress at when the destination ends in .gz or .zst.
+
+    Raises:
+        ValueError: If the files have different columns, or no URL column
+    """
+    if max_open_runs < 2:
+        raise ValueError("Can't merge fewer than 2 runs at a time")
+    report = CompactReport()
+    header: list[str] | None = None
+    seq = 0
+
+    with tempfile.TemporaryDirectory(prefix="amzscout-compact-") as temp_dir:
+        runs: list[Path] = []
+        buffer: list[tuple[str, str, int, list[str]]] = []
+        buffered_bytes = 0
+
+        for source in sources:
+            with open_input(source) as fp:
+                reader = csv.reader(fp)
+                source_header = next(reader, None)
+                if source_header is None:
+                    continue
+                if header is None:
+                    header = source_header
+                    url_column, query_column = _key_columns(header)
+                    if query_column is None:
+                        logger.info("No Query column, products are deduplicated across queries")
+                elif source_header != header:
+                    raise ValueError(f"{source} doesn't have the same columns as {sources[0]}")
+
+                for row in reader:
+                    if row == header:
+                        continue  # a header left over from appending to a file by hand
+                    if len(row) != len(header):
+                        logger.debug(
+                            f"Skipping a row of {len(row)} fields in {source}: {row!r:.200}"
+                        )
+                        report.malformed_rows += 1
+                        continue
+                    query = row[query_column] if query_column is not None else ""
+                    buffer.append((product_key(row[url_column]), query, seq, row))
+                    seq += 1
+                    buffered_bytes += (
+                        sum(map(len, row)) + _FIELD_OVERHEAD * len(row) + _ROW_OVERHEAD
+                    )
+                    if buffered_bytes >= memory_limit:
+                        buffer.sort(key=_sort_key)
+                        runs.append(_write_run(buffer, Path(temp_dir) / f"run-{len(runs)}.csv"))
+                        logger.debug(f"Spilled run #{len(runs)} ({len(buffer)} rows)")
+                        buffer = []
+                        buffered_bytes = 0
+        report.rows_read = seq
+        if report.malformed_rows:
+            logger.warning(f"Skipped {report.malformed_rows} malformed rows")
+        report.runs = len(runs) + bool(buffer)
+
+        # the last run doesn't need to go to disk, but it does take up one of the merge's slots
+        runs, report.merge_passes = _merge_runs(runs, Path(temp_dir), max_open_runs)
+        merged = heapq.merge(*map(_read_run, runs), sorted(buffer, key=_sort_key), key=_sort_key)
+
+        with open_output(destination, level=level) as fp:
+            csv_writer = csv.writer(fp, dialect="excel")
+            if header is not None:
+                csv_writer.writerow(header)
+            for _, group in groupby(merged, key=lambda row: row[:2]):
+                *_, (_, _, _, newest) = group
+                csv_writer.writerow(newest)
+                report.rows_written += 1
+
+    return report
+
+
+__all__ = ("DEFAULT_MEMORY_LIMIT", "DEFAULT_MAX_OPEN_RUNS", "CompactReport", "compact")
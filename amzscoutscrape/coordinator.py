@@ -0,0 +1,308 @@
+"""
+Coordinator/worker queue for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+from typing import Iterable, Iterator, Sequence
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_LEASE_SECONDS = 30 * 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    query TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS queries_state ON queries (state, position);
+CREATE TABLE IF NOT EXISTS rows (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    query TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseQueue:
+    """
+    A query queue stored in SQLite that leases queries out to workers.
+
+    A lease that is not completed or renewed before it expires is put back into the queue,
+    so a worker that dies mid-query doesn't lose the query.
+
+    By default the database uses a write-ahead log, which needs shared memory, so every worker must be on the same
+    host. Workers on other hosts can share the queue over a network filesystem with ``shared``, which uses a rollback
+    journal instead. That still relies on the filesystem's file locking working, and every process using the database
+    has to pass it.
+
+    Args:
+        path: The database file.
+        lease_seconds: How long a query may be held without progress before it is re-issued.
+        max_attempts: How many times a query is leased before it is given up on.
+        shared: Whether the database is on a network filesystem that workers on other hosts reach it through.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        shared: bool = False,
+    ) -> None:
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        # WAL's index lives in shared memory, which processes on different hosts can't share
+        self._connection.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "LeaseQueue":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        else:
+            self._connection.execute("COMMIT")
+
+    def add(self, queries: Iterable[str]) -> int:
+        """
+        Add queries to the queue. Queries that are already known are ignored.
+
+        Returns:
+            The number of queries that were added.
+        """
+        added = 0
+        with self._transaction() as c:
+            (position,) = c.execute("SELECT COALESCE(MAX(position), -1) FROM queries").fetchone()
+            for query in queries:
+                position += 1
+                cursor = c.execute(
+                    "INSERT OR IGNORE INTO queries (query, position) VALUES (?, ?)",
+                    (query, position),
+                )
+                added += cursor.rowcount
+        return added
+
+    def _reissue_expired(self, c: sqlite3.Connection, now: float) -> int:
+        expired = c.execute(
+            "SELECT query, worker FROM queries WHERE state = 'leased' AND expires < ?", (now,)
+        ).fetchall()
+        for query, worker in expired:
+            logger.warning(f"Lease on {query!r} held by {worker} expired, re-issuing...")
+        c.execute(
+            "UPDATE queries SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, expires = NULL, error = COALESCE(error, 'lease expired') "
+            "WHERE state = 'leased' AND expires < ?",
+            (self.max_attempts, now),
+        )
+        return len(expired)
+
+    def reissue_expired(self) -> int:
+        """
+        Put every expired lease back into the queue.
+
+        Returns:
+            The number of leases that had expired.
+        """
+        with self._transaction() as c:
+            return self._reissue_expired(c, time())
+
+    def lease(self, worker: str) -> str | None:
+        """
+        Lease the next pending query to a worker.
+
+        Returns:
+            The query, or None if nothing is pending right now.
+        """
+        now = time()
+        with self._transaction() as c:
+            self._reissue_expired(c, now)
+            row = c.execute(
+                "SELECT query FROM queries WHERE state = 'pending' ORDER BY position LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            (query,) = row
+            c.execute(
+                "UPDATE queries SET state = 'leased', worker = ?, expires = ?, "
+                "attempts = attempts + 1 WHERE query = ?",
+                (worker, now + self.lease_seconds, query),
+            )
+            return query
+
+    def renew(self, query: str, worker: str) -> bool:
+        """
+        Extend a lease. Returns False if the worker no longer holds it.
+        """
+        with self._transaction() as c:
+            cursor = c.execute(
+                "UPDATE queries SET expires = ? WHERE query = ? AND worker = ? AND state = 'leased'",
+                (time() + self.lease_seconds, query, worker),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, query: str, worker: str, rows: Sequence[Sequence[str]]) -> bool:
+        """
+        Mark a leased query as done and store its rows in the same transaction.
+
+        If the lease was lost in the meantime (it expired and was re-issued), the rows are dropped
+        so that they aren't recorded twice.
+
+        Returns:
+            Whether the rows were accepted.
+        """
+        with self._transaction() as c:
+            cursor = c.execute(
+                "UPDATE queries SET state = 'done', expires = NULL, error = NULL "
+                "WHERE query = ? AND worker = ? AND state = 'leased'",
+                (query, worker),
+            )
+            if cursor.rowcount != 1:
+                logger.warning(f"Lease on {query!r} was lost by {worker}, dropping its rows.")
+                return False
+            c.executemany(
+                "INSERT INTO rows (query, data) VALUES (?, ?)",
+                ((query, json.dumps(list(row))) for row in rows),
+            )
+            return True
+
+    def fail(self, query: str, worker: str, error: str) -> None:
+        """
+        Give a leased query back after an error. It is retried until it runs out of attempts.
+        """
+        with self._transaction() as c:
+            c.execute(
+                "UPDATE queries SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, expires = NULL, error = ? "
+                "WHERE query = ? AND worker = ? AND state = 'leased'",
+                (self.max_attempts, error, query, worker),
+            )
+
+    def header(self) -> list[str] | None:
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'header'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_header(self, header: Sequence[str]) -> None:
+        with self._transaction() as c:
+            c.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('header', ?)",
+                (json.dumps(list(header)),),
+            )
+
+    def export_rows(self, limit: int = 1000) -> list[list[str]]:
+        """
+        Fetch the rows that haven't been exported yet and advance the export cursor.
+
+        The cursor lives in the database, so a restarted coordinator picks up where it left off.
+        """
+        with self._transaction() as c:
+            row = c.execute("SELECT value FROM meta WHERE key = 'exported'").fetchone()
+            cursor = int(row[0]) if row is not None else 0
+            rows = c.execute(
+                "SELECT id, data FROM rows WHERE id > ? ORDER BY id LIMIT ?", (cursor, limit)
+            ).fetchall()
+            if rows:
+                c.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('exported', ?)",
+                    (str(rows[-1][0]),),
+                )
+        return [json.loads(data) for _, data in rows]
+
+    def counts(self) -> dict[str, int]:
+        """
+        The number of queries in each state.
+        """
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        for state, count in self._connection.execute(
+            "SELECT state, COUNT(*) FROM queries GROUP BY state"
+        ):
+            counts[state] = count
+        return counts
+
+    def finished(self) -> bool:
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["leased"] == 0
+
+
+class LeaseWriter:
+    """
+    A stand-in for a CSV writer that collects the rows of one leased query.
+
+    Writing a row renews the lease once a third of it has been used up,
+    so long queries aren't re-issued while they are still making progress.
+    """
+
+    def __init__(
+        self, queue: LeaseQueue, query: str, worker: str, *, expect_header: bool = False
+    ) -> None:
+        self.queue = queue
+        self.query = query
+        self.worker = worker
+        self.rows: list[list[str]] = []
+        self.expect_header = expect_header
+        self._renewed = time()
+
+    def writerow(self, row: Sequence[str]) -> None:
+        if self.expect_header:
+            self.expect_header = False
+            self.queue.set_header(row)
+            return
+        self.rows.append(list(row))
+        if time() - self._renewed > self.queue.lease_seconds / 3:
+            self.queue.renew(self.query, self.worker)
+            self._renewed = time()
+
+    def commit(self) -> bool:
+        return self.queue.complete(self.query, self.worker, self.rows)
+
+
+__all__ = ("LeaseQueue", "LeaseWriter", "default_worker_id")
@@ -0,0 +1,381 @@
+"""
+A direct HTTP client for the AMZScout product database, for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from selenium.common import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.support import expected_conditions as ec
+from selenium.webdriver.support.wait import WebDriverWait
+
+from .devtools import find_records
+from .httpclient import client_for
+
+logger = logging.getLogger(__package__)
+
+AMZSCOUT_DB_SITE = "https://amzscout.net/app/#/database"
+AMZSCOUT_DOMAIN = "amzscout.net"
+DEFAULT_MAX_PAGES = 10
+API_TIMEOUT = 30.0
+# the names the web app could be giving its page number
+_PAGE_KEYS = ("page", "pagenumber", "page_number", "pageindex", "page_index")
+# headers that belong to the connection the browser made, not to the request
+_DROPPED_HEADERS = ("host", "content-length", "cookie", "connection", "accept-encoding")
+
+# Records every XHR and fetch the page makes from now on, with its headers, body and response, in
+# window.__amzscoutRequests.
+_RECORD_REQUESTS = """
+if (window.__amzscoutRequests === undefined) {
+    window.__amzscoutRequests = [];
+    const recorded = window.__amzscoutRequests;
+    const open = XMLHttpRequest.prototype.open;
+    const setRequestHeader = XMLHttpRequest.prototype.setRequestHeader;
+    const send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.open = function (method, url) {
+        this.__record = {method: method, url: new URL(url, location.href).href, headers: {}};
+        return open.apply(this, arguments);
+    };
+    XMLHttpRequest.prototype.setRequestHeader = function (name, value) {
+        if (this.__record) this.__record.headers[name] = value;
+        return setRequestHeader.apply(this, arguments);
+    };
+    XMLHttpRequest.prototype.send = function (body) {
+        const record = this.__record;
+        if (record) {
+            record.body = typeof body === "string" ? body : null;
+            this.addEventListener("load", () => {
+                record.status = this.status;
+                record.response = this.responseType === "" || this.responseType === "text"
+                    ? this.responseText : JSON.stringify(this.response);
+                recorded.push(record);
+            });
+        }
+        return send.apply(this, arguments);
+    };
+    const fetch = window.fetch;
+    window.fetch = async function (input, init) {
+        const request = new Request(input, init);
+        const body = init && typeof init.body === "string" ? init.body : null;
+        const response = await fetch.apply(this, arguments);
+        response.clone().text().then(text => recorded.push({
+            method: request.method,
+            url: request.url,
+            headers: Object.fromEntries(request.headers.entries()),
+            body: body,
+            status: response.status,
+            response: text,
+        }));
+        return response;
+    };
+}
+"""
+
+
+def _replace(value: Any, query: str, replacement: str, page: int | None) -> tuple[Any, bool]:
+    """
+    Put the query and page number into a decoded JSON body.
+
+    Returns:
+        The new value, and whether a page number was found in it.
+    """
+    if isinstance(value, dict):
+        paged = False
+        replaced = {}
+        for key, item in value.items():
+            if key.lower() in _PAGE_KEYS and isinstance(item, int) and not isinstance(item, bool):
+                replaced[key] = page if page is not None else item
+                paged = True
+            else:
+                replaced[key], item_paged = _replace(item, query, replacement, page)
+                paged = paged or item_paged
+        return replaced, paged
+    if isinstance(value, list):
+        items = [_replace(item, query, replacement, page) for item in value]
+        return [item for item, _ in items], any(paged for _, paged in items)
+    if isinstance(value, str) and value == query:
+        return replacement, False
+    return value, False
+
+
+def _replace_pairs(
+    pairs: list[tuple[str, str]], query: str, replacement: str, page: int | None
+) -> tuple[list[tuple[str, str]], bool]:
+    paged = False
+    replaced = []
+    for key, value in pairs:
+        if key.lower() in _PAGE_KEYS and value.isdigit():
+            replaced.append((key, str(page) if page is not None else value))
+            paged = True
+        else:
+            replaced.append((key, replacement if value == query else value))
+    return replaced, paged
+
+
+def _first_page(body: Any) -> int | None:
+    if isinstance(body, dict):
+        for key, item in body.items():
+            if key.lower() in _PAGE_KEYS and isinstance(item, int) and not isinstance(item, bool):
+                return item
+            if (page := _first_page(item)) is not None:
+                return page
+    elif isinstance(body, list):
+        for item in body:
+            if (page := _first_page(item)) is not None:
+                return page
+    return None
+
+
+@dataclass
+class SearchRequest:
+    """
+    The request the AMZScout web app makes to search its database, recorded once so it can be made again for any
+    query and page.
+
+    Args:
+        method: The HTTP method.
+        url: The URL, with the recorded query in it if it goes in the URL.
+        headers: The headers the app set, which is where its auth token is.
+        body: The body, with the recorded query in it if it goes in the body.
+        query: The query the request was recorded with.
+    """
+
+    method: str
+    url: str
+    headers: dict[str, str] = field(default_factory=dict)
+    body: str | None = None
+    query: str = ""
+
+    def _split(self) -> tuple[Any, list[tuple[str, str]], Any]:
+        url = urlsplit(self.url)
+        pairs = parse_qsl(url.query, keep_blank_values=True)
+        try:
+            body = json.loads(self.body) if self.body else None
+        except ValueError:
+            body = None
+        return url, pairs, body
+
+    @property
+    def first_page(self) -> int | None:
+        """
+        The number of the page the app asked for, or None if the search isn't paginated.
+        """
+        url, pairs, body = self._split()
+        for key, value in pairs:
+            if key.lower() in _PAGE_KEYS and value.isdigit():
+                return int(value)
+        if body is not None:
+            return _first_page(body)
+        if self.body:
+            for key, value in parse_qsl(self.body, keep_blank_values=True):
+                if key.lower() in _PAGE_KEYS and value.isdigit():
+                    return int(value)
+        return None
+
+    def for_query(self, query: str, page: int | None = None) -> tuple[str, str, str | None]:
+        """
+        The same request for another query, and for the given page if the search is paginated.
+
+        Returns:
+            The method, URL and body.
+        """
+        url, pairs, decoded = self._split()
+        pairs, _ = _replace_pairs(pairs, self.query, query, page)
+        new_url = urlunsplit(url._replace(query=urlencode(pairs)))
+        body = self.body
+        if decoded is not None:
+            replaced, _ = _replace(decoded, self.query, query, page)
+            body = json.dumps(replaced)
+        elif body:
+            form, _ = _replace_pairs(
+                parse_qsl(body, keep_blank_values=True), self.query, query, page
+            )
+            body = urlencode(form)
+        return self.method, new_url, body
+
+    @classmethod
+    def from_recorded(
+        cls, recorded: Iterable[dict[str, Any]], query: str
+    ) -> "SearchRequest | None":
+        """
+        Pick the search out of the requests the page made: the first one to the AMZScout API that carried the query
+        and came back with products.
+        """
+        for request in recorded:
+            if request.get("status") != 200 or AMZSCOUT_DOMAIN not in request.get("url", ""):
+                continue
+            try:
+                payload = json.loads(request.get("response") or "null")
+            except ValueError:
+                continue
+            if next(iter(find_records(payload)), None) is None:
+                continue
+            candidate = cls(
+                request.get("method", "GET").upper(),
+                request["url"],
+                {
+                    name: value
+                    for name, value in request.get("headers", {}).items()
+                    if name.lower() not in _DROPPED_HEADERS
+                },
+                request.get("body"),
+                query,
+            )
+            _, pairs, body = candidate._split()
+            in_url = any(value == query for _, value in pairs)
+            in_body = body is not None and _replace(body, query, "", None)[0] != body
+            in_form = bool(candidate.body) and any(
+                value == query for _, value in parse_qsl(candidate.body or "")
+            )
+            if in_url or in_body or in_form:
+                return candidate
+        return None
+
+
+def _submit_search(driver: WebDriver, wait: WebDriverWait, query: str) -> None:
+    # enter prompt
+    driver.find_element(By.ID, "keywords").find_element(By.TAG_NAME, "input").send_keys(query)
+
+    # click "FIND PRODUCTS"
+    wait.until(
+        ec.element_to_be_clickable((By.CSS_SELECTOR, "button.db-filters__controlls-find-btn"))
+    ).click()
+    if distraction := ec.element_to_be_clickable(
+        (By.CSS_SELECTOR, "app-filter-attention button.btn")
+    )(driver):
+        distraction.click()  # close the "attention" popup
+        wait.until(
+            ec.element_to_be_clickable((By.CSS_SELECTOR, "button.db-filters__controlls-find-btn"))
+        ).click()
+        # run it back
+
+
+def learn_search_request(driver: WebDriver, query: str) -> SearchRequest:
+    """
+    Search the database once in a signed-in browser, and record the request the web app made for it.
+
+    Raises:
+        TimeoutException: If the app didn't make a search request that came back with products
+    """
+    wait = WebDriverWait(driver, driver.timeouts.implicit_wait)
+    logger.info(f"Learning the database search request with {query!r}...")
+    driver.get(AMZSCOUT_DB_SITE)
+    driver.execute_script(_RECORD_REQUESTS)
+    _submit_search(driver, wait, query)
+    try:
+        return wait.until(
+            lambda d: SearchRequest.from_recorded(
+                d.execute_script("return window.__amzscoutRequests || [];"), query
+            )
+        )
+    except TimeoutException:
+        raise TimeoutException(
+            f"The database never made a search request with products for {query!r}"
+        ) from None
+
+
+def session_cookies(driver: WebDriver) -> dict[str, str]:
+    """
+    The AMZScout cookies of a signed-in browser.
+    """
+    return {
+        cookie["name"]: cookie["value"]
+        for cookie in driver.get_cookies()
+        if cookie.get("domain", "").lstrip(".").endswith(AMZSCOUT_DOMAIN)
+    }
+
+
+class DatabaseClient:
+    """
+    Searches the AMZScout database over plain HTTP, with the session of a browser that signed in once.
+
+    Args:
+        request: The search request the web app made, from ``learn_search_request``.
+        cookies: The session cookies, from ``session_cookies``.
+        proxy: Make the requests through this proxy, which should be the one the browser signed in through.
+        max_pages: Stop after this many pages of one query.
+    """
+
+    def __init__(
+        self,
+        request: SearchRequest,
+        cookies: dict[str, str],
+        *,
+        proxy: str | None = None,
+        max_pages: int = DEFAULT_MAX_PAGES,
+        timeout: float = API_TIMEOUT,
+    ) -> None:
+        self.request = request
+        self.cookies = cookies
+        self.proxy = proxy
+        self.max_pages = max_pages
+        self.timeout = timeout
+
+    def page(self, query: str, page: int | None = None) -> list[dict[str, Any]]:
+        """
+        Fetch one page of a query's products.
+
+        Raises:
+            requests.HTTPError: If the API refused, e.g. because the session ran out
+        """
+        method, url, body = self.request.for_query(query, page)
+        response = client_for(self.proxy).session.request(
+            method,
+            url,
+            headers=self.request.headers,
+            data=body.encode("utf-8") if body is not None else None,
+            cookies=self.cookies,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return list(find_records(response.json()))
+
+    def search(self, query: str) -> Iterator[dict[str, Any]]:
+        """
+        Every product the database has for a query, page after page, until a page brings nothing new.
+        """
+        first_page = self.request.first_page
+        seen: set[str] = set()
+        pages = self.max_pages if first_page is not None else 1
+        for number in range(pages):
+            page = first_page + number if first_page is not None else None
+            fresh = 0
+            for record in self.page(query, page):
+                asin = next(value for key, value in record.items() if key.lower() == "asin")
+                if not isinstance(asin, str) or not asin or asin.upper() in seen:
+                    continue
+                seen.add(asin.upper())
+                fresh += 1
+                yield record
+            logger.debug(f"Page {number + 1} of {query!r} had {fresh} new products")
+            if not fresh:
+                return
+
+
+__all__ = (
+    "AMZSCOUT_DB_SITE",
+    "DEFAULT_MAX_PAGES",
+    "SearchRequest",
+    "learn_search_request",
+    "session_cookies",
+    "DatabaseClient",
+)
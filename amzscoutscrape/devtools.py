@@ -0,0 +1,232 @@
+"""
+DevTools network capture for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import base64
+import fnmatch
+import json
+import logging
+from dataclasses import dataclass
+from time import monotonic, sleep
+from typing import Any, Callable, Iterable, Sequence
+
+from selenium.common import WebDriverException
+from selenium.webdriver.chromium.options import ChromiumOptions
+from selenium.webdriver.remote.webdriver import WebDriver
+
+logger = logging.getLogger(__package__)
+
+# The AMZScout panel gets its data from these, everything else it loads is static
+AMZSCOUT_API_PATTERNS = ("*amzscout.net/*",)
+
+Event = dict[str, Any]
+Listener = Callable[[Event], None]
+
+
+def enable_performance_log(options: ChromiumOptions) -> None:
+    """
+    Have ChromeDriver record DevTools network events, so that ``PerformanceLog`` can read them back.
+    """
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
+
+class PerformanceLog:
+    """
+    Reads DevTools events out of ChromeDriver's performance log and hands them to every listener.
+
+    ChromeDriver forgets an entry once it has been read, so everything that wants the events has to share one drain.
+    """
+
+    def __init__(self, driver: WebDriver) -> None:
+        self.driver = driver
+        self._listeners: list[Listener] = []
+
+    def subscribe(self, listener: Listener) -> None:
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Listener) -> None:
+        self._listeners.remove(listener)
+
+    def drain(self) -> int:
+        """
+        Read every event logged since the last drain.
+
+        Returns:
+            How many events were read.
+        """
+        entries = self.driver.get_log("performance")
+        for entry in entries:
+            payload = json.loads(entry["message"])
+            event = payload["message"]
+            if "webview" in payload:
+                event["webview"] = payload["webview"]  # the tab it came from
+            for listener in self._listeners:
+                listener(event)
+        return len(entries)
+
+
+@dataclass
+class CapturedResponse:
+    url: str
+    status: int
+    body: Any
+
+
+def _matches(url: str, patterns: Sequence[str]) -> bool:
+    return any(fnmatch.fnmatchcase(url, pattern) for pattern in patterns)
+
+
+class ResponseCapture:
+    """
+    Collects the JSON bodies of responses to URLs matching any of the patterns.
+
+    Bodies are fetched with Network.getResponseBody as soon as they finish loading, which only works while the tab
+    that made the request is the driver's current one.
+    """
+
+    def __init__(
+        self, log: PerformanceLog, url_patterns: Sequence[str] = AMZSCOUT_API_PATTERNS
+    ) -> None:
+        self.log = log
+        self.url_patterns = url_patterns
+        self.responses: list[CapturedResponse] = []
+        self._pending: dict[str, tuple[str, int]] = {}
+        self._last_arrival = monotonic()
+        log.subscribe(self._on_event)
+
+    def close(self) -> None:
+        self.log.unsubscribe(self._on_event)
+
+    def __enter__(self) -> "ResponseCapture":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def clear(self) -> None:
+        """
+        Forget everything captured so far, including anything still sitting in the log.
+        """
+        self.log.drain()
+        self.responses.clear()
+        self._pending.clear()
+        self._last_arrival = monotonic()
+
+    def _on_event(self, event: Event) -> None:
+        params = event.get("params", {})
+        match event.get("method"):
+            case "Network.responseReceived":
+                response = params["response"]
+                if "json" in response.get("mimeType", "") and _matches(
+                    response["url"], self.url_patterns
+                ):
+                    self._pending[params["requestId"]] = (response["url"], response["status"])
+            case "Network.loadingFinished":
+                if (request := self._pending.pop(params["requestId"], None)) is not None:
+                    self._read_body(params["requestId"], *request)
+            case "Network.loadingFailed":
+                self._pending.pop(params["requestId"], None)
+
+    def _read_body(self, request_id: str, url: str, status: int) -> None:
+        try:
+            result = self.log.driver.execute_cdp_cmd(
+                "Network.getResponseBody", {"requestId": request_id}
+            )
+        except WebDriverException as e:
+            # the body is gone if the tab navigated away or its buffer filled up
+            logger.debug(f"Could not read the response body of {url}: {e}")
+            return
+        body = result["body"]
+        if result.get("base64Encoded"):
+            body = base64.b64decode(body).decode("utf-8")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            logger.debug(f"{url} said it was JSON, but it wasn't")
+            return
+        self.responses.append(CapturedResponse(url, status, payload))
+        self._last_arrival = monotonic()
+
+    def wait_until_quiet(
+        self,
+        done: Callable[[list[CapturedResponse]], bool],
+        *,
+        quiet_seconds: float = 1.0,
+        timeout: float = 30.0,
+        poll_interval: float = 0.1,
+    ) -> bool:
+        """
+        Wait until ``done`` is happy with what has been captured and nothing new has arrived for a little while.
+
+        Returns:
+            False if the timeout ran out first.
+        """
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            self.log.drain()
+            if (
+                not self._pending
+                and done(self.responses)
+                and monotonic() - self._last_arrival >= quiet_seconds
+            ):
+                return True
+            sleep(poll_interval)
+        return False
+
+
+def find_records(payload: Any, key: str = "asin") -> Iterable[dict[str, Any]]:
+    """
+    Find the outermost objects in a JSON document that have the given key, no matter how deeply they are nested.
+
+    The key is matched case-insensitively, since the API isn't consistent about it. A record's own children aren't
+    searched, so the variations nested inside a product don't come back as products of their own.
+    """
+    if isinstance(payload, dict):
+        if any(k.lower() == key for k in payload):
+            yield payload
+            return
+        for value in payload.values():
+            yield from find_records(value, key)
+    elif isinstance(payload, list):
+        for value in payload:
+            yield from find_records(value, key)
+
+
+def products_by_asin(responses: Iterable[CapturedResponse]) -> dict[str, dict[str, Any]]:
+    """
+    Merge the product records from every response into one record per ASIN.
+
+    Different endpoints return different fields for the same product, so later responses add to earlier ones.
+    """
+    products: dict[str, dict[str, Any]] = {}
+    for response in responses:
+        for record in find_records(response.body):
+            asin = next(value for key, value in record.items() if key.lower() == "asin")
+            if isinstance(asin, str) and asin:
+                products.setdefault(asin.upper(), {}).update(record)
+    return products
+
+
+__all__ = (
+    "AMZSCOUT_API_PATTERNS",
+    "enable_performance_log",
+    "PerformanceLog",
+    "CapturedResponse",
+    "ResponseCapture",
+    "find_records",
+    "products_by_asin",
+)
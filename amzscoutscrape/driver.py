@@ -22,6 +22,7 @@ import tempfile
 import zipfile
 from enum import Enum, auto
 from pathlib import Path
+from threading import Event, Thread
 from typing import Any, Type, cast
 from urllib.parse import urlparse
 
@@ -41,14 +42,54 @@ from undetected_chromedriver import Chrome as uChromeDriver
 from undetected_chromedriver import ChromeOptions as uChromeOptions
 
 from . import AmzscoutscrapeAssets
+from .accounts import Account, AccountPool, bind_account
+from .devtools import enable_performance_log
 from .email import get_random_plausible_email
+from .processes import MemoryUsage, memory_of
 from .proxy import ip_of
+from .tracing import CommandTracer, phase
 from .utils import retry, reverse_map
 
 logger = logging.getLogger(__package__)
 EXTENSION = AmzscoutscrapeAssets.path("extensions", "extension_2_4_3_4.crx")
 EXTENSION_ID = "njopapoodmifmcogpingplfphojnfeea"
 EXPLICIT_IMPLICIT_WAIT = 30
+# "normal" waits for the load event, "eager" for DOMContentLoaded and "none" returns as soon as navigation starts.
+# Anything but "normal" relies on the explicit readiness checks in scrape.py.
+PAGE_LOAD_STRATEGIES = ("normal", "eager", "none")
+# Any page of the extension's origin can reach its storage
+EXTENSION_STORAGE_PAGE = f"chrome-extension://{EXTENSION_ID}/manifest.json"
+# The fields of Network.getAllCookies that Network.setCookies accepts back
+_COOKIE_PARAMS = ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires")
+# "default" launches Chromium as it comes, "low-memory" turns off everything a scrape doesn't need
+LAUNCH_PROFILES = ("default", "low-memory")
+LOW_MEMORY_ARGUMENTS = (
+    # nothing is ever looked at, so nothing needs a GPU process
+    "--disable-gpu",
+    "--disable-software-rasterizer",
+    # background services that keep their own connections and memory around
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-breakpad",
+    "--disable-client-side-phishing-detection",
+    "--disable-domain-reliability",
+    "--metrics-recording-only",
+    "--no-pings",
+    "--no-first-run",
+    "--mute-audio",
+    # let tabs share renderers instead of starting one per site; we only ever visit Amazon
+    "--renderer-process-limit=2",
+    "--disable-site-isolation-trials",
+    "--disable-features=IsolateOrigins,site-per-process,Translate,OptimizationHints,MediaRouter,"
+    "BackForwardCache,InterestFeedContentSuggestions,AutofillServerCommunication,"
+    "CertificateTransparencyComponentUpdater,CalculateNativeWinOcclusion",
+    # pages are read once, so a large cache is only ever written to
+    "--disk-cache-size=16777216",
+    "--media-cache-size=1048576",
+    "--js-flags=--max-old-space-size=512",
+)
 
 
 class Driver(Enum):
@@ -79,10 +120,22 @@ def _init_driver(
     timeout: float | None = 60.0,
     proxy: None | str = None,
     load_extension: bool = True,
+    page_load_strategy: str = "normal",
+    capture_network: bool = False,
+    launch_profile: str = "default",
 ) -> WebDriver:
     """
     Initialize a driver with the given options.
     """
+    if page_load_strategy not in PAGE_LOAD_STRATEGIES:
+        raise ValueError(
+            f"Invalid page load strategy {page_load_strategy!r}, "
+            f"expected one of {', '.join(PAGE_LOAD_STRATEGIES)}"
+        )
+    if launch_profile not in LAUNCH_PROFILES:
+        raise ValueError(
+            f"Invalid launch profile {launch_profile!r}, expected one of {', '.join(LAUNCH_PROFILES)}"
+        )
 
     # windows registry key: Software\Policies\Google\Chrome\BackgroundModeEnabled
     # WHY CAN THIS NOT BE DISABLED WITH A SWITCH
@@ -142,6 +195,12 @@ def _init_driver(
                 options_class = ChromiumOptions
 
         options: ChromiumOptions = options_class()
+        options.page_load_strategy = page_load_strategy
+        if capture_network:
+            enable_performance_log(options)
+        if launch_profile == "low-memory":
+            for argument in LOW_MEMORY_ARGUMENTS:
+                options.add_argument(argument)
 
         # need to unpack the extension
         if load_extension:
@@ -188,6 +247,7 @@ def _init_driver(
     else:
         options: FirefoxOptions = FirefoxOptions()
         options.headless = headless
+        options.page_load_strategy = page_load_strategy
 
         # Copilot wrote all of this: I have NO idea if it works
         if proxy is not None:
@@ -200,6 +260,12 @@ def _init_driver(
 
         if load_extension:
             raise NotImplementedError("Firefox extension loading not supported yet.")
+        if capture_network:
+            raise NotImplementedError(
+                "Firefox doesn't speak DevTools, so it can't capture the network."
+            )
+        if launch_profile != "default":
+            logger.warning(f"The {launch_profile} launch profile is Chromium only. Ignoring.")
 
         driver: WebDriver = FirefoxDriver(options=options)
 
@@ -218,6 +284,167 @@ def _init_driver(
     return driver
 
 
+def _settle_extension_tabs(driver: WebDriver, wait: WebDriverWait) -> str:
+    """
+    Wait for the tab the AMZScout extension opens on first load and switch to it.
+
+    Returns:
+        The handle of the browser's start tab.
+    """
+    # When AMZScout PRO extension first loads in, it does this weird thing where it opens a new tab and then closes it.
+    wait.until(lambda d: len(d.window_handles) == 2)
+    web_map = identify_websites(driver)
+
+    amazon_tab = reverse_map(web_map, "www.amazon.com")
+    chrome_start_tab = reverse_map(web_map, "welcome")
+    del web_map
+
+    driver.switch_to.window(amazon_tab)
+    return chrome_start_tab
+
+
+def _sign_up(
+    driver: WebDriver, wait: WebDriverWait, proxy: str | None, load_extension: bool
+) -> str:
+    """
+    Register a new AMZScout account in the current tab.
+
+    Returns:
+        The email the account was registered with.
+    """
+    # This will be the email we use to sign up for our account
+    email = get_random_plausible_email(driver)
+
+    if load_extension:
+        # We will use the extension to bring us to the "sign up for an account" page
+        driver.find_element(By.CLASS_NAME, "login-btn").click()
+    else:
+        driver.get("https://amzscout.net/app/#/auth/login")
+
+        # now we get the iframe
+        # for some reason no matter what I do Selenium will never focus on this iframe
+        # so we brute force!
+        wait.until(ec.presence_of_element_located((By.TAG_NAME, "iframe")))
+        iframe = driver.find_element(By.TAG_NAME, "iframe")
+        iframe_url = iframe.get_attribute("src")
+        del iframe  # this reference is about to be stale, so delete it now so we cant shoot ourselves in the foot
+        driver.get(iframe_url)
+
+    # Type in email
+    driver.find_element(By.TAG_NAME, "input").send_keys(email)
+    # Sign up dialog
+    wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "PgAuth-Sign-form__btn")))
+    driver.find_element(By.CLASS_NAME, "PgAuth-Sign-form__btn").click()
+
+    # check for "The email address is already registered."
+    if ec.visibility_of_any_elements_located((By.CLASS_NAME, "PgAuth-Error"))(driver):
+        ip = "<unknown>"
+        try:
+            ip = ip_of(proxy)
+        except Exception:
+            pass
+
+        raise RuntimeError(f"Email {email} and/or IP {ip} could blocked.")
+        # retry in case of a IP ban which also manifests as this
+
+    # Wait for the destination page to load, which is different depending on whether we're using the extension
+    if load_extension:
+        wait.until(ec.url_contains("amazon.com"))
+        # back @ amazon, skip the tutorial
+        driver.find_element(By.CLASS_NAME, "seller-tips__modal-skip-btn").click()
+    else:
+        # redirects in 3 seconds
+        # wait.until(ec.url_matches("https://amzscout.net/app/#/database"))
+        # doesn't work, lets do it ourselves
+        wait.until(ec.visibility_of_all_elements_located((By.CLASS_NAME, "PgAuth-Progress__title")))
+        countdown = driver.find_elements(By.CLASS_NAME, "PgAuth-Progress__title")[1]
+        wait.until(lambda _: "0" in countdown.text)
+        # skip the tutorial
+        driver.get("https://amzscout.net/app/#/database")
+        # "Welcome to AMZScout!"
+        wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "custom-tour-class__btn")))
+        driver.find_element(By.CLASS_NAME, "custom-tour-class__btn").click()
+        # "Welcome to AMZScout!"
+        wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "custom-tour-class__btn")))
+        driver.find_element(By.CLASS_NAME, "custom-tour-class__btn").click()
+        # "TRY PRO EXTENSION FOR FREE"
+        wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "pro-ad__close")))
+        driver.find_element(By.CLASS_NAME, "pro-ad__close").click()
+        # "GET UP TO 10 READY-TO-GO PRODUCTS" (banner ad)
+        wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "banner__close")))
+        driver.find_element(By.CLASS_NAME, "banner__close").click()
+
+    return email
+
+
+def capture_session(driver: WebDriver) -> tuple[list[dict[str, Any]], dict[str, Any]]:
+    """
+    Copy everything that keeps the browser signed in to AMZScout: all cookies and the extension's storage.
+
+    Returns:
+        The cookies and the extension storage.
+    """
+    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    current_window = driver.current_window_handle
+    driver.switch_to.new_window("tab")
+    try:
+        driver.get(EXTENSION_STORAGE_PAGE)
+        storage = {
+            "chrome": driver.execute_async_script(
+                "const done = arguments[arguments.length - 1];"
+                "chrome.storage.local.get(null, items => done(items));"
+            ),
+            "local": driver.execute_script("return Object.assign({}, window.localStorage);"),
+        }
+    finally:
+        driver.close()
+        driver.switch_to.window(current_window)
+    return cookies, storage
+
+
+class SessionRejected(Exception):
+    """
+    Raised when the browser won't take an account's session back, e.g. because its cookies have expired.
+    """
+
+
+def restore_session(driver: WebDriver, account: Account) -> None:
+    """
+    Sign the browser in by loading an account's cookies and extension storage back in.
+
+    Raises:
+        SessionRejected: If the browser dropped every one of the account's cookies, which it does with expired ones.
+    """
+    cookies = [
+        {key: value for key, value in cookie.items() if key in _COOKIE_PARAMS}
+        for cookie in account.cookies
+    ]
+    driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+    kept = {
+        (cookie["name"], cookie["domain"])
+        for cookie in driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    }
+    if cookies and not any((cookie["name"], cookie.get("domain")) in kept for cookie in cookies):
+        raise SessionRejected(f"the browser dropped every cookie of {account.email}")
+    current_window = driver.current_window_handle
+    driver.switch_to.new_window("tab")
+    try:
+        driver.get(EXTENSION_STORAGE_PAGE)
+        driver.execute_async_script(
+            "const done = arguments[arguments.length - 1];"
+            "chrome.storage.local.set(arguments[0], () => done());",
+            account.storage.get("chrome", {}),
+        )
+        driver.execute_script(
+            "for (const [key, value] of Object.entries(arguments[0])) localStorage.setItem(key, value);",
+            account.storage.get("local", {}),
+        )
+    finally:
+        driver.close()
+        driver.switch_to.window(current_window)
+    logger.info(f"Restored the session of {account.email} ({account.uses_remaining} uses left).")
+
+
 @retry(tries=3, backoff_seconds=2)
 def create_fresh_driver(
     headless: bool = True,
@@ -225,99 +452,66 @@ def create_fresh_driver(
     timeout: float | None = 60.0,
     proxy: None | str = None,
     load_extension: bool = True,
+    page_load_strategy: str = "normal",
+    account_pool: AccountPool | None = None,
+    capture_network: bool = False,
+    command_tracer: CommandTracer | None = None,
+    launch_profile: str = "default",
 ) -> WebDriver:
     """
     Create a fresh driver with the given options.
+
+    ``capture_network`` records DevTools network events for ``devtools.PerformanceLog``.
+    ``command_tracer`` is attached before the driver is set up, so it sees the setup's commands too.
+    ``launch_profile`` picks the Chromium flags, see ``LAUNCH_PROFILES``.
+    If an account pool is given and has an account ready, the driver is signed in with it instead of registering a
+    new account. Use ``account_of`` to find out which account a driver got.
     """
 
-    driver = _init_driver(headless, driver_type, timeout, proxy, load_extension)
+    driver = _init_driver(
+        headless,
+        driver_type,
+        timeout,
+        proxy,
+        load_extension,
+        page_load_strategy,
+        capture_network,
+        launch_profile,
+    )
+    if command_tracer is not None:
+        command_tracer.attach(driver)
     timeout = timeout or EXPLICIT_IMPLICIT_WAIT
     wait = WebDriverWait(driver, timeout)
 
     try:
-        # When AMZScout PRO extension first loads in, it does this weird thing where it opens a new tab and then closes it.
-        if load_extension:
-            wait.until(lambda d: len(d.window_handles) == 2)
-            web_map = identify_websites(driver)
-
-            amazon_tab = reverse_map(web_map, "www.amazon.com")
-            chrome_start_tab = reverse_map(web_map, "welcome")
-            del web_map
-
-            driver.switch_to.window(amazon_tab)
-            del amazon_tab  # irrelevant
-        else:
-            chrome_start_tab = driver.current_window_handle
-            driver.switch_to.new_window("tab")
-
-        # This will be the email we use to sign up for our account
-        email = get_random_plausible_email(driver)
-
-        if load_extension:
-            # We will use the extension to bring us to the "sign up for an account" page
-            driver.find_element(By.CLASS_NAME, "login-btn").click()
-        else:
-            driver.get("https://amzscout.net/app/#/auth/login")
-
-            # now we get the iframe
-            # for some reason no matter what I do Selenium will never focus on this iframe
-            # so we brute force!
-            wait.until(ec.presence_of_element_located((By.TAG_NAME, "iframe")))
-            iframe = driver.find_element(By.TAG_NAME, "iframe")
-            iframe_url = iframe.get_attribute("src")
-            del iframe  # this reference is about to be stale, so delete it now so we cant shoot ourselves in the foot
-            driver.get(iframe_url)
-
-        # Type in email
-        driver.find_element(By.TAG_NAME, "input").send_keys(email)
-        # Sign up dialog
-        wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "PgAuth-Sign-form__btn")))
-        driver.find_element(By.CLASS_NAME, "PgAuth-Sign-form__btn").click()
-
-        # check for "The email address is already registered."
-        if ec.visibility_of_any_elements_located((By.CLASS_NAME, "PgAuth-Error"))(driver):
-            ip = "<unknown>"
-            try:
-                ip = ip_of(proxy)
-            except Exception:
-                pass
-
-            raise RuntimeError(f"Email {email} and/or IP {ip} could blocked.")
-            # retry in case of a IP ban which also manifests as this
-
-        # Wait for the destination page to load, which is different depending on whether we're using the extension
-        if load_extension:
-            wait.until(ec.url_contains("amazon.com"))
-            # back @ amazon, skip the tutorial
-            driver.find_element(By.CLASS_NAME, "seller-tips__modal-skip-btn").click()
-        else:
-            # redirects in 3 seconds
-            # wait.until(ec.url_matches("https://amzscout.net/app/#/database"))
-            # doesn't work, lets do it ourselves
-            wait.until(
-                ec.visibility_of_all_elements_located((By.CLASS_NAME, "PgAuth-Progress__title"))
+        with phase("setup"):
+            if load_extension:
+                chrome_start_tab = _settle_extension_tabs(driver, wait)
+            else:
+                chrome_start_tab = driver.current_window_handle
+                driver.switch_to.new_window("tab")
+
+            account = (
+                account_pool.checkout() if load_extension and account_pool is not None else None
             )
-            countdown = driver.find_elements(By.CLASS_NAME, "PgAuth-Progress__title")[1]
-            wait.until(lambda _: "0" in countdown.text)
-            # skip the tutorial
-            driver.get("https://amzscout.net/app/#/database")
-            # "Welcome to AMZScout!"
-            wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "custom-tour-class__btn")))
-            driver.find_element(By.CLASS_NAME, "custom-tour-class__btn").click()
-            # "Welcome to AMZScout!"
-            wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "custom-tour-class__btn")))
-            driver.find_element(By.CLASS_NAME, "custom-tour-class__btn").click()
-            # "TRY PRO EXTENSION FOR FREE"
-            wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "pro-ad__close")))
-            driver.find_element(By.CLASS_NAME, "pro-ad__close").click()
-            # "GET UP TO 10 READY-TO-GO PRODUCTS" (banner ad)
-            wait.until(ec.element_to_be_clickable((By.CLASS_NAME, "banner__close")))
-            driver.find_element(By.CLASS_NAME, "banner__close").click()
-
-        # Clean it up
-        driver.close()
-        driver.switch_to.window(chrome_start_tab)
-        del chrome_start_tab  # irrelevant
+            if account is not None:
+                try:
+                    restore_session(driver, account)
+                except SessionRejected as e:
+                    account_pool.retire(account.id, f"its session was rejected: {e}")
+                    raise
+                except Exception as e:
+                    # most likely the browser's fault, the account gets another go once it has sat out
+                    account_pool.record_failure(account.id, f"could not restore its session: {e}")
+                    raise
+                bind_account(driver, account)
+            else:
+                _sign_up(driver, wait, proxy, load_extension)
+
+            # Clean it up
+            driver.close()
+            driver.switch_to.window(chrome_start_tab)
+            del chrome_start_tab  # irrelevant
     except Exception:
         driver.quit()
         raise
@@ -329,4 +523,89 @@ def create_fresh_driver(
         return driver
 
 
-__all__ = ("create_fresh_driver",)
+@retry(tries=3, backoff_seconds=2)
+def register_account(
+    account_pool: AccountPool,
+    headless: bool = True,
+    driver_type: Driver = Driver.U_CHROME,
+    timeout: float | None = 60.0,
+    proxy: None | str = None,
+    launch_profile: str = "default",
+) -> None:
+    """
+    Register a new AMZScout account with the extension and put its session in the pool.
+    """
+    driver = _init_driver(
+        headless, driver_type, timeout, proxy, True, launch_profile=launch_profile
+    )
+    wait = WebDriverWait(driver, timeout or EXPLICIT_IMPLICIT_WAIT)
+    try:
+        _settle_extension_tabs(driver, wait)
+        email = _sign_up(driver, wait, proxy, True)
+        cookies, storage = capture_session(driver)
+    finally:
+        driver.quit()
+    account_pool.add(email, cookies, storage)
+
+
+def driver_memory(driver: WebDriver) -> MemoryUsage:
+    """
+    Measure the memory of a driver's whole process tree: the driver service, the browser and all of its helpers.
+    """
+    roots = []
+    service = getattr(driver, "service", None)
+    if service is not None and service.process is not None:
+        roots.append(service.process.pid)
+    # undetected-chromedriver detaches its browser from the service, so it has to be counted on its own
+    if (browser_pid := getattr(driver, "browser_pid", None)) is not None:
+        roots.append(browser_pid)
+    return memory_of(roots)
+
+
+class AccountProvisioner(Thread):
+    """
+    Registers accounts in the background whenever the pool has fewer than ``target`` ready to go,
+    so that drivers never have to sign up inline.
+    """
+
+    def __init__(
+        self,
+        account_pool: AccountPool,
+        target: int,
+        *,
+        poll_interval: float = 10.0,
+        **driver_kwargs: Any,
+    ) -> None:
+        super().__init__(name="AccountProvisioner", daemon=True)
+        self.account_pool = account_pool
+        self.target = target
+        self.poll_interval = poll_interval
+        self.driver_kwargs = driver_kwargs
+        self._stop_event = Event()
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            if self.account_pool.ready_count() >= self.target:
+                self._stop_event.wait(self.poll_interval)
+                continue
+            try:
+                register_account(self.account_pool, **self.driver_kwargs)
+            except Exception as e:
+                logger.exception(f"Could not provision an account: {e}")
+                self._stop_event.wait(self.poll_interval)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+__all__ = (
+    "LAUNCH_PROFILES",
+    "create_fresh_driver",
+    "driver_memory",
+    "register_account",
+    "capture_session",
+    "restore_session",
+    "SessionRejected",
+    "AccountProvisioner",
+    "PAGE_LOAD_STRATEGIES",
+)
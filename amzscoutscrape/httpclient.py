@@ -0,0 +1,280 @@
+"""
+Long-lived, pooled HTTP clients for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import ipaddress
+import logging
+import socket
+from dataclasses import dataclass
+from threading import Lock
+from time import monotonic
+from typing import Any
+
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 16
+DEFAULT_DNS_TTL = 300.0
+
+
+@dataclass
+class ConnectionStats:
+    """
+    How much a client's connections got reused.
+    """
+
+    requests: int = 0
+    connections: int = 0
+    dns_lookups: int = 0
+    dns_hits: int = 0
+
+    @property
+    def reused(self) -> int:
+        return max(self.requests - self.connections, 0)
+
+    def __str__(self) -> str:
+        reuse = f" ({self.reused / self.requests * 100:.0f}% reused)" if self.requests else ""
+        return (
+            f"{self.requests} requests over {self.connections} connections{reuse},"
+            f" {self.dns_lookups} DNS lookups, {self.dns_hits} answered from cache"
+        )
+
+
+class DNSCache:
+    """
+    Remembers what hostnames resolved to, so a new connection to a known host doesn't wait on a lookup.
+
+    Every address a host resolves to is kept, in the order the resolver gave them, so a connection can fall back to the
+    next one like urllib3 would. The address that last worked is tried first. A host that none of its addresses could
+    be connected to is forgotten, in case it moved.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_DNS_TTL) -> None:
+        self.ttl = ttl
+        self._entries: dict[tuple[str, int], tuple[list[str], float]] = {}
+        self._lock = Lock()
+
+    def resolve(self, host: str, port: int, stats: ConnectionStats | None = None) -> list[str]:
+        """
+        The addresses to try for a host, best first. Only the address families urllib3 would use are looked up.
+        """
+        try:
+            ipaddress.ip_address(host)
+            return [host]  # nothing to look up
+        except ValueError:
+            pass
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is not None and entry[1] > now:
+                if stats is not None:
+                    stats.dns_hits += 1
+                return list(entry[0])
+        results = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(str(result[4][0]) for result in results))
+        with self._lock:
+            self._entries[(host, port)] = (addresses, now + self.ttl)
+            if stats is not None:
+                stats.dns_lookups += 1
+        return list(addresses)
+
+    def prefer(self, host: str, port: int, address: str) -> None:
+        """
+        Try an address of a host first from now on, since it is the one that worked.
+        """
+        with self._lock:
+            entry = self._entries.get((host, port))
+            if entry is not None and address in entry[0] and entry[0][0] != address:
+                addresses = [address, *(other for other in entry[0] if other != address)]
+                self._entries[(host, port)] = (addresses, entry[1])
+
+    def forget(self, host: str, port: int) -> None:
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class _TrackedConnection:
+    # set on the subclasses each client makes
+    client: "HttpClient"
+
+    def _new_conn(self) -> socket.socket:
+        client = self.client
+        host = self._dns_host  # type: ignore[has-type]
+        port = self.port  # type: ignore[attr-defined]
+        addresses = client.dns_cache.resolve(host, port, client.stats)
+        error: Exception = NewConnectionError(self, f"{host} resolved to no addresses")
+        # connect to the cached addresses in turn, but keep the hostname for SNI, certificates and the Host header
+        for address in addresses:
+            self._dns_host = address
+            try:
+                sock = super()._new_conn()  # type: ignore[misc]
+            except (NewConnectionError, ConnectTimeoutError) as e:
+                logger.debug(f"Could not connect to {host} at {address}: {e}")
+                error = e
+                continue
+            finally:
+                self._dns_host = host
+            if address != addresses[0]:
+                client.dns_cache.prefer(host, port, address)
+            with client._lock:
+                client.stats.connections += 1
+            return sock
+        client.dns_cache.forget(host, port)
+        raise error
+
+
+class _TrackingAdapter(HTTPAdapter):
+    def __init__(self, client: "HttpClient", **kwargs: Any) -> None:
+        connection = type("Connection", (_TrackedConnection, HTTPConnection), {"client": client})
+        secure = type("SecureConnection", (_TrackedConnection, HTTPSConnection), {"client": client})
+        self._pool_classes = {
+            "http": type("ConnectionPool", (HTTPConnectionPool,), {"ConnectionCls": connection}),
+            "https": type(
+                "SecureConnectionPool", (HTTPSConnectionPool,), {"ConnectionCls": secure}
+            ),
+        }
+        self.client = client
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self._pool_classes
+
+    def proxy_manager_for(self, proxy: str, **proxy_kwargs: Any) -> Any:
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS proxies open their own kind of connection, which we leave alone
+        if not proxy.lower().startswith("socks"):
+            manager.pool_classes_by_scheme = self._pool_classes
+        return manager
+
+    def send(self, *args: Any, **kwargs: Any) -> Response:
+        with self.client._lock:
+            self.client.stats.requests += 1
+        return super().send(*args, **kwargs)
+
+
+class HttpClient:
+    """
+    A ``requests`` session that is meant to live as long as the process, and be shared between threads.
+
+    Connections are kept alive and pooled per host, so thumbnails and proxy checks don't pay for a TCP and TLS
+    handshake every time, and hostnames are resolved through a ``DNSCache``. ``stats`` counts how often that paid off.
+
+    Args:
+        proxy: Send everything through this proxy. "direct://" ignores the system proxy.
+        pool_connections: How many hosts to keep connections to.
+        pool_maxsize: How many connections to keep to each host. Match it to the number of threads sharing the client.
+        dns_cache: Shares resolved addresses between clients.
+    """
+
+    def __init__(
+        self,
+        proxy: str | None = None,
+        *,
+        pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+        dns_cache: DNSCache | None = None,
+    ) -> None:
+        # imported here since proxy.py uses clients for its own checks
+        from .proxy import setup_proxy_for_requests
+
+        self.proxy = proxy
+        self.dns_cache = dns_cache if dns_cache is not None else DNSCache()
+        self.stats = ConnectionStats()
+        self._lock = Lock()
+        self.session = Session()
+        adapter = _TrackingAdapter(
+            self, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        setup_proxy_for_requests(self.session, proxy)
+
+    def get(self, url: str, **kwargs: Any) -> Response:
+        return self.session.get(url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "HttpClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+_clients: dict[str | None, HttpClient] = {}
+_clients_lock = Lock()
+_dns_cache = DNSCache()
+_pool_sizes = {"pool_connections": DEFAULT_POOL_CONNECTIONS, "pool_maxsize": DEFAULT_POOL_MAXSIZE}
+
+
+def configure_clients(
+    *,
+    pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    dns_ttl: float = DEFAULT_DNS_TTL,
+) -> None:
+    """
+    Set the pool sizes and DNS TTL of the clients ``client_for`` makes from now on.
+    """
+    _pool_sizes.update(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    _dns_cache.ttl = dns_ttl
+
+
+def client_for(proxy: str | None = None) -> HttpClient:
+    """
+    The shared client for a proxy, made the first time it is asked for. Every client shares one DNS cache.
+    """
+    with _clients_lock:
+        client = _clients.get(proxy)
+        if client is None:
+            client = _clients[proxy] = HttpClient(proxy, dns_cache=_dns_cache, **_pool_sizes)
+        return client
+
+
+def client_stats() -> dict[str | None, ConnectionStats]:
+    with _clients_lock:
+        return {proxy: client.stats for proxy, client in _clients.items()}
+
+
+def close_clients() -> None:
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+__all__ = (
+    "DEFAULT_POOL_CONNECTIONS",
+    "DEFAULT_POOL_MAXSIZE",
+    "DEFAULT_DNS_TTL",
+    "ConnectionStats",
+    "DNSCache",
+    "HttpClient",
+    "configure_clients",
+    "client_for",
+    "client_stats",
+    "close_clients",
+)
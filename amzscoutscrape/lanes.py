@@ -0,0 +1,132 @@
+"""
+Many scraping lanes in one browser for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+from dataclasses import dataclass
+from threading import Lock
+
+from selenium.webdriver.chrome.options import Options as ChromeOptions
+from selenium.webdriver.chrome.service import Service as ChromeService
+from selenium.webdriver.chrome.webdriver import WebDriver as ChromeDriver
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from .devtools import enable_performance_log
+
+logger = logging.getLogger(__package__)
+
+
+@dataclass
+class Lane:
+    """
+    One tab of a shared browser, with a WebDriver session of its own.
+
+    Lanes run at the same time: every lane has its own chromedriver, so commands to one never wait on another.
+    """
+
+    driver: WebDriver
+    target_id: str
+
+
+class BrowserHost:
+    """
+    One Chromium hosting many lanes, each a tab of its own.
+
+    Tabs share the browser's processes, so a lane costs a tab instead of a whole browser and opens in milliseconds.
+    Lanes attach to the browser through its DevTools address, the same way undetected-chromedriver does.
+
+    Every lane is a tab in the browser's default context. Separate browser contexts are off the record, and unpacked
+    extensions don't run there, so the AMZScout panel would never show up. As a result, all lanes share the browser's
+    cookies and scrape under the one AMZScout session the host driver signed in with.
+
+    Args:
+        driver: A Chromium driver, as made by ``create_fresh_driver``. It keeps the browser alive and isn't scraped with.
+        capture_network: Record DevTools network events on every lane, for ``devtools.PerformanceLog``.
+    """
+
+    def __init__(self, driver: WebDriver, *, capture_network: bool = False) -> None:
+        try:
+            self.address: str = driver.capabilities["goog:chromeOptions"]["debuggerAddress"]
+        except KeyError:
+            raise NotImplementedError("Only Chromium browsers can host lanes") from None
+        self.driver = driver
+        self.capture_network = capture_network
+        self.lanes: list[Lane] = []
+        self._lock = Lock()  # the host driver can only do one thing at a time
+        # attach with the same chromedriver the host uses, so pages look the same to bot screening
+        patcher = getattr(driver, "patcher", None)
+        self._executable_path: str | None = getattr(patcher, "executable_path", None)
+
+    def _attach(self, target_id: str) -> WebDriver:
+        options = ChromeOptions()
+        options.debugger_address = self.address
+        if self.capture_network:
+            enable_performance_log(options)
+        service = (
+            ChromeService(executable_path=self._executable_path)
+            if self._executable_path is not None
+            else ChromeService()
+        )
+        driver = ChromeDriver(options=options, service=service)
+        # chromedriver names windows after their DevTools targets
+        driver.switch_to.window(target_id)
+        driver.timeouts = self.driver.timeouts
+        return driver
+
+    def open_lane(self) -> Lane:
+        """
+        Open a new lane in a tab of its own.
+        """
+        with self._lock:
+            target_id = self.driver.execute_cdp_cmd("Target.createTarget", {"url": "about:blank"})[
+                "targetId"
+            ]
+        try:
+            driver = self._attach(target_id)
+        except BaseException:
+            with self._lock:
+                self.driver.execute_cdp_cmd("Target.closeTarget", {"targetId": target_id})
+            raise
+        lane = Lane(driver, target_id)
+        self.lanes.append(lane)
+        logger.debug(f"Opened lane {target_id}")
+        return lane
+
+    def close_lane(self, lane: Lane) -> None:
+        # an attached session leaves the browser running when it quits, so the tab is closed separately
+        try:
+            lane.driver.quit()
+        finally:
+            self.lanes.remove(lane)
+            with self._lock:
+                self.driver.execute_cdp_cmd("Target.closeTarget", {"targetId": lane.target_id})
+
+    def close(self) -> None:
+        for lane in list(self.lanes):
+            try:
+                self.close_lane(lane)
+            except Exception as e:
+                logger.debug(f"Could not close lane {lane.target_id}: {e}")
+
+    def __enter__(self) -> "BrowserHost":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+__all__ = ("Lane", "BrowserHost")
@@ -0,0 +1,251 @@
+"""
+Output files for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+import gzip
+import io
+import logging
+import os
+import sys
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Callable, TextIO
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+logger = logging.getLogger(__package__)
+
+# Compression is picked from the last suffix of the filename, like amzscout.csv.zst
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3}
+
+# Inline thumbnails make for fields much larger than the csv module allows by default
+csv.field_size_limit(sys.maxsize)
+
+
+def compression_of(path: str | Path) -> str | None:
+    return COMPRESSIONS.get(Path(path).suffix.lower())
+
+
+def _require_zstandard() -> None:
+    if zstandard is None:
+        raise ImportError(
+            "Reading and writing .zst files requires zstandard. Install amzscoutscrape[zstd]."
+        )
+
+
+def _mark_path(path: str | Path) -> Path:
+    return Path(f"{path}.flushed")
+
+
+def _read_mark(path: str | Path) -> int | None:
+    try:
+        return int(_mark_path(path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+class _FramedWriter(io.RawIOBase):
+    """
+    Compresses into a new gzip member or zstd frame after every flush.
+
+    A member is only readable once it has been finished, so finishing one on every flush means everything flushed can
+    be read back even if the process is killed before the file is closed. Where the last finished member ends is kept
+    next to the file, so appending to it later doesn't have to decompress all of it to find out.
+    """
+
+    def __init__(
+        self, raw: BinaryIO, start: Callable[[BinaryIO], BinaryIO], mark: Path | None = None
+    ) -> None:
+        super().__init__()
+        self.raw = raw
+        self._start = start
+        self._mark = mark
+        self._stream: BinaryIO | None = None
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type: ignore[override]
+        if self._stream is None:
+            self._stream = self._start(self.raw)
+        self._stream.write(data)
+        return len(data)
+
+    def flush(self) -> None:
+        finished = self._stream is not None
+        if self._stream is not None:
+            # finishes the member without closing the file under it
+            self._stream.close()
+            self._stream = None
+        if not self.raw.closed:
+            self.raw.flush()
+            if finished and self._mark is not None:
+                self._mark.write_text(str(self.raw.tell()))
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self.raw.close()
+            super().close()
+
+
+def _new_decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)  # exactly one gzip member
+    return zstandard.ZstdDecompressor().decompressobj()  # exactly one zstd frame
+
+
+def _scan_members(path: str | Path, compression: str, start: int) -> tuple[int, bool]:
+    """
+    Decompress a file from an offset on to find where its last whole gzip member or zstd frame ends.
+
+    Returns:
+        The offset after the last whole member, and whether everything from ``start`` on was valid compressed data.
+        A member that was cut short is valid, it just doesn't count as whole.
+    """
+    errors: tuple[type[Exception], ...] = (zlib.error,)
+    if zstandard is not None:
+        errors += (zstandard.ZstdError,)
+    decompressor = _new_decompressor(compression)
+    complete = start
+    offset = start
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        while chunk := fp.read(1 << 20):
+            offset += len(chunk)
+            while chunk:
+                try:
+                    decompressor.decompress(chunk)
+                except errors:
+                    return complete, False
+                if not decompressor.eof:
+                    break
+                complete = offset - len(decompressor.unused_data)
+                chunk = decompressor.unused_data
+                decompressor = _new_decompressor(compression)
+    return complete, True
+
+
+def _readable_length(path: str | Path, compression: str) -> int:
+    """
+    How many bytes at the start of a compressed file are whole gzip members or zstd frames.
+
+    Only what was written after the last flush recorded next to the file is decompressed, unless that doesn't start on
+    a member, e.g. because the file was replaced by something else. Then the whole file is.
+    """
+    mark = _read_mark(path)
+    if mark is not None and mark <= os.path.getsize(path):
+        complete, valid = _scan_members(path, compression, mark)
+        if valid or complete > mark:
+            return complete
+        logger.debug(f"{path} doesn't have a member where it was last flushed, reading all of it")
+    complete, _ = _scan_members(path, compression, 0)
+    return complete
+
+
+def _truncate_incomplete(path: str | Path, compression: str) -> None:
+    """
+    Cut off a gzip member or zstd frame that was left unfinished at the end of a file, e.g. by a crash.
+
+    Anything appended after an unfinished member could never be read back, along with the member itself.
+    """
+    if not os.path.exists(path):
+        return
+    size = os.path.getsize(path)
+    complete = _readable_length(path, compression)
+    if complete < size:
+        logger.warning(
+            f"{path} ends in {size - complete} bytes that were never finished, probably by a crash."
+            " Cutting them off before appending."
+        )
+        os.truncate(path, complete)
+
+
+def open_output(path: str | Path, *, append: bool = False, level: int | None = None) -> TextIO:
+    """
+    Open a csv file for writing, compressing it if the filename asks for it.
+
+    A compressed file is finished off on every flush, so whatever was flushed survives a crash. Appending to a
+    compressed file adds new gzip members or zstd frames after the existing ones, which every decompressor reads back
+    as one continuous stream, after cutting off whatever a crash left unfinished. Where the file was last flushed is
+    kept in a ``.flushed`` file next to it, so only what came after that has to be checked.
+
+    Args:
+        path: Where to write. A .gz or .zst suffix turns on compression.
+        append: Add to the end of the file instead of replacing it.
+        level: The compression level. Defaults to a fast level for each format.
+    """
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, "a" if append else "w", newline="", encoding="utf-8")
+
+    level = level if level is not None else DEFAULT_LEVELS[compression]
+    start: Callable[[BinaryIO], BinaryIO]
+    if compression == "gzip":
+
+        def start(raw: BinaryIO) -> BinaryIO:
+            return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=level)  # type: ignore[return-value]
+
+    else:
+        _require_zstandard()
+        compressor = zstandard.ZstdCompressor(level=level)
+
+        def start(raw: BinaryIO) -> BinaryIO:
+            return compressor.stream_writer(raw, closefd=False)
+
+    mark = _mark_path(path)
+    if append:
+        _truncate_incomplete(path, compression)
+    else:
+        # whatever it says is about the file we're about to replace
+        mark.unlink(missing_ok=True)
+    raw = open(path, "ab" if append else "wb")
+    return io.TextIOWrapper(_FramedWriter(raw, start, mark), encoding="utf-8", newline="")
+
+
+def open_input(path: str | Path) -> TextIO:
+    """
+    Open a csv file written by ``open_output`` for reading, decompressing it if needed.
+    """
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, "r", newline="", encoding="utf-8")
+    if compression == "gzip":
+        return gzip.open(path, "rt", newline="", encoding="utf-8")
+
+    _require_zstandard()
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+    return io.TextIOWrapper(reader, encoding="utf-8", newline="")
+
+
+def has_content(path: str | Path) -> bool:
+    """
+    Whether the file exists and has anything in it, so we know whether headers were already written.
+    """
+    path = Path(path)
+    return path.exists() and path.stat().st_size > 0
+
+
+__all__ = ("COMPRESSIONS", "compression_of", "open_output", "open_input", "has_content")
@@ -0,0 +1,287 @@
+"""
+Per-page network and performance traces for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Iterator, TextIO
+
+from selenium.common import WebDriverException
+
+from .devtools import Event, PerformanceLog
+
+logger = logging.getLogger(__package__)
+
+# what Performance.getMetrics reports that is worth keeping, all cumulative for the tab
+PERFORMANCE_METRICS = (
+    "TaskDuration",
+    "ScriptDuration",
+    "LayoutDuration",
+    "JSHeapUsedSize",
+    "Nodes",
+)
+
+
+def page_kind(url: str) -> str:
+    if "/dp/" in url or "/gp/product/" in url:
+        return "product"
+    if "amazon." in url and "/s?" in url:
+        return "search"
+    return "other"
+
+
+@dataclass
+class PageTrace:
+    """
+    What one navigation cost: the document and everything it loaded.
+
+    Bytes are what came over the network, compressed and with headers, as DevTools counts them. A proxy adds its own
+    overhead on top, so a provider's meter reads a little higher.
+    """
+
+    url: str
+    kind: str
+    query: str | None = None
+    proxy: str | None = None
+    bytes_by_type: Counter[str] = field(default_factory=Counter)
+    requests_by_type: Counter[str] = field(default_factory=Counter)
+    failed: int = 0
+    cached: int = 0
+    # milliseconds after the document was requested: "response", "domcontentloaded", "load" and "finished"
+    milestones: dict[str, float] = field(default_factory=dict)
+    started: float = 0.0  # the DevTools timestamp the document was requested at
+
+    @property
+    def bytes(self) -> int:
+        return sum(self.bytes_by_type.values())
+
+    @property
+    def requests(self) -> int:
+        return sum(self.requests_by_type.values())
+
+    def mark(self, milestone: str, timestamp: float) -> None:
+        # the first time counts; a page can fire load more than once if a frame navigates
+        self.milestones.setdefault(milestone, round((timestamp - self.started) * 1000, 1))
+
+    def to_json(self) -> dict[str, Any]:
+        data = asdict(self)
+        # asdict rebuilds a Counter from its items, which counts the pairs instead of copying them
+        data.update(
+            bytes_by_type=dict(self.bytes_by_type),
+            requests_by_type=dict(self.requests_by_type),
+            bytes=self.bytes,
+            requests=self.requests,
+        )
+        return data
+
+
+class _PageRecorder:
+    """
+    Turns the DevTools events of one query into ``PageTrace``s, one per navigation.
+    """
+
+    def __init__(self, query: str | None, proxy: str | None) -> None:
+        self.query = query
+        self.proxy = proxy
+        self.pages: dict[str, PageTrace] = {}  # by loaderId
+        self._requests: dict[str, tuple[str, str]] = {}  # requestId -> (loaderId, resource type)
+        self._current: dict[str | None, PageTrace] = {}  # the latest document of each tab
+
+    def on_event(self, event: Event) -> None:
+        params = event.get("params", {})
+        match event.get("method"):
+            case "Network.requestWillBeSent":
+                loader = params.get("loaderId", "")
+                resource = params.get("type", "Other")
+                if resource == "Document" and params["requestId"] == loader:
+                    page = PageTrace(
+                        params["request"]["url"],
+                        page_kind(params["request"]["url"]),
+                        self.query,
+                        self.proxy,
+                        started=params.get("timestamp", 0.0),
+                    )
+                    self.pages[loader] = page
+                    self._current[event.get("webview")] = page
+                if loader in self.pages:
+                    self._requests[params["requestId"]] = (loader, resource)
+                    self.pages[loader].requests_by_type[resource] += 1
+            case "Network.responseReceived":
+                if (request := self._requests.get(params["requestId"])) is None:
+                    return
+                page = self.pages[request[0]]
+                response = params.get("response", {})
+                if response.get("fromDiskCache") or response.get("fromPrefetchCache"):
+                    page.cached += 1
+                if params["requestId"] == request[0]:
+                    page.mark("response", params.get("timestamp", page.started))
+            case "Network.loadingFinished":
+                if (request := self._requests.pop(params["requestId"], None)) is None:
+                    return
+                page = self.pages[request[0]]
+                page.bytes_by_type[request[1]] += int(params.get("encodedDataLength", 0))
+                finished = round((params.get("timestamp", page.started) - page.started) * 1000, 1)
+                page.milestones["finished"] = max(page.milestones.get("finished", 0.0), finished)
+            case "Network.loadingFailed":
+                if (request := self._requests.pop(params["requestId"], None)) is not None:
+                    self.pages[request[0]].failed += 1
+            case "Page.domContentEventFired":
+                if (page := self._current.get(event.get("webview"))) is not None:
+                    page.mark("domcontentloaded", params.get("timestamp", page.started))
+            case "Page.loadEventFired":
+                if (page := self._current.get(event.get("webview"))) is not None:
+                    page.mark("load", params.get("timestamp", page.started))
+
+
+@dataclass
+class TrafficStats:
+    pages: int = 0
+    requests: int = 0
+    bytes: int = 0
+    failed: int = 0
+    bytes_by_type: Counter[str] = field(default_factory=Counter)
+    load_ms: float = 0.0  # summed over the pages that fired load
+    loaded: int = 0
+
+    def add(self, page: PageTrace) -> None:
+        self.pages += 1
+        self.requests += page.requests
+        self.bytes += page.bytes
+        self.failed += page.failed
+        self.bytes_by_type.update(page.bytes_by_type)
+        if "load" in page.milestones:
+            self.load_ms += page.milestones["load"]
+            self.loaded += 1
+
+    def __str__(self) -> str:
+        load = f", load in {self.load_ms / self.loaded:.0f}ms" if self.loaded else ""
+        top = ", ".join(
+            f"{kind} {size / 2**10:.0f} KiB" for kind, size in self.bytes_by_type.most_common(4)
+        )
+        per_page = self.bytes / self.pages / 2**10 if self.pages else 0.0
+        return (
+            f"{self.pages} pages, {self.requests} requests ({self.failed} failed),"
+            f" {self.bytes / 2**20:.1f} MiB, {per_page:.0f} KiB per page{load} [{top}]"
+        )
+
+
+@dataclass
+class NetworkReport:
+    """
+    What the traced pages cost, added up per page kind, per query and per proxy.
+    """
+
+    total: TrafficStats = field(default_factory=TrafficStats)
+    by_kind: dict[str, TrafficStats] = field(default_factory=dict)
+    by_query: dict[str, TrafficStats] = field(default_factory=dict)
+    by_proxy: dict[str, TrafficStats] = field(default_factory=dict)
+    # Performance.getMetrics of each query's search tab
+    metrics_by_query: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    def add(self, page: PageTrace) -> None:
+        self.total.add(page)
+        self.by_kind.setdefault(page.kind, TrafficStats()).add(page)
+        self.by_query.setdefault(page.query or "", TrafficStats()).add(page)
+        self.by_proxy.setdefault(page.proxy or "direct", TrafficStats()).add(page)
+
+    def __str__(self) -> str:
+        lines = [f"Network: {self.total}", "By page:"]
+        for kind, stats in sorted(self.by_kind.items(), key=lambda item: -item[1].bytes):
+            lines.append(f"  {kind}: {stats}")
+        lines.append("By proxy:")
+        for proxy, stats in sorted(self.by_proxy.items(), key=lambda item: -item[1].bytes):
+            lines.append(f"  {proxy}: {stats}")
+        lines.append("Heaviest queries:")
+        for query, stats in sorted(self.by_query.items(), key=lambda item: -item[1].bytes)[:10]:
+            lines.append(f"  {query!r}: {stats}")
+        return "\n".join(lines)
+
+
+class NetworkTracer:
+    """
+    Records what every page a scrape opens costs in bytes, requests and time, from DevTools events.
+
+    Tracing is opt-in, and needs drivers created with ``capture_network``. Pages can also be written out as they are
+    traced, one JSON object per line.
+    """
+
+    def __init__(self, output: TextIO | None = None) -> None:
+        self.output = output
+        self._report = NetworkReport()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def recording(
+        self, log: PerformanceLog, *, query: str | None = None, proxy: str | None = None
+    ) -> Iterator[None]:
+        """
+        Trace every page loaded while inside the block. Whatever else reads ``log`` during the block shares its events.
+        """
+        recorder = _PageRecorder(query, proxy)
+        driver = log.driver
+        log.drain()  # anything from before the block isn't ours
+        try:
+            driver.execute_cdp_cmd("Performance.enable", {})
+        except WebDriverException as e:
+            logger.debug(f"Could not enable performance metrics: {e}")
+        log.subscribe(recorder.on_event)
+        try:
+            yield
+        finally:
+            try:
+                log.drain()
+            finally:
+                log.unsubscribe(recorder.on_event)
+            metrics: dict[str, float] = {}
+            try:
+                result = driver.execute_cdp_cmd("Performance.getMetrics", {})
+                metrics = {
+                    metric["name"]: metric["value"]
+                    for metric in result.get("metrics", [])
+                    if metric["name"] in PERFORMANCE_METRICS
+                }
+            except WebDriverException as e:
+                logger.debug(f"Could not read performance metrics: {e}")
+            self._add(recorder.pages.values(), query, metrics)
+
+    def _add(self, pages: Any, query: str | None, metrics: dict[str, float]) -> None:
+        with self._lock:
+            for page in pages:
+                self._report.add(page)
+                if self.output is not None:
+                    self.output.write(json.dumps(page.to_json()) + "\n")
+            if metrics:
+                self._report.metrics_by_query[query or ""] = metrics
+            if self.output is not None:
+                self.output.flush()
+
+    def report(self) -> NetworkReport:
+        with self._lock:
+            return self._report
+
+
+__all__ = (
+    "page_kind",
+    "PageTrace",
+    "TrafficStats",
+    "NetworkReport",
+    "NetworkTracer",
+)
@@ -0,0 +1,246 @@
+"""
+Staged producer/consumer pipelines for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import heapq
+import logging
+from dataclasses import dataclass
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Iterable, Sequence
+
+logger = logging.getLogger(__package__)
+
+_DONE = object()
+
+
+@dataclass
+class StageMetrics:
+    """
+    What a stage did during a run. Queue depth is measured on the stage's input queue.
+    """
+
+    name: str
+    workers: int
+    processed: int = 0
+    dropped: int = 0
+    busy_seconds: float = 0.0
+    max_depth: int = 0
+    _depth_total: int = 0
+    _depth_samples: int = 0
+
+    @property
+    def mean_depth(self) -> float:
+        return self._depth_total / self._depth_samples if self._depth_samples else 0.0
+
+    def sample_depth(self, depth: int) -> None:
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_total += depth
+        self._depth_samples += 1
+
+    def merge(self, other: "StageMetrics") -> None:
+        """
+        Add another run's numbers to these ones.
+        """
+        self.processed += other.processed
+        self.dropped += other.dropped
+        self.busy_seconds += other.busy_seconds
+        self.max_depth = max(self.max_depth, other.max_depth)
+        self._depth_total += other._depth_total
+        self._depth_samples += other._depth_samples
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name} (x{self.workers}): {self.processed} done, {self.dropped} dropped, "
+            f"{self.busy_seconds:.1f}s busy, queue depth {self.mean_depth:.1f} avg / {self.max_depth} max"
+        )
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    Args:
+        name: Shown in logs and metrics.
+        func: Turns an item into the next stage's item. Returning None drops the item, unless this is the last stage.
+        workers: How many threads run ``func`` at once.
+    """
+
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1) -> None:
+        if workers < 1:
+            raise ValueError(f"Stage {name!r} needs at least one worker")
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class _StageRunner:
+    def __init__(
+        self,
+        stage: Stage,
+        metrics: StageMetrics,
+        inbox: Queue,
+        downstream: tuple[Queue, StageMetrics, int] | None,
+        abort: Event,
+        errors: list[BaseException],
+        ordered: bool,
+    ) -> None:
+        self.stage = stage
+        self.metrics = metrics
+        self.inbox = inbox
+        self.downstream = downstream
+        self.abort = abort
+        self.errors = errors
+        self.ordered = ordered
+        self._lock = Lock()
+        self._running = stage.workers
+        self._pending: list[tuple[int, Any]] = []
+        self._next_seq = 0
+
+    def threads(self) -> list[Thread]:
+        return [
+            Thread(target=self._work, name=f"Pipeline-{self.stage.name}-{n}", daemon=True)
+            for n in range(self.stage.workers)
+        ]
+
+    def _work(self) -> None:
+        try:
+            while (envelope := self.inbox.get()) is not _DONE:
+                if self.ordered:
+                    # items are handled in the order the source produced them
+                    # dropped items travel as None so that the sequence has no holes
+                    heapq.heappush(self._pending, envelope)
+                    while self._pending and self._pending[0][0] == self._next_seq:
+                        self._handle(*heapq.heappop(self._pending))
+                        self._next_seq += 1
+                else:
+                    self._handle(*envelope)
+        finally:
+            with self._lock:
+                self._running -= 1
+                last_worker = self._running == 0
+            if last_worker and self.downstream is not None:
+                outbox, _, downstream_workers = self.downstream
+                for _ in range(downstream_workers):
+                    outbox.put(_DONE)
+
+    def _handle(self, seq: int, item: Any) -> None:
+        if item is not None and not self.abort.is_set():
+            start = perf_counter()
+            try:
+                item = self.stage.func(item)
+            except BaseException as e:
+                logger.debug(f"Stage {self.stage.name!r} failed, abandoning the pipeline")
+                self.errors.append(e)
+                self.abort.set()
+                item = None
+            with self._lock:
+                self.metrics.busy_seconds += perf_counter() - start
+                # whatever the last stage returns goes nowhere, so it can't drop anything
+                if item is None and self.downstream is not None:
+                    self.metrics.dropped += 1
+                else:
+                    self.metrics.processed += 1
+        if self.downstream is not None:
+            outbox, downstream_metrics, _ = self.downstream
+            with self._lock:
+                downstream_metrics.sample_depth(outbox.qsize())
+            outbox.put((seq, item))
+
+
+class Pipeline:
+    """
+    Runs items through stages connected by bounded queues.
+
+    Every stage has its own threads, so a slow stage only holds up the stages that are waiting on it.
+    When a queue is full, the stage feeding it blocks, so memory stays bounded no matter which stage is the slowest.
+    If any stage raises, the run is abandoned and the exception is raised again from ``run``.
+
+    Args:
+        stages: The stages, in order.
+        queue_size: How many items may wait in front of each stage.
+        ordered: Hand items to the last stage in the order the source produced them. The last stage must have one worker.
+    """
+
+    def __init__(
+        self, stages: Sequence[Stage], *, queue_size: int = 8, ordered: bool = True
+    ) -> None:
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        if ordered and stages[-1].workers != 1:
+            raise ValueError("An ordered pipeline's last stage must have exactly one worker")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.ordered = ordered
+
+    def run(self, source: Iterable[Any]) -> list[StageMetrics]:
+        """
+        Feed every item of ``source`` through the pipeline and wait for it to drain.
+
+        The source is iterated on the calling thread, so it may use resources that belong to that thread.
+
+        Returns:
+            Metrics for each stage.
+        """
+        abort = Event()
+        errors: list[BaseException] = []
+        queues: list[Queue] = [Queue(maxsize=self.queue_size) for _ in self.stages]
+        metrics = [StageMetrics(stage.name, stage.workers) for stage in self.stages]
+        runners: list[_StageRunner] = []
+        for index, stage in enumerate(self.stages):
+            is_last = index == len(self.stages) - 1
+            runners.append(
+                _StageRunner(
+                    stage,
+                    metrics[index],
+                    queues[index],
+                    None
+                    if is_last
+                    else (queues[index + 1], metrics[index + 1], self.stages[index + 1].workers),
+                    abort,
+                    errors,
+                    # the items waiting to be put back in order are bounded by the queues in front of them
+                    self.ordered and is_last,
+                )
+            )
+
+        threads = [thread for runner in runners for thread in runner.threads()]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for seq, item in enumerate(source):
+                if abort.is_set():
+                    break
+                metrics[0].sample_depth(queues[0].qsize())
+                queues[0].put((seq, item))
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+        return metrics
+
+
+__all__ = ("Stage", "Pipeline", "StageMetrics")
@@ -0,0 +1,265 @@
+"""
+Typed post-processing of scraped data for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator
+
+try:
+    import pandas as pd
+except ImportError:  # pragma: no cover
+    pd = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+from .output import open_input, open_output
+
+logger = logging.getLogger(__package__)
+
+# How each AMZScout column is parsed, picked by the first pattern that matches its name.
+# Columns that match nothing (names, URLs, descriptions...) are left as text.
+COLUMN_KINDS: tuple[tuple[str, str], ...] = (
+    (r"^#$", "count"),
+    (r"price|revenue|fees?\b|\bnet\b|profit|cost", "currency"),
+    (r"rating|stars", "decimal"),
+    (r"rank|sales|reviews|sellers|lqs|variations", "count"),
+    (r"weight", "weight"),
+    (r"date|available", "date"),
+)
+# Cells that mean "no value" rather than a value we failed to read
+MISSING_VALUES = ("", "-", "--", "—", "n/a", "na", "none", "null")
+# Dropped by default, since they are huge and not numeric
+DEFAULT_DROPPED_COLUMNS = ("Thumbnail Image",)
+
+_SUFFIXES = {"": 1.0, "K": 1e3, "M": 1e6, "B": 1e9}
+# Everything is converted to pounds, since that's what Amazon US shows
+_WEIGHT_UNITS = {
+    "lb": 1.0,
+    "lbs": 1.0,
+    "pound": 1.0,
+    "pounds": 1.0,
+    "oz": 1 / 16,
+    "ounce": 1 / 16,
+    "ounces": 1 / 16,
+    "kg": 2.20462,
+    "g": 0.00220462,
+}
+
+
+def _require_pandas() -> None:
+    if pd is None:
+        raise ImportError("Post-processing requires pandas. Install amzscoutscrape[analysis].")
+
+
+def kind_of(column: str) -> str | None:
+    """
+    Find out how a column should be parsed.
+
+    Returns:
+        One of "count", "currency", "decimal", "weight" or "date", or None for text.
+    """
+    for pattern, kind in COLUMN_KINDS:
+        if re.search(pattern, column, flags=re.IGNORECASE):
+            return kind
+    return None
+
+
+def _missing(text: "pd.Series") -> "pd.Series":
+    return text.isna() | text.str.strip().str.lower().isin(MISSING_VALUES)
+
+
+def _parse_number(text: "pd.Series") -> "pd.Series":
+    # "$1,234.56", "#12,345", "1.2K", "45%"
+    parts = text.str.replace(r"[\s$#,%+]", "", regex=True).str.extract(
+        r"^(-?\d*\.?\d+)([KMB]?)$", flags=re.IGNORECASE
+    )
+    value = pd.to_numeric(parts[0], errors="coerce")
+    return value * parts[1].str.upper().map(_SUFFIXES).astype("float64")
+
+
+def _parse_weight(text: "pd.Series") -> "pd.Series":
+    # "1.5 pounds", "12 oz", "0.4 kg"
+    parts = text.str.replace(",", "", regex=False).str.extract(
+        r"^\s*(\d*\.?\d+)\s*([a-z]+)\.?\s*$", flags=re.IGNORECASE
+    )
+    value = pd.to_numeric(parts[0], errors="coerce")
+    return value * parts[1].str.lower().map(_WEIGHT_UNITS).astype("float64")
+
+
+def parse_column(text: "pd.Series", kind: str) -> "pd.Series":
+    """
+    Parse a column of display text into numbers (or dates), all at once.
+
+    Cells that can't be parsed come back as NaN (or NaT).
+    """
+    _require_pandas()
+    text = text.astype("string")
+    match kind:
+        case "count":
+            values = _parse_number(text)
+            # counts are whole numbers, but "1.2K" is only as precise as it says it is
+            return values.round().astype("Int64")
+        case "currency" | "decimal":
+            return _parse_number(text).astype("float64")
+        case "weight":
+            return _parse_weight(text).astype("float64")
+        case "date":
+            return pd.to_datetime(text, errors="coerce", format="mixed")
+        case _:
+            raise ValueError(f"Unknown column kind {kind!r}")
+
+
+def type_frame(frame: "pd.DataFrame") -> tuple["pd.DataFrame", dict[str, int]]:
+    """
+    Parse every column of a frame that has a known kind.
+
+    Returns:
+        The typed frame and, for each parsed column, how many cells had a value that couldn't be parsed.
+    """
+    _require_pandas()
+    typed = frame.copy()
+    unparseable: dict[str, int] = {}
+    for column in frame.columns:
+        kind = kind_of(str(column))
+        if kind is None:
+            continue
+        text = frame[column].astype("string")
+        parsed = parse_column(text, kind)
+        unparseable[column] = int((parsed.isna() & ~_missing(text)).sum())
+        typed[column] = parsed
+    return typed, unparseable
+
+
+@dataclass
+class ParseReport:
+    """
+    How a post-processing run went.
+    """
+
+    rows: int = 0
+    unparseable: Counter = field(default_factory=Counter)
+
+    def __str__(self) -> str:
+        lines = [f"{self.rows} rows"]
+        for column, count in self.unparseable.items():
+            lines.append(f"{column}: {count} unparseable ({count / max(self.rows, 1) * 100:.2f}%)")
+        return "\n".join(lines)
+
+
+def iter_typed_chunks(
+    source: str | Path,
+    *,
+    chunksize: int = 100_000,
+    drop: Iterable[str] = DEFAULT_DROPPED_COLUMNS,
+    report: ParseReport | None = None,
+) -> Iterator["pd.DataFrame"]:
+    """
+    Read a ``generate`` output file a chunk at a time and type each chunk.
+
+    Only one chunk is ever in memory, so the file can be larger than RAM.
+
+    Args:
+        source: The csv to read. It may be compressed.
+        chunksize: How many rows to read at a time.
+        drop: Columns to leave out.
+        report: Filled in with the number of rows and unparseable cells as the chunks are read.
+    """
+    _require_pandas()
+    drop = set(drop)
+    with open_input(source) as fp:
+        for chunk in pd.read_csv(
+            fp,
+            chunksize=chunksize,
+            dtype=str,
+            keep_default_na=False,
+            usecols=lambda column: column not in drop,
+        ):
+            typed, unparseable = type_frame(chunk)
+            if report is not None:
+                report.rows += len(typed)
+                report.unparseable.update(unparseable)
+            yield typed
+
+
+def postprocess(
+    source: str | Path,
+    destination: str | Path,
+    *,
+    chunksize: int = 100_000,
+    drop: Iterable[str] = DEFAULT_DROPPED_COLUMNS,
+    compression_level: int | None = None,
+) -> ParseReport:
+    """
+    Turn a ``generate`` output file into a typed dataset.
+
+    Args:
+        source: The csv to read. It may be compressed.
+        destination: Where to write. A .parquet file keeps the types (and needs pyarrow), anything else is a csv
+            with plain numbers in it, compressed if the name asks for it.
+        chunksize: How many rows to read at a time.
+        drop: Columns to leave out.
+        compression_level: The level to compress at when the destination ends in .gz or .zst.
+
+    Returns:
+        How many rows were read, and how many cells in each column couldn't be parsed.
+    """
+    _require_pandas()
+    report = ParseReport()
+    chunks = iter_typed_chunks(source, chunksize=chunksize, drop=drop, report=report)
+
+    if Path(destination).suffix.lower() == ".parquet":
+        if pyarrow is None:
+            raise ImportError("Writing parquet requires pyarrow. Install amzscoutscrape[analysis].")
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(destination, table.schema)
+                writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open_output(destination, level=compression_level) as fp:
+            for index, chunk in enumerate(chunks):
+                chunk.to_csv(fp, header=index == 0, index=False)
+
+    for column, count in report.unparseable.items():
+        if count:
+            logger.warning(f"{count} of {report.rows} values in {column!r} couldn't be parsed")
+    return report
+
+
+__all__ = (
+    "COLUMN_KINDS",
+    "DEFAULT_DROPPED_COLUMNS",
+    "kind_of",
+    "parse_column",
+    "type_frame",
+    "ParseReport",
+    "iter_typed_chunks",
+    "postprocess",
+)
@@ -0,0 +1,300 @@
+"""
+Process tree inspection for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+import os
+import signal
+from dataclasses import dataclass
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Iterable
+
+try:
+    import psutil
+except ImportError:  # pragma: no cover
+    psutil = None
+
+logger = logging.getLogger(__package__)
+
+# Browsers inherit this from the scraper that started them, so we can tell whose they are once it is gone
+SESSION_ENV = "AMZSCOUT_SESSION"
+BROWSER_NAMES = ("chrome", "chromium", "msedge", "chromedriver", "msedgedriver")
+
+
+@dataclass(frozen=True)
+class ProcessInfo:
+    pid: int
+    ppid: int
+    name: str
+    cmdline: tuple[str, ...]
+    # when the process started, in whatever unit the platform uses; with the pid it names exactly one process
+    start_time: float
+
+    @property
+    def is_browser(self) -> bool:
+        name = self.name.lower()
+        return any(browser in name for browser in BROWSER_NAMES)
+
+
+def mark_session() -> None:
+    """
+    Tag every browser this process starts from now on, so ``orphaned_browsers`` can find them if it dies.
+    """
+    os.environ[SESSION_ENV] = str(os.getpid())
+
+
+def _session_of(pid: int) -> int | None:
+    try:
+        if psutil is not None:
+            value = psutil.Process(pid).environ().get(SESSION_ENV)
+        else:
+            environ = (Path("/proc") / str(pid) / "environ").read_bytes()
+            prefix = f"{SESSION_ENV}=".encode()
+            value = next(
+                (
+                    entry[len(prefix) :].decode()
+                    for entry in environ.split(b"\0")
+                    if entry.startswith(prefix)
+                ),
+                None,
+            )
+    except Exception:
+        return None  # gone, or someone else's
+    return int(value) if value and value.isdigit() else None
+
+
+def _read_proc(pid_dir: Path) -> ProcessInfo | None:
+    try:
+        stat = (pid_dir / "stat").read_text()
+        cmdline = (pid_dir / "cmdline").read_bytes()
+    except OSError:
+        return None  # gone already, or not ours to look at
+    # the name is in parentheses and may contain anything, including spaces and parentheses
+    name = stat[stat.index("(") + 1 : stat.rindex(")")]
+    fields = stat[stat.rindex(")") + 2 :].split()
+    return ProcessInfo(
+        pid=int(pid_dir.name),
+        ppid=int(fields[1]),
+        name=name,
+        cmdline=tuple(part.decode(errors="replace") for part in cmdline.split(b"\0") if part),
+        start_time=float(fields[19]),
+    )
+
+
+def list_processes() -> list[ProcessInfo]:
+    """
+    Every process we can see. Uses psutil if it is installed, and /proc otherwise.
+    """
+    if psutil is not None:
+        processes = []
+        for process in psutil.process_iter(["pid", "ppid", "name", "cmdline", "create_time"]):
+            info = process.info
+            processes.append(
+                ProcessInfo(
+                    info["pid"],
+                    info["ppid"] or 0,
+                    info["name"] or "",
+                    tuple(info["cmdline"] or ()),
+                    info["create_time"] or 0.0,
+                )
+            )
+        return processes
+    proc = Path("/proc")
+    if not proc.is_dir():
+        logger.warning("Can't list processes without psutil on this platform. Install psutil.")
+        return []
+    return [
+        info
+        for pid_dir in proc.iterdir()
+        if pid_dir.name.isdigit() and (info := _read_proc(pid_dir)) is not None
+    ]
+
+
+def descendants(pid: int, processes: Iterable[ProcessInfo] | None = None) -> list[ProcessInfo]:
+    """
+    Every process below ``pid`` in the process tree, not including ``pid`` itself.
+    """
+    children: dict[int, list[ProcessInfo]] = {}
+    for info in processes if processes is not None else list_processes():
+        children.setdefault(info.ppid, []).append(info)
+    found: list[ProcessInfo] = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), ()):
+            found.append(child)
+            stack.append(child.pid)
+    return found
+
+
+def orphaned_browsers(processes: Iterable[ProcessInfo] | None = None) -> list[ProcessInfo]:
+    """
+    Browser and driver processes whose scraper is gone.
+
+    Only processes tagged by ``mark_session`` are considered, so browsers belonging to a live scraper, or to anything
+    other than amzscout-scrape, are never touched. undetected-chromedriver detaches its browser from the process that
+    started it, so the tag is the only reliable way to find its owner.
+    """
+    processes = list(processes if processes is not None else list_processes())
+    alive = {info.pid: info for info in processes}
+    orphans: list[ProcessInfo] = []
+    for info in processes:
+        if not info.is_browser or (owner := _session_of(info.pid)) is None or owner == info.pid:
+            continue
+        parent = alive.get(owner)
+        # a process that started after the browser can't be its owner, it just got the same pid
+        if parent is None or parent.start_time > info.start_time:
+            orphans.append(info)
+    return orphans
+
+
+@dataclass
+class MemoryUsage:
+    """
+    How much memory a set of processes takes up.
+
+    RSS counts shared pages once for every process that maps them, so it overstates a multi-process browser.
+    PSS splits shared pages between the processes that share them, and adds up to what they really cost, but it is
+    only available on Linux.
+    """
+
+    processes: int = 0
+    rss: int = 0
+    pss: int | None = None
+
+    def __str__(self) -> str:
+        pss = f", {self.pss / 2**20:.0f} MiB PSS" if self.pss is not None else ""
+        return f"{self.processes} processes, {self.rss / 2**20:.0f} MiB RSS{pss}"
+
+
+def _memory_of(pid: int) -> tuple[int, int | None] | None:
+    try:
+        if psutil is not None:
+            process = psutil.Process(pid)
+            try:
+                full = process.memory_full_info()
+                return full.rss, getattr(full, "pss", None)
+            except psutil.AccessDenied:
+                return process.memory_info().rss, None
+        pid_dir = Path("/proc") / str(pid)
+        rss = int((pid_dir / "statm").read_text().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        try:
+            rollup = (pid_dir / "smaps_rollup").read_text()
+        except OSError:
+            return rss, None
+        pss = next(
+            (
+                int(line.split()[1]) * 1024
+                for line in rollup.splitlines()
+                if line.startswith("Pss:")
+            ),
+            None,
+        )
+        return rss, pss
+    except Exception:
+        return None  # gone, or not ours to look at
+
+
+def memory_of(roots: Iterable[int], processes: Iterable[ProcessInfo] | None = None) -> MemoryUsage:
+    """
+    The memory taken up by some processes and everything below them.
+    """
+    processes = list(processes if processes is not None else list_processes())
+    pids = set()
+    for root in roots:
+        pids.add(root)
+        pids.update(info.pid for info in descendants(root, processes))
+    usage = MemoryUsage(pss=0)
+    for pid in pids:
+        memory = _memory_of(pid)
+        if memory is None:
+            continue
+        rss, pss = memory
+        usage.processes += 1
+        usage.rss += rss
+        usage.pss = usage.pss + pss if usage.pss is not None and pss is not None else None
+    return usage
+
+
+def available_memory() -> int | None:
+    """
+    How many bytes of memory can be handed out without swapping, if we can tell.
+    """
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo") as fp:
+            for line in fp:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _still_running(info: ProcessInfo, current: dict[int, ProcessInfo]) -> bool:
+    # a pid can be reused, so it only counts if it started at the same time
+    now = current.get(info.pid)
+    return now is not None and now.start_time == info.start_time
+
+
+def kill_processes(
+    targets: Iterable[ProcessInfo], *, grace_seconds: float = 5.0
+) -> list[ProcessInfo]:
+    """
+    Ask processes to stop, and kill whatever is still running once the grace period is over.
+
+    Returns:
+        The processes that were signalled.
+    """
+    targets = list(targets)
+    if not targets:
+        return []
+    current = {info.pid: info for info in list_processes()}
+    signalled = [info for info in targets if _still_running(info, current)]
+    for info in signalled:
+        try:
+            os.kill(info.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    deadline = monotonic() + grace_seconds
+    remaining = signalled
+    while remaining and monotonic() < deadline:
+        sleep(0.1)
+        current = {info.pid: info for info in list_processes()}
+        remaining = [info for info in remaining if _still_running(info, current)]
+    for info in remaining:
+        try:
+            os.kill(info.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        except OSError:
+            pass
+    return signalled
+
+
+__all__ = (
+    "SESSION_ENV",
+    "ProcessInfo",
+    "mark_session",
+    "list_processes",
+    "descendants",
+    "orphaned_browsers",
+    "kill_processes",
+    "MemoryUsage",
+    "memory_of",
+    "available_memory",
+)
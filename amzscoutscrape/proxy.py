@@ -16,33 +16,268 @@ or implied. See the License for the specific language governing
 permissions and limitations under the License.
 
 """
+import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from threading import Event
-from typing import Sequence, cast
+import sqlite3
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Event, Lock
+from time import monotonic, time
+from typing import Any, Callable, Iterable, Sequence
 
 import requests
-from requests import Session
 
-_CACHE: Sequence[dict] | None = None
+from .httpclient import HttpClient, client_for
+
 _USED = set()
 logger = logging.getLogger(__package__)
 
+GEONODE_API = "https://proxylist.geonode.com/api/proxy-list"
+GEONODE_PAGE_SIZE = 500
+GEONODE_MAX_PAGES = 20
+DEFAULT_PROXY_CATALOG = Path(tempfile.gettempdir()).joinpath("amzscout-proxies.sqlite3")
+# how long a fetched list is good for before it is fetched again
+DEFAULT_PROXY_TTL = 6 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS proxies (
+    id TEXT PRIMARY KEY,
+    ip TEXT NOT NULL,
+    port TEXT NOT NULL,
+    protocols TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    successes INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    latency REAL,
+    last_success REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def _fetch_proxy_page(page: int, limit: int = GEONODE_PAGE_SIZE) -> tuple[list[dict], int]:
+    """
+    Fetch one page of proxies from proxylist.geonode.com, most recently checked first.
 
-def _fetch_proxies() -> Sequence[dict]:
-    global _CACHE
-    logger.info("Fetching proxies from proxylist.geonode.com...")
-    with requests.get(
-        "https://proxylist.geonode.com/api/proxy-list?limit=500&page=1&sort_by=lastChecked&sort_type=desc&country=US",
+    Returns:
+        The proxies, and how many there are over every page.
+    """
+    logger.info(f"Fetching page {page} of proxies from proxylist.geonode.com...")
+    with client_for(None).get(
+        GEONODE_API,
+        params={
+            "limit": limit,
+            "page": page,
+            "sort_by": "lastChecked",
+            "sort_type": "desc",
+            "country": "US",
+        },
         timeout=60,
     ) as r:
-        _CACHE = r.json()["data"]
-    logger.info(f"Fetched {len(_CACHE)} proxies.")
-    return cast(Sequence[dict], _CACHE)
+        r.raise_for_status()
+        body = r.json()
+    return body["data"], int(body.get("total") or 0)
+
+
+@dataclass
+class CatalogProxy:
+    id: str
+    ip: str
+    port: str
+    protocols: list[str] = field(default_factory=list)
+    successes: int = 0
+    failures: int = 0
+    latency: float | None = None  # of the last successful check, in seconds
+
+    @property
+    def urls(self) -> list[str]:
+        return [f"{protocol}://{self.ip}:{self.port}" for protocol in self.protocols]
+
+    @classmethod
+    def from_geonode(cls, proxy: dict[str, Any]) -> "CatalogProxy":
+        return cls(proxy["_id"], proxy["ip"], str(proxy["port"]), list(proxy["protocols"]))
+
+
+class ProxyCatalog:
+    """
+    The proxies from proxylist.geonode.com and how every one of them has done when checked, stored in SQLite so both
+    survive restarts.
+
+    The list is only fetched again once it is older than ``ttl``, a page at a time, and a fetch that gets interrupted
+    picks up where it left off. Until then, ``ranked`` answers from disk with the proxies that have worked best first.
+
+    Args:
+        path: Where the catalog lives. By default it is shared by every run on the machine.
+        ttl: How long a fetched list is good for, in seconds.
+    """
+
+    def __init__(
+        self, path: str | Path = DEFAULT_PROXY_CATALOG, *, ttl: float = DEFAULT_PROXY_TTL
+    ) -> None:
+        self.path = Path(path)
+        self.ttl = ttl
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "ProxyCatalog":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _meta(self, key: str) -> str | None:
+        row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_meta(self, key: str, value: Any) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+        )
 
+    def add(
+        self, proxies: Iterable[dict[str, Any]], now: float | None = None
+    ) -> list[CatalogProxy]:
+        """
+        Add or refresh proxies as geonode lists them. What is known about how they have done is kept.
+        """
+        now = now if now is not None else time()
+        added = [CatalogProxy.from_geonode(proxy) for proxy in proxies]
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                for proxy in added:
+                    self._connection.execute(
+                        "INSERT INTO proxies (id, ip, port, protocols, fetched) VALUES (?, ?, ?, ?, ?) "
+                        "ON CONFLICT (id) DO UPDATE SET ip = excluded.ip, port = excluded.port, "
+                        "protocols = excluded.protocols, fetched = excluded.fetched",
+                        (proxy.id, proxy.ip, proxy.port, json.dumps(proxy.protocols), now),
+                    )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return added
+
+    def ranked(self) -> list[CatalogProxy]:
+        """
+        Every proxy in the catalog, the ones most likely to work first: by how often they have passed a check, with
+        proxies that were never checked in between those that mostly work and those that mostly don't, then by how
+        fast they answered.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, ip, port, protocols, successes, failures, latency FROM proxies "
+                "ORDER BY (successes + 1.0) / (successes + failures + 2) DESC, "
+                "COALESCE(latency, 1e9), fetched DESC"
+            ).fetchall()
+        return [
+            CatalogProxy(id, ip, port, json.loads(protocols), successes, failures, latency)
+            for id, ip, port, protocols, successes, failures, latency in rows
+        ]
+
+    def record(
+        self, proxy_id: str, ok: bool, latency: float | None = None, now: float | None = None
+    ) -> None:
+        """
+        Remember how a check of a proxy went.
+        """
+        with self._lock:
+            if ok:
+                self._connection.execute(
+                    "UPDATE proxies SET successes = successes + 1, latency = ?, last_success = ? "
+                    "WHERE id = ?",
+                    (latency, now if now is not None else time(), proxy_id),
+                )
+            else:
+                self._connection.execute(
+                    "UPDATE proxies SET failures = failures + 1 WHERE id = ?", (proxy_id,)
+                )
+
+    def needs_refresh(self, now: float | None = None) -> bool:
+        with self._lock:
+            refreshed = self._meta("refreshed")
+        return (
+            refreshed is None or (now if now is not None else time()) - float(refreshed) > self.ttl
+        )
+
+    def refresh(
+        self,
+        *,
+        fetch_page: Callable[[int, int], tuple[list[dict], int]] = _fetch_proxy_page,
+        on_page: Callable[[list[CatalogProxy]], None] | None = None,
+        until: Callable[[], bool] | None = None,
+        now: float | None = None,
+    ) -> bool:
+        """
+        Fetch the list again, page by page, adding every page as it comes in.
 
-def setup_proxy_for_requests(session: Session, proxy: str | None = None) -> None:
+        Once every page has been fetched, proxies that weren't on the list anymore and haven't worked within ``ttl``
+        are dropped.
+
+        Args:
+            fetch_page: Fetches a page of proxies and says how many there are in total.
+            on_page: Called with the proxies of every page as it comes in.
+            until: Stop between pages once this is true. The next refresh carries on from there.
+
+        Returns:
+            True if every page was fetched.
+        """
+        now = now if now is not None else time()
+        with self._lock:
+            started = self._meta("refresh_started")
+            next_page = self._meta("next_page")
+        if started is not None and next_page is not None and now - float(started) <= self.ttl:
+            page = int(next_page)
+            started_at = float(started)
+            logger.info(f"Resuming the proxy list from page {page}...")
+        else:
+            page = 1
+            started_at = now
+            with self._lock:
+                self._set_meta("refresh_started", started_at)
+        while True:
+            if until is not None and until():
+                with self._lock:
+                    self._set_meta("next_page", page)
+                return False
+            proxies, total = fetch_page(page, GEONODE_PAGE_SIZE)
+            added = self.add(proxies, now)
+            if on_page is not None:
+                on_page(added)
+            if (
+                len(proxies) < GEONODE_PAGE_SIZE
+                or page * GEONODE_PAGE_SIZE >= total
+                or page >= GEONODE_MAX_PAGES
+            ):
+                break
+            page += 1
+        with self._lock:
+            pruned = self._connection.execute(
+                "DELETE FROM proxies WHERE fetched < ? AND (last_success IS NULL OR last_success < ?)",
+                (started_at, now - self.ttl),
+            ).rowcount
+            self._set_meta("refreshed", now)
+            self._connection.execute(
+                "DELETE FROM meta WHERE key IN ('refresh_started', 'next_page')"
+            )
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM proxies").fetchone()
+        logger.info(f"The proxy catalog has {count} proxies, {pruned} dropped.")
+        return True
+
+
+def setup_proxy_for_requests(session: requests.Session, proxy: str | None = None) -> None:
     if proxy is None:
         return
 
@@ -58,68 +293,119 @@ def setup_proxy_for_requests(session: Session, proxy: str | None = None) -> None
     session.proxies.update(proxies)
 
 
-def fetch_working_geonode_proxy() -> str:
+def fetch_working_geonode_proxy(catalog: ProxyCatalog | None = None) -> str:
     """
-    Get a random SOCKS5 proxy from proxylist.geonode.com.
-    Returns: A SOCKS5 proxy.
+    Get a working proxy from proxylist.geonode.com.
+
+    Proxies are tried from the catalog first, best first, with no need to wait for the list. If the list is older
+    than the catalog's TTL, it is fetched again while those are being tried, and every page is tried as it comes in.
+    If the list can't be fetched, the proxies that are already known are still tried. How every check went is saved to
+    the catalog for next time.
 
+    Args:
+        catalog: Where proxies and their history are kept. By default, the shared catalog on this machine.
+
+    Returns: A proxy URL.
+
+    Raises:
+        RuntimeError: If every proxy was tried and none worked
     """
-    global _CACHE, _USED
+    global _USED
+
+    own_catalog = catalog is None
+    if catalog is None:
+        catalog = ProxyCatalog()
 
     proxy_found = Event()
     good_proxy: str | None = None
+    checks: list[Future] = []
 
-    with ThreadPoolExecutor(
-        thread_name_prefix="ProxySearch", max_workers=64
-    ) as executor, Session() as session:
+    try:
+        # every candidate is a different proxy, so there is nothing to reuse between them; one pooled client still
+        # saves a lookup and a handshake per candidate on the way to each proxy
+        with ThreadPoolExecutor(
+            thread_name_prefix="ProxySearch", max_workers=64
+        ) as executor, HttpClient(pool_maxsize=64) as client:
 
-        def _try_proxy(proxy_with_protocol: str) -> bool:
-            nonlocal good_proxy
+            def _try_proxy(proxy: CatalogProxy) -> bool:
+                nonlocal good_proxy
 
-            logger.debug(f"Trying proxy {proxy_with_protocol}...")
+                # a proxy is tried over each of its protocols in turn, and the catalog hears about it once
+                for proxy_with_protocol in proxy.urls:
+                    if proxy_found.is_set():
+                        return False  # not a failure, it just wasn't needed
 
-            try:
-                with session.get(
-                    "https://api.ipify.org",
-                    timeout=30,
-                    proxies={"http": proxy_with_protocol, "https": proxy_with_protocol},
-                ) as r:
-                    if not proxy_found.is_set() and r.ok:
+                    logger.debug(f"Trying proxy {proxy_with_protocol}...")
+
+                    began = monotonic()
+                    try:
+                        with client.get(
+                            "https://api.ipify.org",
+                            timeout=30,
+                            proxies={"http": proxy_with_protocol, "https": proxy_with_protocol},
+                        ) as r:
+                            if not r.ok:
+                                continue
+                    except (
+                        requests.exceptions.ProxyError,
+                        requests.exceptions.ConnectTimeout,
+                        requests.exceptions.ReadTimeout,
+                        requests.exceptions.ConnectionError,
+                    ) as e:
+                        continue
+
+                    catalog.record(proxy.id, True, monotonic() - began)
+                    if not proxy_found.is_set():
                         proxy_found.set()  # no need for a lock?
                         good_proxy = proxy_with_protocol
                         return True
-                    else:
-                        return False
-            except (
-                requests.exceptions.ProxyError,
-                requests.exceptions.ConnectTimeout,
-                requests.exceptions.ReadTimeout,
-                requests.exceptions.ConnectionError,
-            ) as e:
+                    return False
+
+                catalog.record(proxy.id, False)
                 return False
 
-        for proxy in _CACHE or _fetch_proxies():
-            if proxy["_id"] not in _USED:
-                _USED.add(proxy["_id"])
-            else:
-                continue
+            def _try_proxies(proxies: Sequence[CatalogProxy]) -> None:
+                for proxy in proxies:
+                    if proxy.id not in _USED:
+                        _USED.add(proxy.id)
+                    else:
+                        continue
+
+                    checks.append(executor.submit(_try_proxy, proxy))
 
-            host = proxy["ip"]
-            port = proxy["port"]
-            for protocol in proxy["protocols"]:
-                executor.submit(partial(_try_proxy, f"{protocol}://{host}:{port}"))
+            _try_proxies(catalog.ranked())
+            if catalog.needs_refresh():
+                try:
+                    catalog.refresh(on_page=_try_proxies, until=proxy_found.is_set)
+                except Exception as e:
+                    logger.warning(
+                        f"Could not fetch the proxy list, trying the {len(checks)} proxies at hand: {e}"
+                    )
 
-        proxy_found.wait()
-        executor.shutdown(wait=False, cancel_futures=True)
-        logger.info(f"Proxy {good_proxy} succeeded, using...")
-        return good_proxy
+            for check in as_completed(checks):
+                if check.exception() is None and check.result():
+                    break
+            executor.shutdown(wait=False, cancel_futures=True)
+            if good_proxy is None:
+                raise RuntimeError(f"None of the {len(checks)} proxies tried worked")
+            logger.info(f"Proxy {good_proxy} succeeded, using...")
+            return good_proxy
+    finally:
+        if own_catalog:
+            catalog.close()
 
 
 def ip_of(proxy: str) -> str:
-    with Session() as s:
-        setup_proxy_for_requests(s, proxy)
-        with s.get("https://api.ipify.org") as r:
-            return r.text
+    with client_for(proxy).get("https://api.ipify.org", timeout=60) as r:
+        return r.text
 
 
-__all__ = ("fetch_working_geonode_proxy", "setup_proxy_for_requests", "ip_of")
+__all__ = (
+    "DEFAULT_PROXY_CATALOG",
+    "DEFAULT_PROXY_TTL",
+    "CatalogProxy",
+    "ProxyCatalog",
+    "fetch_working_geonode_proxy",
+    "setup_proxy_for_requests",
+    "ip_of",
+)
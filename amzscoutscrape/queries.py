@@ -0,0 +1,137 @@
+"""
+Query sources for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+import sys
+from hashlib import blake2b
+from itertools import islice
+from typing import Iterable, Iterator
+
+from . import AmzscoutscrapeAssets
+
+logger = logging.getLogger(__package__)
+
+STDIN = "-"
+
+
+def read_queries(source: str | None = None) -> Iterator[str]:
+    """
+    Lazily read queries, one per line, skipping blank lines.
+
+    Args:
+        source: A path to a file of queries, "-" for stdin, or None for the bundled list.
+    """
+    if source == STDIN:
+        yield from _stripped(sys.stdin)
+        return
+
+    path = AmzscoutscrapeAssets.path("amazon_products.txt") if source is None else source
+    with open(path, "r", encoding="utf-8") as fp:
+        yield from _stripped(fp)
+
+
+def _stripped(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        if query := line.strip():
+            yield query
+
+
+def _digest(query: str) -> bytes:
+    # Python's hash() is salted per process, which is useless for splitting work between hosts
+    return blake2b(query.encode("utf-8"), digest_size=8).digest()
+
+
+def deduplicate(queries: Iterable[str]) -> Iterator[str]:
+    """
+    Drop queries that have already been seen.
+
+    Only an 8-byte digest of each query is remembered, so this stays small on huge keyword files.
+    """
+    seen: set[bytes] = set()
+    for query in queries:
+        digest = _digest(query)
+        if digest in seen:
+            continue
+        seen.add(digest)
+        yield query
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """
+    Parse a shard spec like "0/4" into an (index, count) pair. Indexes start at 0.
+
+    Raises:
+        ValueError: If the spec is malformed or the index is out of range
+    """
+    try:
+        index_str, count_str = spec.split("/")
+        index, count = int(index_str), int(count_str)
+    except ValueError:
+        raise ValueError(f"Invalid shard {spec!r}, expected something like 0/4") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {spec!r}, the index must be between 0 and {count - 1}")
+    return index, count
+
+
+def shard_of(query: str, count: int) -> int:
+    """
+    The shard a query belongs to. This is stable across processes, hosts and Python versions.
+    """
+    return int.from_bytes(_digest(query), "big") % count
+
+
+def select_shard(queries: Iterable[str], index: int, count: int) -> Iterator[str]:
+    return (query for query in queries if shard_of(query, count) == index)
+
+
+def query_stream(
+    source: str | None = None,
+    *,
+    skip: int = 0,
+    limit: int = -1,
+    shard: tuple[int, int] | None = None,
+    dedupe: bool = True,
+) -> Iterator[str]:
+    """
+    Build the stream of queries a run should work through.
+
+    Sharding happens before skipping, so --skip resumes a run within its own shard.
+
+    Args:
+        source: See ``read_queries``.
+        skip: How many queries to skip ahead.
+        limit: How many queries to yield at most. Negative means all of them.
+        shard: An (index, count) pair from ``parse_shard``.
+        dedupe: Drop repeated queries.
+    """
+    queries: Iterator[str] = read_queries(source)
+    if shard is not None:
+        queries = select_shard(queries, *shard)
+    if dedupe:
+        queries = deduplicate(queries)
+    return islice(queries, skip, None if limit < 0 else skip + limit)
+
+
+__all__ = (
+    "read_queries",
+    "deduplicate",
+    "parse_shard",
+    "shard_of",
+    "select_shard",
+    "query_stream",
+)
@@ -0,0 +1,163 @@
+"""
+Offline re-parsing of archived snapshots for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+import json
+import logging
+from dataclasses import dataclass
+from multiprocessing import Pool
+from pathlib import Path
+
+from . import thumbnails
+from .archive import QuerySnapshot, SnapshotArchive
+from .devtools import CapturedResponse, products_by_asin
+from .output import open_output
+from .scrape import (
+    attach_api_data,
+    parse_listing_html,
+    parse_product_page,
+    products_from_api,
+)
+from .thumbnails import THUMBNAIL_FORMATS, to_data_uri, transcode
+
+logger = logging.getLogger(__package__)
+
+
+@dataclass
+class _Job:
+    root: str
+    snapshot: QuerySnapshot
+    thumbnail_format: str
+    thumbnail_size: int
+    thumbnail_quality: int
+
+
+def _reparse_snapshot(job: _Job) -> tuple[list[str], list[list[str]]]:
+    archive = SnapshotArchive(job.root)
+    snapshot = job.snapshot
+    if snapshot.listing is None:
+        return [], []
+    column_names, products = parse_listing_html(archive.get_text(snapshot.listing))
+
+    if snapshot.responses is not None:
+        responses = json.loads(archive.get_text(snapshot.responses))
+        api_products = products_by_asin(CapturedResponse(**response) for response in responses)
+        # the live scrape built its rows from the responses whenever it could, and so do we
+        if api_products:
+            try:
+                products = products_from_api(column_names, api_products)
+            except ValueError:
+                attach_api_data(products, api_products)
+
+    rows: list[list[str]] = []
+    for product in products:
+        # the live scrape left out products whose page it couldn't read, and so do we
+        if product.url not in snapshot.products:
+            continue
+        product.description, product.about, product.manufacturer = parse_product_page(
+            archive.get_text(snapshot.products[product.url])
+        )
+        if product.image_url is not None and product.image_url in snapshot.images:
+            digest, content_type = snapshot.images[product.image_url]
+            data = archive.get(digest)
+            try:
+                data, content_type = transcode(
+                    data,
+                    content_type,
+                    job.thumbnail_format,
+                    job.thumbnail_size,
+                    job.thumbnail_quality,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Could not transcode a {content_type} thumbnail, keeping it as-is: {e}"
+                )
+            product.thumbnail = to_data_uri(data, content_type)
+        rows.append(product.to_csv_row())
+    return column_names, rows
+
+
+def reparse(
+    root: str | Path,
+    destination: str | Path,
+    *,
+    processes: int | None = None,
+    level: int | None = None,
+    thumbnail_format: str = "passthrough",
+    thumbnail_size: int = 160,
+    thumbnail_quality: int = 60,
+) -> tuple[int, int]:
+    """
+    Produce a dataset again from an archive, without a browser or the network.
+
+    Snapshots are parsed in a pool of processes, so this runs as fast as the CPUs allow.
+    Rows come out in the order the queries were scraped. Snapshots taken with either extraction mode share a header,
+    but every snapshot's panel must have had the same columns, since they all go under the first one's header.
+
+    Args:
+        root: The archive's directory.
+        destination: Where to write. A .gz or .zst suffix turns on compression.
+        processes: How many processes parse at once. Defaults to one per CPU.
+        level: The compression level.
+        thumbnail_format: Re-encode thumbnails as "webp" or "jpeg", or keep them as they were with "passthrough".
+        thumbnail_size: The largest width or height a re-encoded thumbnail may have, in pixels.
+        thumbnail_quality: The encoder quality (0-100) for re-encoded thumbnails.
+
+    Returns:
+        The number of queries and rows.
+
+    Raises:
+        ValueError: If a snapshot's columns differ from those of the snapshots before it, whose rows are
+            already written.
+    """
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        raise ValueError(
+            f"Invalid thumbnail format {thumbnail_format!r}, expected one of {', '.join(THUMBNAIL_FORMATS)}"
+        )
+    if thumbnail_format != "passthrough" and thumbnails.Image is None:
+        raise ImportError(
+            "Transcoding thumbnails requires Pillow. Install amzscoutscrape[thumbnails]."
+        )
+    archive = SnapshotArchive(root)
+    snapshots = list(archive.snapshots())
+    jobs = (
+        _Job(str(archive.root), snapshot, thumbnail_format, thumbnail_size, thumbnail_quality)
+        for snapshot in snapshots
+    )
+
+    queries = 0
+    written = 0
+    header: list[str] | None = None
+    with open_output(destination, level=level) as fp, Pool(processes) as pool:
+        csv_writer = csv.writer(fp, dialect="excel")
+        for snapshot, (column_names, rows) in zip(snapshots, pool.imap(_reparse_snapshot, jobs)):
+            queries += 1
+            if column_names and header is None:
+                header = column_names
+                csv_writer.writerow(header)
+            elif column_names and column_names != header:
+                raise ValueError(
+                    f"The snapshot of {snapshot.query!r} has other columns than the ones before it: "
+                    f"{', '.join(column_names)}. Was the AMZScout panel set up differently?"
+                )
+            csv_writer.writerows(rows)
+            written += len(rows)
+    return queries, written
+
+
+__all__ = ("reparse",)
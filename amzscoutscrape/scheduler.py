@@ -0,0 +1,308 @@
+"""
+Query scheduling for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import heapq
+import logging
+import sqlite3
+from dataclasses import dataclass, field
+from itertools import count
+from pathlib import Path
+from time import sleep, time
+from typing import Hashable, Iterable, Iterator
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_QUERY_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF = 60.0
+DEFAULT_LOOKAHEAD = 1000
+# a query scraped this long ago is worth as much as one that was never scraped
+STALE_AFTER = 7 * 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    query TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    successes INTEGER NOT NULL DEFAULT 0,
+    rows INTEGER NOT NULL DEFAULT 0,
+    last_success REAL,
+    last_error TEXT
+);
+"""
+
+
+@dataclass(frozen=True)
+class QueryRecord:
+    attempts: int = 0
+    successes: int = 0
+    rows: int = 0
+    last_success: float | None = None
+
+    @property
+    def mean_yield(self) -> float | None:
+        return self.rows / self.successes if self.successes else None
+
+
+class QueryHistory:
+    """
+    How every query has done across runs, stored in SQLite.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "QueryHistory":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def get(self, query: str) -> QueryRecord:
+        row = self._connection.execute(
+            "SELECT attempts, successes, rows, last_success FROM history WHERE query = ?",
+            (query,),
+        ).fetchone()
+        return QueryRecord(*row) if row is not None else QueryRecord()
+
+    def mean_yield(self) -> float | None:
+        """
+        The mean number of rows a successful query produces, over every query.
+        """
+        (rows, successes) = self._connection.execute(
+            "SELECT SUM(rows), SUM(successes) FROM history"
+        ).fetchone()
+        return rows / successes if successes else None
+
+    def record_success(self, query: str, rows: int | None) -> None:
+        self._connection.execute(
+            "INSERT INTO history (query, attempts, successes, rows, last_success) VALUES (?, 1, ?, ?, ?) "
+            "ON CONFLICT (query) DO UPDATE SET attempts = attempts + 1, "
+            "successes = successes + excluded.successes, rows = rows + excluded.rows, "
+            "last_success = excluded.last_success",
+            # a success with no row count doesn't count towards the yield
+            (query, int(rows is not None), rows or 0, time()),
+        )
+
+    def record_failure(self, query: str, error: str) -> None:
+        self._connection.execute(
+            "INSERT INTO history (query, attempts, last_error) VALUES (?, 1, ?) "
+            "ON CONFLICT (query) DO UPDATE SET attempts = attempts + 1, last_error = excluded.last_error",
+            (query, error),
+        )
+
+
+def read_priorities(path: str | Path) -> dict[str, float]:
+    """
+    Read user-assigned priorities, one ``query<TAB>priority`` per line. Higher goes first, and the default is 0.
+
+    Raises:
+        ValueError: If a line has no priority, or it isn't a number
+    """
+    priorities: dict[str, float] = {}
+    with open(path, "r", encoding="utf-8") as fp:
+        for number, line in enumerate(fp, 1):
+            if not line.strip():
+                continue
+            query, _, priority = line.rstrip("\n").rpartition("\t")
+            try:
+                priorities[query.strip()] = float(priority)
+            except ValueError:
+                raise ValueError(
+                    f"{path}:{number}: expected a query, a tab and a priority, got {line!r}"
+                ) from None
+    return priorities
+
+
+@dataclass(order=True)
+class Task:
+    """
+    A query waiting to be scraped. Tasks sort in the order they should be handed out.
+    """
+
+    key: tuple[float, float]
+    sequence: int
+    query: str = field(compare=False)
+    attempt: int = field(default=1, compare=False)
+    # the worker this query last failed on, which it won't be handed to again if anything else can take it
+    avoid: Hashable | None = field(default=None, compare=False)
+    not_before: float = field(default=0.0, compare=False)
+
+
+class QueryScheduler:
+    """
+    Hands out queries in priority order, and requeues the ones that fail.
+
+    Queries are ordered by their user-assigned priority, then by how many rows they can be expected to bring in now:
+    how many they have yielded before, scaled by how long ago they were last scraped, so a productive query that
+    hasn't been scraped in a while goes before one that was scraped yesterday. Only ``lookahead`` queries are read
+    ahead of time, so a huge query file is ordered a window at a time.
+
+    A failed query waits ``retry_backoff`` seconds, doubling with every attempt, and is then handed to a different
+    worker than the one it failed on if possible. After ``max_attempts`` it is given up on.
+
+    Iterating yields tasks for ``worker``, which the caller sets to whatever is scraping right now, until there is
+    nothing left to do. When the only work that is ready failed on the current worker, it is handed out anyway with
+    ``avoid`` set to that worker, so the caller knows to switch.
+
+    Args:
+        queries: The queries to scrape.
+        history: Where to look up and record how queries have done. Without it, only priorities count.
+        priorities: User-assigned priorities by query.
+    """
+
+    def __init__(
+        self,
+        queries: Iterable[str],
+        *,
+        history: QueryHistory | None = None,
+        priorities: dict[str, float] | None = None,
+        max_attempts: int = DEFAULT_QUERY_ATTEMPTS,
+        retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+        lookahead: int = DEFAULT_LOOKAHEAD,
+    ) -> None:
+        self.history = history
+        self.priorities = priorities or {}
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lookahead = lookahead
+        self.worker: Hashable | None = None
+        self.given_up: list[str] = []
+        self._queries = iter(queries)
+        self._exhausted = False
+        self._ready: list[Task] = []
+        self._waiting: list[tuple[float, int, Task]] = []
+        self._sequence = count()
+        self._default_yield = (history.mean_yield() if history is not None else None) or 1.0
+
+    def score(self, query: str, now: float | None = None) -> tuple[float, float]:
+        """
+        The sort key of a query. Lower goes first.
+        """
+        priority = self.priorities.get(query, 0.0)
+        if self.history is None:
+            return -priority, 0.0
+        record = self.history.get(query)
+        expected = record.mean_yield if record.mean_yield is not None else self._default_yield
+        if record.last_success is not None:
+            age = (now if now is not None else time()) - record.last_success
+            expected *= min(max(age, 0.0) / STALE_AFTER, 1.0)
+        return -priority, -expected
+
+    def _fill(self) -> None:
+        while not self._exhausted and len(self._ready) < self.lookahead:
+            query = next(self._queries, None)
+            if query is None:
+                self._exhausted = True
+                return
+            heapq.heappush(self._ready, Task(self.score(query), next(self._sequence), query))
+
+    def _release(self, now: float) -> None:
+        while self._waiting and self._waiting[0][0] <= now:
+            _, _, task = heapq.heappop(self._waiting)
+            heapq.heappush(self._ready, task)
+
+    @property
+    def pending(self) -> int:
+        return len(self._ready) + len(self._waiting)
+
+    def take(self, worker: Hashable | None = None, now: float | None = None) -> Task | None:
+        """
+        The next task for a worker, or None if nothing is ready.
+        """
+        self._release(now if now is not None else time())
+        self._fill()
+        if not self._ready:
+            return None
+        if self._ready[0].avoid is not None and self._ready[0].avoid == worker:
+            # something that didn't fail on this worker goes first if there is anything
+            for i, task in enumerate(self._ready):
+                if task.avoid != worker:
+                    self._ready[i] = self._ready[-1]
+                    self._ready.pop()
+                    heapq.heapify(self._ready)
+                    return task
+        return heapq.heappop(self._ready)
+
+    def wait(self, now: float | None = None) -> float | None:
+        """
+        How long until a requeued query is ready, or None if nothing is waiting.
+        """
+        if not self._waiting:
+            return None
+        return max(self._waiting[0][0] - (now if now is not None else time()), 0.0)
+
+    def succeeded(self, task: Task, rows: int | None = None) -> None:
+        if self.history is not None:
+            self.history.record_success(task.query, rows)
+
+    def failed(
+        self, task: Task, error: str, worker: Hashable | None = None, now: float | None = None
+    ) -> bool:
+        """
+        Record a failure, and requeue the query if it has attempts left.
+
+        Returns:
+            True if the query will be retried.
+        """
+        if self.history is not None:
+            self.history.record_failure(task.query, error)
+        if task.attempt >= self.max_attempts:
+            logger.warning(f"Giving up on {task.query!r} after {task.attempt} attempts: {error}")
+            self.given_up.append(task.query)
+            return False
+        delay = self.retry_backoff * 2 ** (task.attempt - 1)
+        not_before = (now if now is not None else time()) + delay
+        retry = Task(
+            task.key,
+            task.sequence,
+            task.query,
+            attempt=task.attempt + 1,
+            avoid=worker,
+            not_before=not_before,
+        )
+        heapq.heappush(self._waiting, (not_before, next(self._sequence), retry))
+        logger.info(f"Retrying {task.query!r} in {delay:.0f} seconds")
+        return True
+
+    def __iter__(self) -> Iterator[Task]:
+        while True:
+            task = self.take(self.worker)
+            if task is not None:
+                yield task
+                continue
+            wait = self.wait()
+            if wait is None:
+                return
+            logger.info(f"Waiting {wait:.0f} seconds for a query to retry...")
+            sleep(wait)
+
+
+__all__ = (
+    "DEFAULT_QUERY_ATTEMPTS",
+    "DEFAULT_RETRY_BACKOFF",
+    "QueryRecord",
+    "QueryHistory",
+    "read_priorities",
+    "Task",
+    "QueryScheduler",
+)
@@ -16,56 +16,267 @@ or implied. See the License for the specific language governing
 permissions and limitations under the License.
 
 """
-import base64
+import json
 import logging
-from time import sleep, time
-from urllib.parse import urlencode
+import re
+from contextlib import nullcontext
+from dataclasses import dataclass
+from threading import Lock
+from time import time
+from typing import Any, Callable, Sequence
+from urllib.parse import urlencode, urljoin
+from weakref import WeakKeyDictionary
 
 from _csv import Writer
 from bs4 import BeautifulSoup
-from requests import Session as RequestsSession
+from requests import Timeout as RequestsTimeout
 from selenium.common import NoSuchElementException, StaleElementReferenceException
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.timeouts import Timeouts
 from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.wait import WebDriverWait
 
-from .proxy import setup_proxy_for_requests
-from .utils import deprecated
+from .archive import SnapshotArchive
+from .blocking import apply_url_blocklist
+from .dbapi import DEFAULT_MAX_PAGES, DatabaseClient, learn_search_request, session_cookies
+from .devtools import PerformanceLog, ResponseCapture, products_by_asin
+from .httpclient import client_for
+from .pagetrace import NetworkTracer
+from .pipeline import Pipeline, Stage, StageMetrics
+from .thumbnails import ThumbnailTranscoder, to_data_uri
+from .tracing import phase
+from .utils import Deadline, current_deadline
 
 logger = logging.getLogger(__package__)
 
+# The sections of a product page that the deep scrape reads
+PRODUCT_SECTION_IDS = ("productDescription", "feature-bullets", "aplus")
+# "dom" reads the panel's table, "api" reads the responses the panel was filled from instead
+EXTRACTION_MODES = ("dom", "api")
+# every row ends with this column, so rows from either extraction mode fit under one header
+API_DATA_COLUMN = "API Data"
+# "#", the thumbnail, name, URL and the three deep scrape sections come before the panel's metrics
+_LEADING_COLUMNS = 7
+_ASIN_PATTERN = re.compile(r"/(?:dp|gp/product)/([A-Z0-9]{10})")
+_CSS_URL_PATTERN = re.compile(r"url\(\s*['\"]?(.*?)['\"]?\s*\)")
+# The longest a single thumbnail download may take, deadline or not
+IMAGE_TIMEOUT = 30.0
+# Set on a document before navigating away from it, so the waits can tell it apart from the one that replaces it
+_STALE_DOCUMENT_MARKER = "__amzscoutScrapeStale"
+
+
+def asin_of(url: str) -> str | None:
+    """
+    Find the ASIN in an Amazon product URL.
+    """
+    match = _ASIN_PATTERN.search(url)
+    return match.group(1) if match is not None else None
 
-def search_and_write_amazon(
-    driver: WebDriver,
-    csv_writer: Writer,
-    query: str,
-    proxy: str | None = None,
-    *,
-    write_headers: bool = True,
-    write_data: bool = True,
-) -> None:
+
+def _navigate(driver: WebDriver, url: str) -> None:
     """
-    Search for a query and write the results to a CSV file.
+    Load a page, marking the current document first.
+
+    With the "none" page load strategy, ``get`` returns before the new document has replaced the old one, so the waits
+    below would otherwise be satisfied by the page we are leaving. The URL alone can't tell them apart, since the same
+    search or product may be loaded twice in a row.
+    """
+    driver.execute_script(f"window.{_STALE_DOCUMENT_MARKER} = true;")
+    driver.get(url)
+
+
+def _on_new_document(driver: WebDriver) -> bool:
+    return not driver.execute_script(f"return window.{_STALE_DOCUMENT_MARKER} === true;")
+
+
+def _wait_for_search_page(driver: WebDriver, wait: WebDriverWait) -> None:
+    """
+    Wait until the AMZScout button has been injected into the search page ``_navigate`` went to.
+    """
+    wait.until(_on_new_document)
+    wait.until(ec.element_to_be_clickable((By.TAG_NAME, "os-circle")))
+
+
+def _wait_for_product_page(driver: WebDriver, wait: WebDriverWait) -> None:
+    """
+    Wait until the sections we read from the product page ``_navigate`` went to are in the DOM.
+
+    Not every product has every section, so once the HTML has been fully parsed we stop waiting for the rest.
+    Subresources (images, scripts, etc.) are never waited for.
+    """
+    wait.until(_on_new_document)
+    wait.until(
+        lambda d: d.execute_script(
+            """
+            const ids = arguments[0];
+            const found = ids.filter(id => document.getElementById(id) !== null).length;
+            return found === ids.length || (document.readyState !== "loading" && document.body !== null);
+            """,
+            list(PRODUCT_SECTION_IDS),
+        )
+    )
+
+
+@dataclass
+class ProductRow:
+    """
+    One product from the AMZScout panel. It is filled in bit by bit as it moves through the scrape.
+    """
+
+    number: str
+    name: str
+    url: str
+    image_url: str | None
+    metrics: list[str]
+    image: tuple[bytes, str] | None = None  # the downloaded thumbnail and its content type
+    thumbnail: str = ""
+    description: str = ""
+    about: str = ""
+    manufacturer: str = ""
+    # only when the row was built from the panel's API responses
+    api_data: dict[str, Any] | None = None
+
+    def to_csv_row(self) -> list[str]:
+        return [
+            self.number,
+            self.thumbnail,
+            self.name,
+            self.url,
+            self.description,
+            self.about,
+            self.manufacturer,
+            *self.metrics,
+            json.dumps(self.api_data, separators=(",", ":")) if self.api_data is not None else "",
+        ]
+
+
+def _record_field(record: dict[str, Any], *names: str) -> str | None:
+    for key, value in record.items():
+        if key.lower() in names and isinstance(value, str) and value:
+            return value
+    return None
+
+
+def _normalized(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return json.dumps(value, separators=(",", ":"))
+
+
+API_COLUMN_FIELDS: dict[str, tuple[str, ...]] = {
+    "Brand": ("brand",),
+    "Price": ("price",),
+    "Category": ("category",),
+    "Rank": ("rank", "bsr"),
+    "Est. Sales": ("estimatedSales", "sales"),
+    "Est. Revenue": ("estimatedRevenue", "revenue"),
+    "Reviews": ("reviews", "reviewsCount"),
+    "Rating": ("rating",),
+    "RPR": ("rpr",),
+    "LQS": ("lqs",),
+    "Sellers": ("sellers", "sellersCount"),
+    "Product Tier": ("tier", "productTier"),
+    "Weight": ("weight",),
+    "Dimensions": ("dimensions",),
+    "Net": ("net", "netProfit"),
+    "FBA Fees": ("fbaFees", "fees"),
+    "Available From": ("availableFrom", "dateFirstAvailable"),
+}
+"""
+The record fields each of the panel's metric columns is filled from, in order of preference.
+
+Column names are matched ignoring case and punctuation, field names ignoring case.
+"""
+
+
+def _api_fields(column_name: str) -> tuple[str, ...] | None:
+    for name, fields in API_COLUMN_FIELDS.items():
+        if _normalized(name) == _normalized(column_name):
+            return tuple(field.lower() for field in fields)
+    return None
+
+
+def products_from_api(
+    column_names: Sequence[str], records: dict[str, dict[str, Any]]
+) -> list[ProductRow]:
+    """
+    Build the panel's rows from the product records of its API responses, in the order they came in.
+
+    Every metric column is filled from the record fields ``API_COLUMN_FIELDS`` lists for it, and is left empty for a
+    record that has none of them. The whole record is in the "API Data" column either way.
 
     Args:
-        driver:
-        csv_writer:
-        proxy:
-        query:
-        write_headers:
-        write_data:
+        column_names: The header, as ``_read_column_names`` or ``parse_listing_html`` read it.
+        records: The records by ASIN, from ``devtools.products_by_asin``.
 
-    Returns:
+    Raises:
+        ValueError: If a metric column isn't in ``API_COLUMN_FIELDS``, or no record has any of its fields. The table
+            has to be read instead.
+    """
+    metric_columns = [name for name in column_names[_LEADING_COLUMNS:] if name != API_DATA_COLUMN]
+    column_fields = [_api_fields(name) for name in metric_columns]
+    unmapped = [name for name, fields in zip(metric_columns, column_fields) if fields is None]
+    if unmapped:
+        raise ValueError(f"No API fields are known for the columns {', '.join(unmapped)}")
+    field_names = {key.lower() for record in records.values() for key in record}
+    missing = [
+        name
+        for name, fields in zip(metric_columns, column_fields)
+        if not field_names.intersection(fields)
+    ]
+    if missing:
+        raise ValueError(f"No API record has a field for the columns {', '.join(missing)}")
+
+    products: list[ProductRow] = []
+    for number, (asin, record) in enumerate(records.items(), 1):
+        fields = {key.lower(): value for key, value in record.items()}
+        products.append(
+            ProductRow(
+                str(number),
+                _record_field(record, "title", "name", "productname") or "",
+                _record_field(record, "url", "link") or f"https://www.amazon.com/dp/{asin}",
+                _record_field(record, "image", "imageurl", "img"),
+                [
+                    _cell(next((fields[field] for field in names if field in fields), None))
+                    for names in column_fields
+                ],
+                api_data=record,
+            )
+        )
+    return products
+
+
+def attach_api_data(products: list[ProductRow], records: dict[str, dict[str, Any]]) -> None:
+    """
+    Put each product's API record in the "API Data" column of rows read from the table.
 
+    Args:
+        products: The rows, read from the table.
+        records: The records by ASIN, from ``devtools.products_by_asin``.
     """
-    wait = WebDriverWait(driver, driver.timeouts.implicit_wait)
-    # TODO: replace timeout dependent code with WebDriverWait
-    timeout = driver.timeouts.implicit_wait
-    logger.info(f"Searching for {query!r}...")
+    for product in products:
+        product.api_data = records.get(asin_of(product.url) or "")
+
 
-    driver.get("https://www.amazon.com/s?" + urlencode({"k": query}))
-    amazon_window_handle = driver.current_window_handle
+def _open_amzscout_panel(driver: WebDriver, wait: WebDriverWait, query: str) -> WebElement:
+    """
+    Search Amazon for a query and open the AMZScout panel on the results.
+
+    Returns:
+        The panel's app wrapper.
+    """
+    _navigate(driver, "https://www.amazon.com/s?" + urlencode({"k": query}))
+    _wait_for_search_page(driver, wait)
 
     # open the menu
     driver.find_element(By.TAG_NAME, "os-circle").click()
@@ -77,50 +288,52 @@ def search_and_write_amazon(
     driver.execute_script(
         """
         let ad = document.getElementsByTagName("ad")[0];
-        ad.parentNode.removeChild(ad); // do NOT return, it crashes selenium
+        if (ad) ad.parentNode.removeChild(ad); // do NOT return, it crashes selenium
     """
     )
 
     # get the AMZScout window (again) make sure we don't have a stale reference
-    appwrap = driver.find_element(By.TAG_NAME, "amzscout-pro").find_element(
-        By.CLASS_NAME, "l-appwrap"
-    )
-
-    # TODO: if we wanted to enable more headers or change any other options, we could do it here
+    return driver.find_element(By.TAG_NAME, "amzscout-pro").find_element(By.CLASS_NAME, "l-appwrap")
 
-    # no stale protection needed here
-    if write_headers:
-        # We need to get the column names so that DA will be easier
-        header = appwrap.find_element(By.CLASS_NAME, "maintable-header")
-        column_names: list[str] = []
-        for i, col in enumerate(header.find_elements(By.CLASS_NAME, "ng-binding")):
-            # i = 0: #
-            # i = 1: Product Name
 
-            # We need to inject our "thumbnail image" and "description"
+def _read_column_names(appwrap: WebElement) -> list[str]:
+    # We need to get the column names so that DA will be easier
+    header = appwrap.find_element(By.CLASS_NAME, "maintable-header")
+    return _expand_column_names(
+        [col.text for col in header.find_elements(By.CLASS_NAME, "ng-binding")]
+    )
 
-            if i != 1:
-                column_names.append(col.text)
-            else:
-                # this is the title column
-                # special cases
-                column_names.append("Thumbnail Image")
-                column_names.append("Product Name")
-                column_names.append("URL")
-                column_names.append("Description")
-                column_names.append("About this item")
-                column_names.append("From the manufacturer")
-        logger.info(f"Saving {len(column_names)} columns: {', '.join(column_names)}")
-        csv_writer.writerow(column_names)
 
-    if not write_data:
-        return  # skip the rest of the function
+def _expand_column_names(header_texts: Sequence[str]) -> list[str]:
+    column_names: list[str] = []
+    for i, text in enumerate(header_texts):
+        # i = 0: #
+        # i = 1: Product Name
 
-    maintable = appwrap.find_element(By.CLASS_NAME, "maintable")
+        # We need to inject our "thumbnail image" and "description"
 
+        if i != 1:
+            column_names.append(text)
+        else:
+            # this is the title column
+            # special cases
+            column_names.append("Thumbnail Image")
+            column_names.append("Product Name")
+            column_names.append("URL")
+            column_names.append("Description")
+            column_names.append("About this item")
+            column_names.append("From the manufacturer")
+    column_names.append(API_DATA_COLUMN)
+    return column_names
+
+
+def _wait_for_listing(
+    driver: WebDriver, maintable: WebElement, timeout: float, budget: Deadline
+) -> None:
     # wait for the spinner(s) to go away
     spinner_wait_start = time()
     while True:
+        budget.check("waiting for the panel's spinners")
         # global spinner
         if "ng-hide" not in (
             driver.find_element(By.TAG_NAME, "amzscout-pro")
@@ -128,7 +341,7 @@ def search_and_write_amazon(
             .find_element(By.CSS_SELECTOR, "div.spinner.centered")
         ).get_attribute("class").split(" "):
             # the spinner not is hidden, we have to wait
-            sleep(0.1)
+            budget.sleep(0.1)
             continue
 
         continue_nonlocal = False  # if we should continue the outer loop
@@ -145,7 +358,7 @@ def search_and_write_amazon(
                 continue_nonlocal = True
                 break
         if continue_nonlocal:
-            sleep(0.1)
+            budget.sleep(0.1)
             continue
 
         break
@@ -157,131 +370,183 @@ def search_and_write_amazon(
     # this takes FOREVER to load, so we need to wait at least this much time
     if spinner_wait_time < dynamic_timeout:
         # we have waited less than the timeout, we should wait until more load in
-        sleep(dynamic_timeout - spinner_wait_time)
+        budget.sleep(dynamic_timeout - spinner_wait_time)
 
     # From here on out, we are just screenscraping and don't need to click anything
     # To prevent stale element references, we are going to stop any currently running javascript
     driver.execute_script("window.stop();")
 
-    with RequestsSession() as s:
-        # initialize the session with data from the driver
-        # s.cookies.update({c["name"]: c["value"] for c in driver.get_cookies()})  # unnecessary
-        s.headers.update({"User-Agent": driver.execute_script("return navigator.userAgent")})
-        setup_proxy_for_requests(s, proxy)
-        # ok, lets scrape!
-        rows_scraped = 0
-        for i, row in enumerate(maintable.find_elements(By.CLASS_NAME, "maintable__row")):
-            columns: list[str] = []
+
+def _read_listing_row(row: WebElement) -> ProductRow:
+    number = ""
+    name = ""
+    url = ""
+    image_url: str | None = None
+    metrics: list[str] = []
+    for j, col in enumerate(row.find_elements(By.CLASS_NAME, "scout-col")):
+        if j < 2:  # skip the first two columns, they are not important
+            continue
+        # j = 2: number
+        # j = 3: title & image
+        if j == 2:
+            number = col.text
+        elif j != 3:
+            metrics.append(col.text)
+        else:
             try:
-                for j, col in enumerate(row.find_elements(By.CLASS_NAME, "scout-col")):
-                    if j < 2:  # skip the first two columns, they are not important
-                        continue
-                    # j = 2: number
-                    # j = 3: title & image
-                    try:
-                        if j != 3:
-                            columns.append(col.text)
-                        else:
-                            # column_names.append("Thumbnail Image")
-                            try:
-                                image_css = col.find_element(
-                                    By.CSS_SELECTOR, "span.preview-img.ng-scope"
-                                ).value_of_css_property("background-image")
-                            except NoSuchElementException:
-                                image_css = "none"
-                            if image_css == "none":
-                                image_b64 = ""
-                            else:
-                                # this will be something like 'url("https://m.media-amazon.com/images/I/71Pn98gmz3L._SL300_.jpg")'
-                                image_url = image_css.split('"')[1]
-                                # this will be something like 'https://m.media-amazon.com/images/I/71Pn98gmz3L._SL300_.jpg'
-                                # we need to download the image and convert it to base64
-                                image_response = s.get(image_url)
-                                image_b64_string = base64.b64encode(image_response.content).decode(
-                                    "utf-8"
-                                )
-                                image_b64 = f"data:{image_response.headers['Content-Type']};base64,{image_b64_string}"
-
-                            columns.append(image_b64)
-
-                            # column_names.append("Product Name")
-                            a = col.find_element(By.CSS_SELECTOR, "a.ng-binding")
-                            product_name = a.text
-
-                            columns.append(product_name)
-
-                            # column_names.append("URL")
-                            short_url = a.get_attribute("href")
-
-                            columns.append(short_url)
-
-                            # OK, lets work on scraping the description & other data
-                            # gotta fetch it with the full url
-                            # i wanted to use requests & soup for this but it doesn't work perfect due to amazon's
-                            # bot screening & the description being super odd & dynamic
-                            logger.info(f"Deep scraping {product_name} ({short_url})...")
-                            driver.switch_to.new_window("tab")
-                            driver.get(short_url)
-                            # while we are waiting for the page to road, we need to scratch out the AMZScout window
-                            # since we just want the amazon page
-                            driver.execute_script(
-                                """
-                                let ad = document.getElementsByTagName("amzscout-pro")[0];
-                                ad.parentNode.removeChild(ad); // do NOT return, it crashes selenium
-                            """
-                            )
-                            # lets try this:
-                            soup = BeautifulSoup(
-                                driver.page_source, "html.parser"
-                            )  # page_source is the DOM, not the source
-
-                            # column_names.append("Description")
-                            description = soup.find("div", id="productDescription")
-                            if description is not None:
-                                columns.append(description.text.strip())
-                            else:
-                                columns.append("")  # null(?)
-
-                            # column_names.append("About this item")
-                            about = soup.find("div", id="feature-bullets")
-                            if about is not None:
-                                columns.append(about.text.strip())
-                            else:
-                                columns.append("")  # null(?)
-
-                            # column_names.append("From the manufacturer")
-                            manufacturer = soup.find("div", id="aplus")
-                            if manufacturer is not None:
-                                columns.append(manufacturer.text.strip())
-                            else:
-                                columns.append("")  # null(?)
-
-                            logger.debug(f"Deep scraping {product_name} ({short_url})... done")
-                            driver.close()
-                            driver.switch_to.window(amazon_window_handle)
-                            # we continue now
-                    except StaleElementReferenceException as e:
-                        logger.warning(
-                            f"StaleElementReferenceException while scraping row {i} column {j}: {e}"
-                        )
-                        continue
-            except StaleElementReferenceException as e:
-                logger.warning(f"StaleElementReferenceException while scraping row {i}: {e}")
+                image_css = col.find_element(
+                    By.CSS_SELECTOR, "span.preview-img.ng-scope"
+                ).value_of_css_property("background-image")
+            except NoSuchElementException:
+                image_css = "none"
+            if image_css != "none":
+                # this will be something like 'url("https://m.media-amazon.com/images/I/71Pn98gmz3L._SL300_.jpg")'
+                image_url = image_css.split('"')[1]
+                # this will be something like 'https://m.media-amazon.com/images/I/71Pn98gmz3L._SL300_.jpg'
+
+            a = col.find_element(By.CSS_SELECTOR, "a.ng-binding")
+            name = a.text
+            url = a.get_attribute("href")
+    return ProductRow(number, name, url, image_url, metrics)
+
+
+def parse_listing_html(html: str) -> tuple[list[str], list[ProductRow]]:
+    """
+    Read the column names and rows out of the AMZScout panel's HTML, the same way the live scrape reads the DOM.
+
+    Returns:
+        The column names and a row for every product in the table.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    header = soup.select_one(".maintable-header")
+    column_names = (
+        _expand_column_names(
+            [col.get_text(" ", strip=True) for col in header.select(".ng-binding")]
+        )
+        if header is not None
+        else []
+    )
+
+    products: list[ProductRow] = []
+    for row in soup.select(".maintable__row"):
+        number = ""
+        name = ""
+        url = ""
+        image_url: str | None = None
+        metrics: list[str] = []
+        for j, col in enumerate(row.select(".scout-col")):
+            if j < 2:
                 continue
-            csv_writer.writerow(columns)
-            rows_scraped += 1
+            if j == 2:
+                number = col.get_text(" ", strip=True)
+            elif j != 3:
+                metrics.append(col.get_text(" ", strip=True))
+            else:
+                preview = col.select_one("span.preview-img.ng-scope")
+                if preview is not None and (
+                    match := _CSS_URL_PATTERN.search(preview.get("style", ""))
+                ):
+                    image_url = match.group(1)
+                a = col.select_one("a.ng-binding")
+                if a is not None:
+                    name = a.get_text(" ", strip=True)
+                    # the live scrape reads the href property, which is always absolute
+                    url = urljoin("https://www.amazon.com/", a.get("href", ""))
+        products.append(ProductRow(number, name, url, image_url, metrics))
+    return column_names, products
+
+
+def product_sections_html(html: str) -> str:
+    """
+    Cut a product page down to the sections ``parse_product_page`` reads, so it can be archived cheaply.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    return "\n".join(
+        str(section)
+        for section_id in PRODUCT_SECTION_IDS
+        if (section := soup.find("div", id=section_id)) is not None
+    )
 
-    logger.info(f"Scraped {rows_scraped} rows of data from query {query!r}")
 
-    # we haven't the luxury of the "next 20 pages" button, so our results may be polluted by the only top 50 results we
-    # get only being the best of the best
+def parse_product_page(html: str) -> tuple[str, str, str]:
+    """
+    Pull the description, "About this item" and "From the manufacturer" text out of a product page.
 
+    Sections the product doesn't have come back empty.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    sections: list[str] = []
+    for section_id in PRODUCT_SECTION_IDS:
+        section = soup.find("div", id=section_id)
+        sections.append(section.text.strip() if section is not None else "")  # null(?)
+    description, about, manufacturer = sections
+    return description, about, manufacturer
 
-AMZSCOUT_DB_SITE = "https://amzscout.net/app/#/database"
 
+def deep_scrape_product(
+    driver: WebDriver,
+    wait: WebDriverWait,
+    url: str,
+    *,
+    return_to: str,
+    blocked_urls: Sequence[str] = (),
+) -> tuple[str, str, str]:
+    """
+    Open a product page in a new tab and scrape its text sections.
 
-@deprecated
-def search_and_write_amzscout(
+    Returns:
+        The description, "About this item" and "From the manufacturer" sections.
+    """
+    return parse_product_page(
+        fetch_product_page(driver, wait, url, return_to=return_to, blocked_urls=blocked_urls)
+    )
+
+
+def fetch_product_page(
+    driver: WebDriver,
+    wait: WebDriverWait,
+    url: str,
+    *,
+    return_to: str,
+    blocked_urls: Sequence[str] = (),
+) -> str:
+    """
+    Open a product page in a new tab and get its HTML, without the AMZScout panel.
+
+    i wanted to use requests & soup for this but it doesn't work perfect due to amazon's
+    bot screening & the description being super odd & dynamic
+
+    Args:
+        driver:
+        wait:
+        url: The product page.
+        return_to: The window handle to switch back to once the tab is closed.
+        blocked_urls: URL patterns that the product page is not allowed to load.
+
+    Returns:
+        The page's HTML.
+    """
+    driver.switch_to.new_window("tab")
+    try:
+        apply_url_blocklist(driver, blocked_urls)
+        _navigate(driver, url)
+        _wait_for_product_page(driver, wait)
+        # while we are waiting for the page to road, we need to scratch out the AMZScout window
+        # since we just want the amazon page
+        driver.execute_script(
+            """
+            let ad = document.getElementsByTagName("amzscout-pro")[0];
+            if (ad) ad.parentNode.removeChild(ad); // do NOT return, it crashes selenium
+        """
+        )
+        html = driver.page_source  # page_source is the DOM, not the source
+    finally:
+        driver.close()
+        driver.switch_to.window(return_to)
+    return html
+
+
+def search_and_write_amazon(
     driver: WebDriver,
     csv_writer: Writer,
     query: str,
@@ -289,10 +554,25 @@ def search_and_write_amzscout(
     *,
     write_headers: bool = True,
     write_data: bool = True,
-) -> None:
+    blocked_urls: Sequence[str] = (),
+    thumbnail_transcoder: ThumbnailTranscoder | None = None,
+    image_workers: int = 4,
+    transform_workers: int = 2,
+    queue_size: int = 8,
+    extraction: str = "dom",
+    cached_sections: Callable[[ProductRow], tuple[str, str, str] | None] | None = None,
+    archive: SnapshotArchive | None = None,
+    budget: Deadline | None = None,
+    deep_scrape: bool = True,
+    network_tracer: NetworkTracer | None = None,
+) -> list[StageMetrics]:
     """
     Search for a query and write the results to a CSV file.
 
+    The rows go through a pipeline of stages (listing, image, deep scrape, transform and sink) connected by bounded
+    queues, so thumbnails are downloaded and encoded while the browser is busy loading product pages.
+    Stages that use the browser only ever have one worker, since a WebDriver can only do one thing at a time.
+
     Args:
         driver:
         csv_writer:
@@ -300,60 +580,362 @@ def search_and_write_amzscout(
         query:
         write_headers:
         write_data:
+        blocked_urls: URL patterns that product pages are not allowed to load. The search tab loads everything.
+        thumbnail_transcoder: Shrinks thumbnails in a process pool.
+        image_workers: How many thumbnails are downloaded at once.
+        transform_workers: How many rows are encoded at once.
+        queue_size: How many rows may wait in front of each stage.
+        extraction: "api" builds the rows from the responses the AMZScout panel is filled from instead of its table, and
+            doesn't wait on the panel's spinners. The responses also go into the "API Data" column, which is empty in
+            "dom" mode. This needs a driver created with ``capture_network``.
+        cached_sections: Looks up a product's description, "About this item" and "From the manufacturer" sections
+            from an earlier scrape. Products it returns them for aren't deep scraped again.
+        archive: Saves the panel, the product pages and the thumbnails, so the rows can be produced again offline.
+        budget: How long the query may take in all. Every wait, page load and download takes its timeout from what is
+            left of it. Defaults to the deadline this thread is under, if any.
+        deep_scrape: Open every product page for its text sections. Without it, the sections are left empty and the
+            query only takes as long as the panel does.
+        network_tracer: Records the bytes, requests and timings of every page the query opens. This needs a driver
+            created with ``capture_network``.
 
     Returns:
+        Metrics for each stage of the pipeline.
 
+    Raises:
+        DeadlineExceeded: If the query ran over its budget
     """
-    wait = WebDriverWait(driver, driver.timeouts.implicit_wait)
-
+    budget = budget if budget is not None else current_deadline()
+    # the response capture and the tracer have to share a log, since reading an event takes it out of the log
+    log = PerformanceLog(driver) if extraction == "api" or network_tracer is not None else None
+    tracing = (
+        network_tracer.recording(log, query=query, proxy=proxy)
+        if network_tracer is not None and log is not None
+        else nullcontext()
+    )
+    with budget.limiting(driver) as limits, tracing:
+        return _search_and_write_amazon(
+            driver,
+            csv_writer,
+            query,
+            proxy,
+            write_headers=write_headers,
+            write_data=write_data,
+            blocked_urls=blocked_urls,
+            thumbnail_transcoder=thumbnail_transcoder,
+            image_workers=image_workers,
+            transform_workers=transform_workers,
+            queue_size=queue_size,
+            extraction=extraction,
+            cached_sections=cached_sections,
+            archive=archive,
+            budget=budget,
+            limits=limits,
+            deep_scrape=deep_scrape,
+            log=log,
+        )
+
+
+def _search_and_write_amazon(
+    driver: WebDriver,
+    csv_writer: Writer,
+    query: str,
+    proxy: str | None,
+    *,
+    write_headers: bool,
+    write_data: bool,
+    blocked_urls: Sequence[str],
+    thumbnail_transcoder: ThumbnailTranscoder | None,
+    image_workers: int,
+    transform_workers: int,
+    queue_size: int,
+    extraction: str,
+    cached_sections: Callable[[ProductRow], tuple[str, str, str] | None] | None,
+    archive: SnapshotArchive | None,
+    budget: Deadline,
+    limits: Timeouts,
+    deep_scrape: bool,
+    log: PerformanceLog | None,
+) -> list[StageMetrics]:
+    if extraction not in EXTRACTION_MODES:
+        raise ValueError(
+            f"Invalid extraction mode {extraction!r}, expected one of {', '.join(EXTRACTION_MODES)}"
+        )
+    timeout = limits.implicit_wait
     logger.info(f"Searching for {query!r}...")
 
-    if driver.current_url != AMZSCOUT_DB_SITE:
-        driver.get(AMZSCOUT_DB_SITE)
-    else:
-        driver.refresh()  # don't waste time
+    with phase("search"):
+        capture: ResponseCapture | None = None
+        if extraction == "api" and log is not None:
+            capture = ResponseCapture(log)
+            capture.clear()  # anything from before the search isn't ours
+
+        budget.apply_to(driver, limits)
+        appwrap = _open_amzscout_panel(driver, budget.wait(driver, timeout), query)
+        amazon_window_handle = driver.current_window_handle
+
+        # TODO: if we wanted to enable more headers or change any other options, we could do it here
+
+        # no stale protection needed here
+        column_names = _read_column_names(appwrap) if write_headers or capture is not None else []
+        if write_headers:
+            logger.info(f"Saving {len(column_names)} columns: {', '.join(column_names)}")
+            csv_writer.writerow(column_names)
+
+        if not write_data:
+            return []  # skip the rest of the function
+
+        maintable = appwrap.find_element(By.CLASS_NAME, "maintable")
+        products: dict[str, dict[str, Any]] = {}
+        if capture is not None:
+            with capture:
+                # the table is rendered the moment the responses arrive, so there is no need to watch the spinners
+                if capture.wait_until_quiet(
+                    lambda responses: bool(products_by_asin(responses)),
+                    timeout=budget.timeout(timeout * 2),
+                ):
+                    products = products_by_asin(capture.responses)
+                    logger.info(
+                        f"Captured {len(products)} products from {len(capture.responses)} responses"
+                    )
+                    driver.execute_script("window.stop();")
+                else:
+                    logger.warning(
+                        f"No product data came through the network for {query!r}, waiting on the panel"
+                    )
+                    _wait_for_listing(driver, maintable, timeout, budget)
+        else:
+            _wait_for_listing(driver, maintable, timeout, budget)
+
+        snapshot = archive.begin(query) if archive is not None else None
+        if snapshot is not None:
+            snapshot.listing = archive.put_text(appwrap.get_attribute("outerHTML"))
+            if capture is not None:
+                snapshot.responses = archive.put_text(
+                    json.dumps([response.__dict__ for response in capture.responses])
+                )
+
+    # the listing and deep scrape stages share the browser, so they take turns
+    driver_lock = Lock()
+
+    def read_listing(row: WebElement | ProductRow) -> ProductRow | None:
+        if isinstance(row, ProductRow):
+            return row  # built from the API responses, there is nothing to read
+        with driver_lock, phase("listing"):
+            budget.apply_to(driver, limits)
+            try:
+                product = _read_listing_row(row)
+            except StaleElementReferenceException as e:
+                logger.warning(f"StaleElementReferenceException while scraping a row: {e}")
+                return None
+        if products:
+            attach_api_data([product], products)
+        return product
+
+    def fetch_image(product: ProductRow) -> ProductRow:
+        if product.image_url is not None:
+            # we need to download the image and convert it to base64
+            try:
+                image_response = client.get(
+                    product.image_url,
+                    headers={"User-Agent": user_agent},
+                    timeout=budget.timeout(IMAGE_TIMEOUT),
+                )
+            except RequestsTimeout:
+                budget.check("downloading a thumbnail")
+                raise
+            product.image = (image_response.content, image_response.headers["Content-Type"])
+            if snapshot is not None:
+                snapshot.images[product.image_url] = (
+                    archive.put(product.image[0]),
+                    product.image[1],
+                )
+        return product
+
+    def read_product_page(product: ProductRow) -> ProductRow | None:
+        if cached_sections is not None and (sections := cached_sections(product)) is not None:
+            logger.debug(f"Reusing the deep scrape of {product.name} ({product.url})")
+            product.description, product.about, product.manufacturer = sections
+            return product
+        logger.info(f"Deep scraping {product.name} ({product.url})...")
+        with driver_lock, phase("deep scrape"):
+            budget.apply_to(driver, limits)
+            try:
+                html = fetch_product_page(
+                    driver,
+                    budget.wait(driver, timeout),
+                    product.url,
+                    return_to=amazon_window_handle,
+                    blocked_urls=blocked_urls,
+                )
+            except StaleElementReferenceException as e:
+                logger.warning(
+                    f"StaleElementReferenceException while deep scraping {product.url}: {e}"
+                )
+                return None
+        if snapshot is not None:
+            # the sections parse the same as the whole page, and are a fraction of the size
+            html = product_sections_html(html)
+            snapshot.products[product.url] = archive.put_text(html)
+        product.description, product.about, product.manufacturer = parse_product_page(html)
+        logger.debug(f"Deep scraping {product.name} ({product.url})... done")
+        return product
+
+    def transform(product: ProductRow) -> ProductRow:
+        if product.image is not None:
+            data, content_type = product.image
+            if thumbnail_transcoder is not None:
+                product.thumbnail = thumbnail_transcoder.submit(data, content_type).result()
+            else:
+                product.thumbnail = to_data_uri(data, content_type)
+            product.image = None  # don't hold on to the raw bytes any longer than we need to
+        return product
+
+    def sink(product: ProductRow) -> None:
+        csv_writer.writerow(product.to_csv_row())
+
+    stages = [
+        Stage("listing", read_listing),
+        Stage("image", fetch_image, workers=image_workers),
+        Stage("deep scrape", read_product_page),
+        Stage("transform", transform, workers=transform_workers),
+        Stage("sink", sink),
+    ]
+    if not deep_scrape:
+        stages = [stage for stage in stages if stage.name != "deep scrape"]
+    pipeline = Pipeline(stages, queue_size=queue_size)
+
+    # the client outlives the query, so its connections to the image CDN carry over to the next one
+    client = client_for(proxy)
+    user_agent = driver.execute_script("return navigator.userAgent")
+    # ok, lets scrape!
+    rows: list[WebElement] | list[ProductRow]
+    with phase("listing"):
+        rows = []
+        if products:
+            try:
+                # no round trip per cell, the responses already have everything the table shows
+                rows = products_from_api(column_names, products)
+            except ValueError as e:
+                logger.warning(f"Reading the table instead of the API responses: {e}")
+        if not rows:
+            rows = maintable.find_elements(By.CLASS_NAME, "maintable__row")
+    metrics = pipeline.run(rows)
+
+    if snapshot is not None:
+        archive.commit(snapshot)
+
+    rows_scraped = metrics[-1].processed
+    logger.info(f"Scraped {rows_scraped} rows of data from query {query!r}")
+    for stage_metrics in metrics:
+        logger.debug(f"{query!r}: {stage_metrics}")
 
-    # TODO: Filters go here
+    # we haven't the luxury of the "next 20 pages" button, so our results may be polluted by the only top 50 results we
+    # get only being the best of the best
 
-    # enter prompt
-    (driver.find_element(By.ID, "keywords").find_element(By.TAG_NAME, "input").send_keys(query))
+    return metrics
 
-    # click "FIND PRODUCTS"
-    wait.until(
-        ec.element_to_be_clickable((By.CSS_SELECTOR, "button.db-filters__controlls-find-btn"))
-    ).click()
-    if distraction := ec.element_to_be_clickable(
-        (By.CSS_SELECTOR, "app-filter-attention button.btn")
-    )(driver):
-        distraction.click()  # close the "attention" popup
-        wait.until(
-            ec.element_to_be_clickable((By.CSS_SELECTOR, "button.db-filters__controlls-find-btn"))
-        ).click()
-        # run it back
-
-    # wait for results to load
-    wait.until(ec.visibility_of_element_located((By.CSS_SELECTOR, "div.loader__text")))
-    wait.until(ec.invisibility_of_element_located((By.CSS_SELECTOR, "div.loader__text")))
 
-    if write_headers:
-        # TODO: Write headers here
-        pass
+# the columns of a database row: the usual leading ones, then everything the API said about the product
+DATABASE_COLUMNS = (
+    "#",
+    "Thumbnail Image",
+    "Product Name",
+    "URL",
+    "Description",
+    "About this item",
+    "From the manufacturer",
+    API_DATA_COLUMN,
+)
+# a browser is only needed to sign in and learn the search request, so its client is reused for every query it runs
+_database_clients: "WeakKeyDictionary[WebDriver, DatabaseClient]" = WeakKeyDictionary()
 
-    if write_data:
-        if driver.find_element(By.CSS_SELECTOR, "div.empty-row").is_displayed():
-            logger.warning(f"No results found for query {query!r}, skipping...")
-        else:
-            # TODO: Write data here
-            pass
 
-    raise NotImplementedError(
-        "I didn't get this far, sorry! Please use the extension mode for now."
+def database_product(number: int, record: dict[str, Any]) -> ProductRow:
+    """
+    Turn a product from the AMZScout database API into a row.
+    """
+    asin = next(value for key, value in record.items() if key.lower() == "asin").upper()
+    return ProductRow(
+        str(number),
+        _record_field(record, "title", "name", "productname") or "",
+        _record_field(record, "url", "link") or f"https://www.amazon.com/dp/{asin}",
+        _record_field(record, "image", "imageurl", "img"),
+        [],
+        api_data=record,
     )
-    # for a couple different reasons, doing this without the extension is a pretty dumb idea.
-    # #1: the rate limit for the dedicated website is a lot lower (more accounts = more IPs)
-    # #2: amazon loading is not the rate limit of the project
-    # #3: less products on dedicated website
-    # its for all these reasons i wont continue developing the dedicated website scraper.
 
 
-__all__ = ("search_and_write_amzscout", "search_and_write_amazon")
+def search_and_write_amzscout(
+    driver: WebDriver,
+    csv_writer: Writer,
+    query: str,
+    proxy: str | None = None,
+    *,
+    write_headers: bool = True,
+    write_data: bool = True,
+    max_pages: int = DEFAULT_MAX_PAGES,
+) -> int:
+    """
+    Search the AMZScout database for a query and write the results to a CSV file.
+
+    The browser isn't used for the search itself. The first time a driver is used, it runs one search in the web app to
+    record the request the app makes and the session it makes it with. Every search after that, including this one, is
+    made directly over HTTP and paged through.
+
+    Args:
+        driver: A browser signed in to amzscout.net.
+        csv_writer: Where the rows go.
+        query: What to search for.
+        proxy: The proxy the browser uses, so the session is used from the same address.
+        write_headers: Write the header row first.
+        write_data: Write the rows.
+        max_pages: The most pages of results to read.
+
+    Returns:
+        The number of rows written.
+    """
+    logger.info(f"Searching for {query!r}...")
+
+    client = _database_clients.get(driver)
+    if client is None:
+        client = _database_clients[driver] = DatabaseClient(
+            learn_search_request(driver, query),
+            session_cookies(driver),
+            proxy=proxy,
+            max_pages=max_pages,
+        )
+
+    if write_headers:
+        csv_writer.writerow(DATABASE_COLUMNS)
+
+    if not write_data:
+        return 0
+
+    rows = 0
+    for number, record in enumerate(client.search(query), 1):
+        csv_writer.writerow(database_product(number, record).to_csv_row())
+        rows += 1
+    if not rows:
+        logger.warning(f"No results found for query {query!r}")
+    logger.info(f"Scraped {rows} rows of data from query {query!r}")
+    return rows
+
+
+__all__ = (
+    "search_and_write_amzscout",
+    "database_product",
+    "DATABASE_COLUMNS",
+    "search_and_write_amazon",
+    "deep_scrape_product",
+    "fetch_product_page",
+    "parse_listing_html",
+    "product_sections_html",
+    "asin_of",
+    "EXTRACTION_MODES",
+    "API_DATA_COLUMN",
+    "API_COLUMN_FIELDS",
+    "products_from_api",
+    "attach_api_data",
+    "parse_product_page",
+    "ProductRow",
+)
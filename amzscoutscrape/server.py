@@ -0,0 +1,374 @@
+"""
+A long-running scrape server for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import Any, Callable, Iterator, Sequence
+
+from selenium.webdriver.remote.webdriver import WebDriver
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8750
+# a driver that fails this many queries in a row is replaced, whatever its quota says
+MAX_CONSECUTIVE_FAILURES = 3
+THROUGHPUT_WINDOW = 300.0
+
+
+class _JobWriter:
+    """
+    A stand-in for a CSV writer that hands every row to the job as soon as it is written.
+    """
+
+    def __init__(self, job: "Job") -> None:
+        self.job = job
+        self.header: list[str] | None = None
+
+    def writerow(self, row: Sequence[str]) -> None:
+        if self.header is None:
+            self.header = list(row)
+            return
+        self.job.rows += 1
+        self.job.events.put({"query": self.job.query, "row": dict(zip(self.header, row))})
+
+
+@dataclass
+class Job:
+    """
+    One query submitted to the server.
+
+    Its events are the rows of the query, as they are scraped, followed by exactly one line saying how it ended.
+    """
+
+    query: str
+    events: Queue[dict[str, Any]] = field(default_factory=Queue)
+    submitted: float = field(default_factory=time)
+    rows: int = 0
+    # set once nobody is waiting for the results anymore
+    cancelled: Event = field(default_factory=Event)
+
+    def finish(self, error: str | None = None, **details: Any) -> None:
+        end: dict[str, Any] = {"query": self.query, "status": "failed" if error else "done"}
+        if error:
+            end["error"] = error
+        end.update(rows=self.rows, **details)
+        self.events.put(end)
+
+    def stream(self) -> Iterator[dict[str, Any]]:
+        while True:
+            event = self.events.get()
+            yield event
+            if "status" in event:
+                return
+
+
+@dataclass
+class DriverSlot:
+    """
+    One of the pool's drivers and how it has been doing.
+    """
+
+    index: int
+    # "starting", "idle", "busy" or "stopped"
+    state: str = "starting"
+    driver: WebDriver | None = None
+    started: float | None = None
+    uses: int = 0
+    served: int = 0
+    failed: int = 0
+    consecutive_failures: int = 0
+    replaced: int = 0
+    last_error: str | None = None
+
+    def status(self) -> dict[str, Any]:
+        return {
+            "index": self.index,
+            "state": self.state,
+            "age": round(time() - self.started, 1) if self.started is not None else None,
+            "uses": self.uses,
+            "served": self.served,
+            "failed": self.failed,
+            "consecutive_failures": self.consecutive_failures,
+            "replaced": self.replaced,
+            "last_error": self.last_error,
+        }
+
+
+class DriverPool:
+    """
+    Keeps a number of drivers warm and feeds them queries from a shared queue.
+
+    Every driver has a thread of its own. A driver is replaced as soon as it is retired, so the next query never waits
+    for a browser to start.
+
+    Args:
+        size: How many drivers to keep.
+        new_driver: Makes a driver, or returns None if it couldn't.
+        scrape: Scrapes a query with a driver into a CSV writer, header first.
+        retire: Called after every query with the driver and how many queries it has run. True replaces the driver.
+        close_driver: Gets rid of a driver.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        *,
+        new_driver: Callable[[], WebDriver | None],
+        scrape: Callable[[WebDriver, Any, str], None],
+        retire: Callable[[WebDriver, int], bool] = lambda driver, uses: False,
+        close_driver: Callable[[WebDriver], None] = lambda driver: driver.quit(),
+    ) -> None:
+        self.new_driver = new_driver
+        self.scrape = scrape
+        self.retire = retire
+        self.close_driver = close_driver
+        self.slots = [DriverSlot(index) for index in range(size)]
+        self.jobs: Queue[Job | None] = Queue()
+        self.started = time()
+        self.completed = 0
+        self.failed = 0
+        self.rows = 0
+        self._finished: deque[tuple[float, int]] = deque()  # (when, rows) of recent queries
+        self._lock = Lock()
+        self._stopping = Event()
+        self._threads = [
+            Thread(target=self._work, args=(slot,), name=f"Driver-{slot.index}", daemon=True)
+            for slot in self.slots
+        ]
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, query: str) -> Job:
+        job = Job(query)
+        self.jobs.put(job)
+        return job
+
+    def _replace(self, slot: DriverSlot) -> bool:
+        if slot.driver is not None:
+            try:
+                self.close_driver(slot.driver)
+            except Exception as e:
+                logger.debug(f"Could not close driver {slot.index}: {e}")
+            slot.driver = None
+            slot.replaced += 1
+        slot.state = "starting"
+        while slot.driver is None and not self._stopping.is_set():
+            logger.info(f"Starting driver {slot.index}...")
+            try:
+                slot.driver = self.new_driver()
+            except Exception as e:
+                logger.exception(f"Could not start driver {slot.index}: {e}")
+                slot.last_error = repr(e)
+        slot.started = time()
+        slot.uses = 0
+        slot.consecutive_failures = 0
+        slot.state = "idle"
+        return slot.driver is not None
+
+    def _run(self, slot: DriverSlot, job: Job) -> None:
+        driver = slot.driver
+        if driver is None:
+            # fail the job rather than the worker, so whoever is waiting on it hears back
+            slot.last_error = f"Driver {slot.index} isn't running"
+            job.finish(slot.last_error)
+            return
+        slot.state = "busy"
+        slot.uses += 1
+        began = monotonic()
+        try:
+            self.scrape(driver, _JobWriter(job), job.query)
+        except Exception as e:
+            logger.exception(f"Error while processing query {job.query!r}: {e}")
+            slot.failed += 1
+            slot.consecutive_failures += 1
+            slot.last_error = repr(e)
+            with self._lock:
+                self.failed += 1
+            job.finish(repr(e))
+        else:
+            slot.served += 1
+            slot.consecutive_failures = 0
+            with self._lock:
+                self.completed += 1
+                self.rows += job.rows
+                self._finished.append((time(), job.rows))
+            job.finish(seconds=round(monotonic() - began, 2))
+        finally:
+            slot.state = "idle"
+
+    def _work(self, slot: DriverSlot) -> None:
+        try:
+            # warm up before the first query comes in
+            if not self._replace(slot):
+                return
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                if job.cancelled.is_set():
+                    continue
+                self._run(slot, job)
+                if (
+                    slot.driver is None
+                    or slot.consecutive_failures >= MAX_CONSECUTIVE_FAILURES
+                    or self.retire(slot.driver, slot.uses)
+                ):
+                    logger.info(f"Replacing driver {slot.index}...")
+                    if not self._replace(slot):
+                        return
+        finally:
+            slot.state = "stopped"
+            if slot.driver is not None:
+                self.close_driver(slot.driver)
+                slot.driver = None
+
+    def close(self) -> None:
+        """
+        Stop the drivers once they are done with what they are on, and fail every query still waiting.
+        """
+        self._stopping.set()
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except Empty:
+                break
+            if job is not None:
+                job.finish("The server is shutting down")
+        for _ in self._threads:
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def status(self) -> dict[str, Any]:
+        now = time()
+        with self._lock:
+            while self._finished and now - self._finished[0][0] > THROUGHPUT_WINDOW:
+                self._finished.popleft()
+            recent = list(self._finished)
+            completed, failed, rows = self.completed, self.failed, self.rows
+        window = min(THROUGHPUT_WINDOW, now - self.started) or 1.0
+        return {
+            "uptime": round(now - self.started, 1),
+            "queue_depth": self.jobs.qsize(),
+            "in_flight": sum(slot.state == "busy" for slot in self.slots),
+            "completed": completed,
+            "failed": failed,
+            "rows": rows,
+            "throughput": {
+                "window": round(window, 1),
+                "queries_per_minute": round(len(recent) / window * 60, 2),
+                "rows_per_minute": round(sum(rows for _, rows in recent) / window * 60, 2),
+            },
+            "drivers": [slot.status() for slot in self.slots],
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "ScrapeServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, status: HTTPStatus, body: Any) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/status":
+            self._send_json(HTTPStatus.OK, self.server.pool.status())
+        else:
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"No such endpoint {self.path!r}"})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/queries":
+            self._send_json(HTTPStatus.NOT_FOUND, {"error": f"No such endpoint {self.path!r}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            queries = body["queries"] if "queries" in body else [body["query"]]
+            if not queries or not all(isinstance(query, str) and query for query in queries):
+                raise ValueError("queries must be non-empty strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(
+                HTTPStatus.BAD_REQUEST,
+                {"error": f'Expected {{"queries": ["..."]}} or {{"query": "..."}}: {e}'},
+            )
+            return
+
+        jobs = [self.server.pool.submit(query) for query in queries]
+        # no Content-Length, so the response runs until the connection closes and can be read line by line
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for job in jobs:
+                for event in job.stream():
+                    self.wfile.write(json.dumps(event).encode() + b"\n")
+                    self.wfile.flush()
+        except OSError:
+            logger.info(f"{self.address_string()} went away, dropping its queries")
+            for job in jobs:
+                job.cancelled.set()
+
+
+class ScrapeServer(ThreadingHTTPServer):
+    """
+    Takes queries over HTTP and streams back their rows as they are scraped.
+
+    ``POST /queries`` with ``{"queries": ["..."]}`` answers with one JSON object per line: ``{"query", "row"}`` for
+    every row, then ``{"query", "status", "rows"}`` once the query is done or has failed. Queries from every client
+    share the pool's drivers in the order they came in. ``GET /status`` describes the queue and the drivers.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, pool: DriverPool, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT
+    ) -> None:
+        self.pool = pool
+        super().__init__((host, port), _Handler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+__all__ = (
+    "DEFAULT_HOST",
+    "DEFAULT_PORT",
+    "Job",
+    "DriverSlot",
+    "DriverPool",
+    "ScrapeServer",
+)
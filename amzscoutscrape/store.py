@@ -0,0 +1,213 @@
+"""
+Persistent per-product store for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+import json
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import Sequence
+
+from .output import open_output
+from .scrape import ProductRow, asin_of
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_DEEP_SCRAPE_TTL = 30 * 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    key TEXT PRIMARY KEY,
+    query TEXT NOT NULL,
+    data TEXT NOT NULL,
+    listed REAL NOT NULL,
+    deep_scraped REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+# Where the deep scrape's sections are in a csv row, see ProductRow.to_csv_row
+SECTIONS_COLUMNS = slice(4, 7)
+URL_COLUMN = 3
+
+
+def product_key(url: str) -> str:
+    """
+    Products are keyed by ASIN, or by URL if it doesn't have one.
+    """
+    return asin_of(url) or url
+
+
+class ProductStore:
+    """
+    The latest row of every product that has been scraped, and when its listing and deep scrape were last refreshed.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "ProductStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def header(self) -> list[str] | None:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'header'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_header(self, header: Sequence[str]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('header', ?)",
+                (json.dumps(list(header)),),
+            )
+
+    def fresh_sections(self, url: str, ttl: float) -> tuple[str, str, str] | None:
+        """
+        Get a product's deep scrape, if it was done less than ``ttl`` seconds ago.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM products WHERE key = ? AND deep_scraped >= ?",
+                (product_key(url), time() - ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        description, about, manufacturer = json.loads(row[0])[SECTIONS_COLUMNS]
+        return description, about, manufacturer
+
+    def upsert(self, query: str, row: Sequence[str], *, deep_scraped: bool) -> None:
+        """
+        Save a product's row, replacing whatever was saved for it before.
+
+        Args:
+            query: The query the product was found with.
+            row: The csv row.
+            deep_scraped: Whether the row's sections were just scraped, as opposed to copied from the store.
+        """
+        now = time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO products (key, query, data, listed, deep_scraped) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET query = excluded.query, data = excluded.data, "
+                "listed = excluded.listed, "
+                "deep_scraped = CASE WHEN ? THEN excluded.deep_scraped ELSE deep_scraped END",
+                (
+                    product_key(row[URL_COLUMN]),
+                    query,
+                    json.dumps(list(row)),
+                    now,
+                    now,
+                    deep_scraped,
+                ),
+            )
+
+    def count(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM products").fetchone()
+        return count
+
+    def export(self, path: str | Path, *, level: int | None = None) -> int:
+        """
+        Write every product to a csv, replacing the file in one go so readers never see half of it.
+
+        Returns:
+            The number of rows written.
+        """
+        path = Path(path)
+        # keep the suffix so the temporary file is compressed the same way
+        temporary = path.with_name(f".tmp-{path.name}")
+        header = self.header()
+        written = 0
+        with open_output(temporary, level=level) as fp:
+            csv_writer = csv.writer(fp, dialect="excel")
+            if header is not None:
+                csv_writer.writerow(header)
+            with self._lock:
+                rows = self._connection.execute("SELECT data FROM products ORDER BY rowid")
+                for (data,) in rows:
+                    csv_writer.writerow(json.loads(data))
+                    written += 1
+        os.replace(temporary, path)
+        return written
+
+
+class StoreWriter:
+    """
+    A stand-in for a CSV writer that upserts the rows of one query into a ``ProductStore``.
+
+    Pass ``cached_sections`` to ``search_and_write_amazon`` so that products deep scraped less than ``ttl`` seconds
+    ago are filled in from the store instead of being scraped again.
+    """
+
+    def __init__(
+        self,
+        store: ProductStore,
+        query: str,
+        *,
+        ttl: float = DEFAULT_DEEP_SCRAPE_TTL,
+        expect_header: bool = False,
+    ) -> None:
+        self.store = store
+        self.query = query
+        self.ttl = ttl
+        self.expect_header = expect_header
+        self.rows = 0
+        self.reused = 0
+        self._from_store: set[str] = set()
+
+    def cached_sections(self, product: ProductRow) -> tuple[str, str, str] | None:
+        sections = self.store.fresh_sections(product.url, self.ttl)
+        if sections is not None:
+            self._from_store.add(product.url)
+            self.reused += 1
+        return sections
+
+    def writerow(self, row: Sequence[str]) -> None:
+        if self.expect_header:
+            self.expect_header = False
+            self.store.set_header(row)
+            return
+        self.store.upsert(self.query, row, deep_scraped=row[URL_COLUMN] not in self._from_store)
+        self.rows += 1
+
+
+__all__ = (
+    "DEFAULT_DEEP_SCRAPE_TTL",
+    "SECTIONS_COLUMNS",
+    "URL_COLUMN",
+    "ProductStore",
+    "StoreWriter",
+    "product_key",
+)
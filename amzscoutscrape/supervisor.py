@@ -0,0 +1,265 @@
+"""
+Supervised driver sessions for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+import multiprocessing
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from itertools import islice
+from time import monotonic, time
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+from .processes import ProcessInfo, descendants, kill_processes, mark_session, orphaned_browsers
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_HEARTBEAT_TIMEOUT = 300.0
+DEFAULT_SESSION_ATTEMPTS = 2
+
+# Processes are spawned rather than forked, so a session never inherits another session's threads or drivers
+_context = multiprocessing.get_context("spawn")
+
+
+class SessionReporter:
+    """
+    Handed to a session running in a child process, to tell the supervisor what it is up to.
+
+    Anything the session does counts as a heartbeat. A session that goes quiet for too long is killed.
+    """
+
+    def __init__(self, messages: Any, heartbeat: Any) -> None:
+        self._messages = messages
+        self._heartbeat = heartbeat
+
+    def beat(self) -> None:
+        self._heartbeat.value = time()
+
+    def started(self, item: str) -> None:
+        self.beat()
+        self._messages.send(("started", item, None))
+
+    def done(self, item: str, result: Any) -> None:
+        self.beat()
+        self._messages.send(("done", item, result))
+
+    def failed(self, item: str, error: str) -> None:
+        self.beat()
+        self._messages.send(("failed", item, error))
+
+
+def _session_main(
+    target: Callable[[Sequence[str], SessionReporter], None],
+    items: list[str],
+    messages: Any,
+    heartbeat: Any,
+    log_level: int,
+) -> None:
+    logging.basicConfig(level=log_level)
+    mark_session()
+    target(items, SessionReporter(messages, heartbeat))
+
+
+@dataclass
+class Intervention:
+    """
+    Something the supervisor had to step in for.
+    """
+
+    # "hung", "crashed", "leftovers" or "orphans"
+    kind: str
+    session: int | None
+    item: str | None
+    killed: int
+    time: float = field(default_factory=time)
+
+    def __str__(self) -> str:
+        subject = f"session {self.session}" if self.session is not None else "no session"
+        during = f" during {self.item!r}" if self.item is not None else ""
+        return f"{self.kind}: {subject}{during}, {self.killed} processes killed"
+
+
+@dataclass
+class SessionResult:
+    item: str
+    result: Any = None
+    error: str | None = None
+
+
+class Supervisor:
+    """
+    Runs sessions in child processes, and kills and replaces the ones that stop making progress.
+
+    A session is a picklable callable that takes a batch of items and a ``SessionReporter``.
+    It reports each item as it starts and finishes it, and beats whenever it makes progress in between.
+    When a session hangs or crashes, its process tree is killed, the item it was working on counts as an attempt,
+    and the rest of its batch goes to a fresh session. Browsers left behind by dead sessions are reaped.
+    Every time the supervisor steps in, it is logged and added to ``interventions``.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[Sequence[str], SessionReporter], None],
+        *,
+        heartbeat_timeout: float = DEFAULT_HEARTBEAT_TIMEOUT,
+        max_attempts: int = DEFAULT_SESSION_ATTEMPTS,
+        poll_interval: float = 1.0,
+        scan_interval: float = 10.0,
+        reap_orphans: bool = True,
+        log_level: int = logging.WARNING,
+    ) -> None:
+        self.target = target
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.scan_interval = scan_interval
+        self.reap_orphans = reap_orphans
+        self.log_level = log_level
+        self.interventions: list[Intervention] = []
+
+    def _intervene(
+        self, kind: str, session: int | None, item: str | None, killed: int
+    ) -> Intervention:
+        intervention = Intervention(kind, session, item, killed)
+        logger.warning(f"Supervisor stepped in: {intervention}")
+        self.interventions.append(intervention)
+        return intervention
+
+    def reap(self) -> int:
+        """
+        Kill browsers left behind by sessions that are gone.
+
+        Returns:
+            How many processes were killed.
+        """
+        killed = len(kill_processes(orphaned_browsers()))
+        if killed:
+            self._intervene("orphans", None, None, killed)
+        return killed
+
+    def is_stale(self, last_beat: float, now: float | None = None) -> bool:
+        return (now if now is not None else time()) - last_beat > self.heartbeat_timeout
+
+    def run(self, items: Iterable[str], session_size: int) -> Iterator[SessionResult]:
+        """
+        Work through items, ``session_size`` at a time per session.
+
+        Results come out as the sessions report them. Every item comes out exactly once, either done or failed.
+        """
+        if self.reap_orphans:
+            self.reap()  # whatever an earlier run left behind
+        attempts: Counter[str] = Counter()
+        pending: deque[str] = deque()
+        remaining = iter(items)
+        while True:
+            batch = [pending.popleft() for _ in range(min(len(pending), session_size))]
+            batch.extend(islice(remaining, session_size - len(batch)))
+            if not batch:
+                return
+            yield from self._run_session(batch, pending, attempts)
+            if self.reap_orphans:
+                self.reap()
+
+    def _run_session(
+        self, batch: list[str], pending: deque[str], attempts: Counter[str]
+    ) -> Iterator[SessionResult]:
+        # a pipe rather than a queue: a send has gone out when it returns, so a session that dies right after
+        # reporting something can't take the report with it
+        messages, sender = _context.Pipe(duplex=False)
+        heartbeat = _context.Value("d", time(), lock=False)
+        # not a daemon, since daemons may not start processes of their own and browsers are processes
+        process = _context.Process(
+            target=_session_main,
+            args=(self.target, batch, sender, heartbeat, self.log_level),
+        )
+        process.start()
+        sender.close()
+        logger.info(f"Started session {process.pid} with {len(batch)} items")
+
+        outstanding = list(batch)
+        current: str | None = None
+        tree: list[ProcessInfo] = []
+        next_scan = 0.0
+        hung = False
+        try:
+            while True:
+                message = None
+                if messages.poll(self.poll_interval):
+                    try:
+                        message = messages.recv()
+                    except EOFError:
+                        process.join(
+                            self.poll_interval
+                        )  # it closed its end, so it's on its way out
+                if message is not None:
+                    kind, item, payload = message
+                    if kind == "started":
+                        current = item
+                    else:
+                        current = None
+                        outstanding.remove(item)
+                        yield SessionResult(
+                            item,
+                            payload if kind == "done" else None,
+                            payload if kind == "failed" else None,
+                        )
+                    continue
+                # only once everything it sent has been read, or it could have died mid-message
+                if not process.is_alive():
+                    break
+                if monotonic() >= next_scan:
+                    # its children are found while they are still its children, so they can be killed once it's gone
+                    tree = descendants(process.pid)
+                    next_scan = monotonic() + self.scan_interval
+                if self.is_stale(heartbeat.value):
+                    hung = True
+                    break
+        finally:
+            if process.is_alive():
+                # hung, or whoever was reading the results stopped
+                tree = descendants(process.pid) or tree
+                process.kill()
+            process.join()
+        killed = len(kill_processes(tree))
+        if hung:
+            self._intervene("hung", process.pid, current, killed + 1)
+        elif process.exitcode != 0:
+            self._intervene("crashed", process.pid, current, killed)
+        elif killed:
+            self._intervene("leftovers", process.pid, None, killed)
+        messages.close()
+
+        if outstanding:
+            # blame whatever it was working on, or the first item if it never got that far
+            blamed = current if current is not None else outstanding[0]
+            attempts[blamed] += 1
+            if attempts[blamed] >= self.max_attempts:
+                outstanding.remove(blamed)
+                yield SessionResult(
+                    blamed, error=f"Gave up after {attempts[blamed]} sessions died on it"
+                )
+            pending.extendleft(reversed(outstanding))
+
+
+__all__ = (
+    "DEFAULT_HEARTBEAT_TIMEOUT",
+    "DEFAULT_SESSION_ATTEMPTS",
+    "SessionReporter",
+    "Intervention",
+    "SessionResult",
+    "Supervisor",
+)
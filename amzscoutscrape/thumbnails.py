@@ -0,0 +1,130 @@
+"""
+Thumbnail transcoding for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import base64
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
+
+logger = logging.getLogger(__package__)
+
+THUMBNAIL_FORMATS = ("passthrough", "webp", "jpeg")
+_CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+
+def to_data_uri(data: bytes, content_type: str) -> str:
+    return f"data:{content_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def transcode(
+    data: bytes, content_type: str, fmt: str, max_size: int, quality: int
+) -> tuple[bytes, str]:
+    """
+    Downscale an image to fit in a max_size square and re-encode it.
+
+    The original is kept if re-encoding wouldn't make it any smaller.
+
+    Returns:
+        The image and its content type.
+    """
+    if fmt == "passthrough":
+        return data, content_type
+
+    with Image.open(BytesIO(data)) as image:
+        image.thumbnail((max_size, max_size))
+        if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = BytesIO()
+        image.save(buffer, format=fmt.upper(), quality=quality)
+
+    if buffer.tell() >= len(data):
+        return data, content_type
+    return buffer.getvalue(), _CONTENT_TYPES[fmt]
+
+
+def _transcode_to_data_uri(
+    data: bytes, content_type: str, fmt: str, max_size: int, quality: int
+) -> str:
+    # runs in the pool, so the base64 encoding is kept off the main process too
+    try:
+        data, content_type = transcode(data, content_type, fmt, max_size, quality)
+    except Exception as e:
+        logger.warning(f"Could not transcode a {content_type} thumbnail, keeping it as-is: {e}")
+    return to_data_uri(data, content_type)
+
+
+class ThumbnailTranscoder:
+    """
+    Transcodes thumbnails in a pool of processes, so the work doesn't contend for the GIL with scraping.
+
+    Needs Pillow unless the format is "passthrough".
+    """
+
+    def __init__(
+        self,
+        fmt: str = "webp",
+        *,
+        max_size: int = 160,
+        quality: int = 60,
+        workers: int | None = None,
+    ) -> None:
+        if fmt not in THUMBNAIL_FORMATS:
+            raise ValueError(
+                f"Invalid thumbnail format {fmt!r}, expected one of {', '.join(THUMBNAIL_FORMATS)}"
+            )
+        if fmt != "passthrough" and Image is None:
+            raise ImportError(
+                "Transcoding thumbnails requires Pillow. Install amzscoutscrape[thumbnails]."
+            )
+        self.fmt = fmt
+        self.max_size = max_size
+        self.quality = quality
+        self._executor = ProcessPoolExecutor(max_workers=workers) if fmt != "passthrough" else None
+
+    def submit(self, data: bytes, content_type: str) -> Future[str]:
+        """
+        Queue a thumbnail for transcoding.
+
+        Returns:
+            A future for the thumbnail as a data URI.
+        """
+        if self._executor is None:
+            future: Future[str] = Future()
+            future.set_result(to_data_uri(data, content_type))
+            return future
+        return self._executor.submit(
+            _transcode_to_data_uri, data, content_type, self.fmt, self.max_size, self.quality
+        )
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self) -> "ThumbnailTranscoder":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+__all__ = ("THUMBNAIL_FORMATS", "ThumbnailTranscoder", "transcode", "to_data_uri")
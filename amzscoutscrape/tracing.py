@@ -0,0 +1,173 @@
+"""
+WebDriver command tracing for amzscout-scrape.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import logging
+import sys
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Iterator
+
+from selenium.webdriver.remote.webdriver import WebDriver
+
+logger = logging.getLogger(__package__)
+
+_PACKAGE_DIR = str(Path(__file__).parent)
+_local = threading.local()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Mark the commands sent from this thread as part of a scrape phase, for any tracer that is listening.
+
+    This costs next to nothing when nothing is being traced.
+    """
+    previous = getattr(_local, "phase", None)
+    _local.phase = name
+    try:
+        yield
+    finally:
+        _local.phase = previous
+
+
+def current_phase() -> str:
+    return getattr(_local, "phase", None) or "other"
+
+
+def _call_site() -> str:
+    # the first frame in our own code that isn't this module is the one that asked for the command
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PACKAGE_DIR) and filename != __file__:
+            return f"{Path(filename).name}:{frame.f_lineno} ({frame.f_code.co_name})"
+        frame = frame.f_back
+    return "<outside amzscoutscrape>"
+
+
+@dataclass
+class CommandStats:
+    count: int = 0
+    seconds: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+
+
+@dataclass
+class TraceReport:
+    """
+    Where the time spent talking to the browser went.
+    """
+
+    commands: int
+    seconds: float
+    rows: int
+    by_command: dict[str, CommandStats] = field(default_factory=dict)
+    by_phase: dict[str, CommandStats] = field(default_factory=dict)
+    by_call_site: dict[str, CommandStats] = field(default_factory=dict)
+
+    @property
+    def commands_per_row(self) -> float:
+        return self.commands / self.rows if self.rows else 0.0
+
+    def slowest_call_sites(self, limit: int = 10) -> list[tuple[str, CommandStats]]:
+        return sorted(self.by_call_site.items(), key=lambda item: -item[1].seconds)[:limit]
+
+    def __str__(self) -> str:
+        lines = [
+            f"{self.commands} WebDriver commands, {self.seconds:.1f}s on the wire, "
+            f"{self.commands_per_row:.1f} commands per row over {self.rows} rows",
+            "By phase:",
+        ]
+        for name, stats in sorted(self.by_phase.items(), key=lambda item: -item[1].seconds):
+            lines.append(f"  {name}: {stats.count} commands, {stats.seconds:.2f}s")
+        lines.append("By command:")
+        for name, stats in sorted(self.by_command.items(), key=lambda item: -item[1].seconds):
+            lines.append(
+                f"  {name}: {stats.count} x {stats.seconds / stats.count * 1000:.1f}ms = {stats.seconds:.2f}s"
+            )
+        lines.append("Slowest call sites:")
+        for site, stats in self.slowest_call_sites():
+            lines.append(f"  {site}: {stats.count} commands, {stats.seconds:.2f}s")
+        return "\n".join(lines)
+
+
+class CommandTracer:
+    """
+    Times every command a driver sends to its browser, and notes the phase and line of code it came from.
+
+    Tracing is opt-in: nothing is recorded until a driver is attached.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._by_command: dict[str, CommandStats] = defaultdict(CommandStats)
+        self._by_phase: dict[str, CommandStats] = defaultdict(CommandStats)
+        self._by_call_site: dict[str, CommandStats] = defaultdict(CommandStats)
+        self.rows = 0
+
+    def attach(self, driver: WebDriver) -> None:
+        """
+        Start tracing a driver. A tracer can trace any number of drivers, one after another or at once.
+        """
+        executor = driver.command_executor
+        original = executor.execute
+
+        def execute(command: str, params: dict[str, Any]) -> Any:
+            start = perf_counter()
+            try:
+                return original(command, params)
+            finally:
+                self.record(command, perf_counter() - start, current_phase(), _call_site())
+
+        executor.execute = execute
+
+    @staticmethod
+    def detach(driver: WebDriver) -> None:
+        # the wrapper shadows the method on the instance, so removing it brings the method back
+        driver.command_executor.__dict__.pop("execute", None)
+
+    def record(self, command: str, seconds: float, phase_name: str, call_site: str) -> None:
+        with self._lock:
+            self._by_command[command].add(seconds)
+            self._by_phase[phase_name].add(seconds)
+            self._by_call_site[call_site].add(seconds)
+
+    def count_rows(self, rows: int) -> None:
+        with self._lock:
+            self.rows += rows
+
+    def report(self) -> TraceReport:
+        with self._lock:
+            return TraceReport(
+                commands=sum(stats.count for stats in self._by_command.values()),
+                seconds=sum(stats.seconds for stats in self._by_command.values()),
+                rows=self.rows,
+                by_command=dict(self._by_command),
+                by_phase=dict(self._by_phase),
+                by_call_site=dict(self._by_call_site),
+            )
+
+
+__all__ = ("phase", "current_phase", "CommandStats", "TraceReport", "CommandTracer")
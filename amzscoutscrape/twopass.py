@@ -0,0 +1,375 @@
+"""
+Two-pass scraping for amzscout-scrape: every query's listing first, then every product page once.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+import logging
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, Sequence
+
+from _csv import Writer
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from .scrape import fetch_product_page, parse_product_page
+from .store import SECTIONS_COLUMNS, URL_COLUMN, product_key
+from .utils import Deadline
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_DEEP_WORKERS = 2
+# product pages don't need an AMZScout account, so this is about staying under Amazon's radar
+DEFAULT_PAGES_PER_DRIVER = 40
+MAX_CONSECUTIVE_FAILURES = 3
+# how long to wait before starting a driver again after one failed to start, doubling every time
+DRIVER_RETRY_BACKOFF = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    query TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    -- set once the row has been written out joined, so a later run doesn't write it again
+    exported INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS products (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    sections TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class HarvestStore:
+    """
+    The listing rows of the first pass and the product pages of the second, stored in SQLite.
+
+    Every product is listed once however many queries it came up in, so its page is only scraped once.
+    Without a path, the database is a temporary file that goes away when the store is closed. With one, a later run
+    can skip the queries that were already harvested, and only writes out what hasn't been written yet.
+    """
+
+    def __init__(self, path: str | Path | None = None) -> None:
+        self.path = Path(path) if path is not None else None
+        self._lock = Lock()
+        # an empty name is a private on-disk database that SQLite deletes when it is closed
+        self._connection = sqlite3.connect(
+            str(self.path) if self.path is not None else "",
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "HarvestStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def header(self) -> list[str] | None:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'header'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def set_header(self, header: Sequence[str]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('header', ?)",
+                (json.dumps(list(header)),),
+            )
+
+    def harvested(self, query: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM listings WHERE query = ? LIMIT 1", (query,)
+            ).fetchone()
+        return row is not None
+
+    def add_listing(self, query: str, rows: Sequence[Sequence[str]]) -> None:
+        """
+        Save the listing rows of one query, all at once, replacing any it had before.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._connection.execute("DELETE FROM listings WHERE query = ?", (query,))
+                for row in rows:
+                    key = product_key(row[URL_COLUMN])
+                    self._connection.execute(
+                        "INSERT INTO listings (query, key, data) VALUES (?, ?, ?)",
+                        (query, key, json.dumps(list(row))),
+                    )
+                    self._connection.execute(
+                        "INSERT OR IGNORE INTO products (key, url) VALUES (?, ?)",
+                        (key, row[URL_COLUMN]),
+                    )
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def unscraped(self) -> list[tuple[str, str]]:
+        """
+        The ``(key, url)`` of every product whose page hasn't been scraped yet.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT key, url FROM products WHERE sections IS NULL ORDER BY rowid"
+            ).fetchall()
+
+    def set_sections(self, key: str, sections: tuple[str, str, str]) -> None:
+        with self._lock:
+            self._connection.execute(
+                "UPDATE products SET sections = ?, error = NULL WHERE key = ?",
+                (json.dumps(list(sections)), key),
+            )
+
+    def set_error(self, key: str, error: str) -> None:
+        with self._lock:
+            self._connection.execute("UPDATE products SET error = ? WHERE key = ?", (error, key))
+
+    def counts(self) -> tuple[int, int]:
+        """
+        How many listing rows and how many distinct products there are.
+        """
+        with self._lock:
+            (listings,) = self._connection.execute("SELECT COUNT(*) FROM listings").fetchone()
+            (products,) = self._connection.execute("SELECT COUNT(*) FROM products").fetchone()
+        return listings, products
+
+    def write_joined(self, csv_writer: Writer, *, write_header: bool = True) -> int:
+        """
+        Write every listing row that hasn't been written before with its product's text sections filled in.
+        Products whose page couldn't be scraped keep empty sections.
+
+        Returns:
+            The number of rows written.
+        """
+        header = self.header()
+        if write_header and header is not None:
+            csv_writer.writerow(header)
+        written = 0
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT listings.id, listings.data, products.sections FROM listings "
+                "JOIN products ON products.key = listings.key WHERE NOT listings.exported "
+                "ORDER BY listings.id"
+            ).fetchall()
+        for _, data, sections in rows:
+            row = json.loads(data)
+            if sections is not None:
+                row[SECTIONS_COLUMNS] = json.loads(sections)
+            csv_writer.writerow(row)
+            written += 1
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE listings SET exported = 1 WHERE id = ?", [(id,) for id, _, _ in rows]
+            )
+        return written
+
+
+class HarvestWriter:
+    """
+    A stand-in for a CSV writer that collects the listing rows of one query for a ``HarvestStore``.
+
+    Rows are kept back until ``commit``, so a query that fails halfway doesn't leave half its listing behind.
+    Committed rows are also written to ``listings``, if given, so the listing data can be used before the second pass.
+    The header only goes to ``listings`` if ``listings_header`` says it doesn't have one yet.
+    """
+
+    def __init__(
+        self,
+        store: HarvestStore,
+        query: str,
+        *,
+        expect_header: bool = False,
+        listings: Writer | None = None,
+        listings_header: bool = True,
+    ) -> None:
+        self.store = store
+        self.query = query
+        self.expect_header = expect_header
+        self.listings = listings
+        self.listings_header = listings_header
+        self.rows: list[list[str]] = []
+
+    def writerow(self, row: Sequence[str]) -> None:
+        if self.expect_header:
+            self.expect_header = False
+            self.store.set_header(row)
+            if self.listings is not None and self.listings_header:
+                self.listings.writerow(row)
+            return
+        self.rows.append(list(row))
+
+    def commit(self) -> int:
+        self.store.add_listing(self.query, self.rows)
+        if self.listings is not None:
+            self.listings.writerows(self.rows)
+        return len(self.rows)
+
+
+def scrape_product_page(
+    driver: WebDriver,
+    url: str,
+    *,
+    blocked_urls: Sequence[str] = (),
+    page_budget: float | None = None,
+) -> tuple[str, str, str]:
+    """
+    Scrape a product page's text sections, the same way the first pass would have.
+    """
+    budget = Deadline(page_budget)
+    with budget.limiting(driver) as limits:
+        html = fetch_product_page(
+            driver,
+            budget.wait(driver, limits.implicit_wait),
+            url,
+            return_to=driver.current_window_handle,
+            blocked_urls=blocked_urls,
+        )
+    return parse_product_page(html)
+
+
+@dataclass
+class DeepPassResult:
+    scraped: int = 0
+    failed: int = 0
+    drivers: int = 0
+    driver_failures: int = 0  # drivers that failed to start
+
+
+def deep_scrape_pass(
+    store: HarvestStore,
+    *,
+    new_driver: Callable[[], WebDriver | None],
+    scrape_page: Callable[[WebDriver, str], tuple[str, str, str]] = scrape_product_page,
+    workers: int = DEFAULT_DEEP_WORKERS,
+    pages_per_driver: int = DEFAULT_PAGES_PER_DRIVER,
+    close_driver: Callable[[WebDriver], None] = lambda driver: driver.quit(),
+    retry_backoff: float = DRIVER_RETRY_BACKOFF,
+) -> DeepPassResult:
+    """
+    Scrape the page of every product the first pass found, each exactly once, with ``workers`` drivers at a time.
+
+    Product pages don't need the AMZScout extension, so ``new_driver`` can make plain drivers. A driver is replaced
+    after ``pages_per_driver`` pages, or after a few failures in a row. A driver that fails to start is tried again
+    after ``retry_backoff`` seconds, doubling every time, and a worker that can't start one a few times in a row stops.
+
+    Raises:
+        RuntimeError: If every worker stopped with products left to scrape
+    """
+    pending: Queue[tuple[str, str]] = Queue()
+    for product in store.unscraped():
+        pending.put(product)
+    total = pending.qsize()
+    result = DeepPassResult()
+    lock = Lock()
+    logger.info(f"Deep scraping {total} products with {workers} drivers...")
+
+    def work() -> None:
+        driver: WebDriver | None = None
+        uses = 0
+        consecutive_failures = 0
+        try:
+            while True:
+                try:
+                    key, url = pending.get_nowait()
+                except Empty:
+                    return
+                if driver is not None and (
+                    uses >= pages_per_driver or consecutive_failures >= MAX_CONSECUTIVE_FAILURES
+                ):
+                    close_driver(driver)
+                    driver = None
+                start_failures = 0
+                while driver is None:
+                    logger.info("Attempting to create a new driver...")
+                    try:
+                        driver = new_driver()
+                    except Exception as e:
+                        start_failures += 1
+                        with lock:
+                            result.driver_failures += 1
+                        if start_failures >= MAX_CONSECUTIVE_FAILURES:
+                            logger.error(f"Could not start a driver, stopping this worker: {e!r}")
+                            pending.put((key, url))  # for another worker, if any are left
+                            return
+                        delay = retry_backoff * 2 ** (start_failures - 1)
+                        logger.warning(f"Could not start a driver, retrying in {delay:.0f}s: {e!r}")
+                        sleep(delay)
+                        continue
+                    uses = 0
+                    consecutive_failures = 0
+                    with lock:
+                        result.drivers += 1
+                uses += 1
+                try:
+                    sections = scrape_page(driver, url)
+                except Exception as e:
+                    logger.warning(f"Could not deep scrape {url}: {e!r}")
+                    store.set_error(key, repr(e))
+                    consecutive_failures += 1
+                    with lock:
+                        result.failed += 1
+                    continue
+                store.set_sections(key, sections)
+                consecutive_failures = 0
+                with lock:
+                    result.scraped += 1
+                    done = result.scraped + result.failed
+                logger.info(f"Deep scraped {done}/{total}: {url}")
+        finally:
+            if driver is not None:
+                close_driver(driver)
+
+    threads = [Thread(target=work, name=f"DeepScrape-{i}") for i in range(min(workers, total))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if not pending.empty():
+        raise RuntimeError(
+            f"The deep pass stopped with {pending.qsize()} products left to scrape,"
+            f" after {result.driver_failures} drivers failed to start"
+        )
+    return result
+
+
+__all__ = (
+    "DEFAULT_DEEP_WORKERS",
+    "DEFAULT_PAGES_PER_DRIVER",
+    "HarvestStore",
+    "HarvestWriter",
+    "scrape_product_page",
+    "DeepPassResult",
+    "deep_scrape_pass",
+)
@@ -18,9 +18,16 @@ permissions and limitations under the License.
 """
 import functools
 import logging
+import threading
 import time
 import warnings
-from typing import Mapping, TypeVar
+from contextlib import contextmanager
+from typing import Iterator, Mapping, TypeVar
+
+from selenium.common import TimeoutException
+from selenium.webdriver.common.timeouts import Timeouts
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.support.wait import WebDriverWait
 
 K = TypeVar("K")
 V = TypeVar("V")
@@ -68,6 +75,7 @@ def retry(tries=5, backoff_seconds=1):
                         type(e) == KeyboardInterrupt
                         or type(e) == SystemExit
                         or type(e) == NotImplementedError
+                        or isinstance(e, DeadlineExceeded)
                     ):
                         raise
 
@@ -76,6 +84,11 @@ def retry(tries=5, backoff_seconds=1):
 
                     sleep = backoff_seconds * 2**attempts
 
+                    # there's no point waiting for an attempt that would start after the deadline
+                    budget = current_deadline()
+                    if budget.remaining is not None and budget.remaining <= sleep:
+                        raise budget.exceeded(f"retrying {f.__name__}") from e
+
                     logger.exception(f"Retrying {f.__name__} in {sleep} seconds due to {e}")
 
                     time.sleep(sleep)
@@ -86,8 +99,152 @@ def retry(tries=5, backoff_seconds=1):
     return rwb
 
 
-# TODO: add timeout context manager
-# https://stackoverflow.com/questions/2281850/timeout-function-if-it-takes-too-long-to-finish
-
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a piece of work has used up its time budget.
+    """
+
+
+class Deadline:
+    """
+    A time budget that every wait, navigation, request and retry inside it takes its timeout from.
+
+    Waits don't add up past the deadline: each one gets whatever is left, or its own limit if that is shorter.
+    A deadline of None seconds never expires, so code can always take one.
+    """
+
+    def __init__(self, seconds: float | None = None) -> None:
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+
+    @property
+    def remaining(self) -> float | None:
+        return max(self.expires - time.monotonic(), 0.0) if self.expires is not None else None
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def exceeded(self, doing: str = "") -> DeadlineExceeded:
+        while_doing = f" while {doing}" if doing else ""
+        return DeadlineExceeded(f"Ran over a budget of {self.seconds}s{while_doing}")
+
+    def check(self, doing: str = "") -> None:
+        if self.expired:
+            raise self.exceeded(doing)
+
+    def timeout(self, limit: float | None = None) -> float | None:
+        """
+        How long the next wait may take: whatever is left, but no more than ``limit``.
+
+        Raises:
+            DeadlineExceeded: If nothing is left
+        """
+        remaining = self.remaining
+        if remaining is None:
+            return limit
+        if remaining <= 0:
+            raise self.exceeded()
+        return min(remaining, limit) if limit is not None else remaining
+
+    def sleep(self, seconds: float) -> None:
+        """
+        Sleep, unless the deadline would pass first, in which case give up right away instead.
+        """
+        remaining = self.remaining
+        if remaining is not None and remaining < seconds:
+            raise self.exceeded("sleeping")
+        time.sleep(seconds)
+
+    def wait(self, driver: WebDriver, limit: float) -> WebDriverWait:
+        return WebDriverWait(driver, self.timeout(limit))
+
+    def apply_to(self, driver: WebDriver, limits: Timeouts) -> None:
+        """
+        Cut the driver's implicit wait, page load and script timeouts down to what is left.
+
+        This only costs a command once the deadline is closer than the driver's own timeouts.
+        """
+        remaining = self.remaining
+        longest = max(
+            (limit for limit in (limits.implicit_wait, limits.page_load, limits.script) if limit),
+            default=0.0,
+        )
+        if remaining is None or remaining >= longest:
+            return
+        if remaining <= 0:
+            raise self.exceeded()
+        driver.timeouts = Timeouts(
+            implicit_wait=min(limits.implicit_wait, remaining),
+            page_load=min(limits.page_load or remaining, remaining),
+            script=min(limits.script or remaining, remaining),
+        )
 
-__all__ = ("reverse_map", "deprecated", "retry")
+    @contextmanager
+    def limiting(self, driver: WebDriver) -> Iterator[Timeouts]:
+        """
+        Run some browser work under this deadline.
+
+        Selenium's timeouts become ``DeadlineExceeded`` once the deadline has passed, and the driver gets its own
+        timeouts back afterwards.
+
+        Yields:
+            The driver's own timeouts, for ``apply_to``.
+        """
+        limits = driver.timeouts
+        try:
+            yield limits
+        except TimeoutException as e:
+            if self.expired:
+                raise self.exceeded() from e
+            raise
+        finally:
+            if self.expires is not None:
+                try:
+                    driver.timeouts = limits
+                except Exception as e:
+                    logger.debug(f"Could not restore the driver's timeouts: {e}")
+
+
+_local = threading.local()
+_UNBOUNDED = Deadline()
+
+
+def current_deadline() -> Deadline:
+    """
+    The deadline this thread is working under, which never expires if there is none.
+    """
+    return getattr(_local, "deadline", None) or _UNBOUNDED
+
+
+@contextmanager
+def deadline(seconds: float | None) -> Iterator[Deadline]:
+    """
+    Give the work in this block a time budget. Nested deadlines never outlast the ones around them.
+
+    Example:
+        ::
+
+            with deadline(300) as budget:
+                search_and_write_amazon(driver, csv_writer, query, budget=budget)
+    """
+    outer = current_deadline()
+    budget = Deadline(seconds)
+    if outer.expires is not None and (budget.expires is None or outer.expires < budget.expires):
+        budget = outer
+    _local.deadline = budget
+    try:
+        yield budget
+    finally:
+        _local.deadline = outer if outer is not _UNBOUNDED else None
+
+
+__all__ = (
+    "reverse_map",
+    "deprecated",
+    "retry",
+    "DeadlineExceeded",
+    "Deadline",
+    "current_deadline",
+    "deadline",
+)
@@ -0,0 +1,109 @@
+"""
+Tests for the account pool.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import sqlite3
+
+import pytest
+
+from amzscoutscrape.accounts import AccountPool
+
+from . import TestResources
+
+COOKIES = [{"name": "session", "value": "abc", "domain": ".amzscout.net", "path": "/"}]
+STORAGE = {"chrome": {"token": "xyz"}, "local": {}}
+
+
+class TestAccountPool:
+    def test_checkout_restores_session(self):
+        with TestResources.temp_dir() as path, AccountPool(path / "accounts.sqlite3") as pool:
+            pool.add("a@example.com", COOKIES, STORAGE, quota=3)
+            assert pool.ready_count() == 1
+
+            account = pool.checkout()
+            assert account is not None
+            assert account.email == "a@example.com"
+            assert account.cookies == COOKIES
+            assert account.storage == STORAGE
+            assert account.uses_remaining == 3
+            # checked out accounts aren't handed out twice
+            assert pool.checkout() is None
+            assert pool.ready_count() == 0
+
+    def test_release_returns_leftover_quota(self):
+        with TestResources.temp_dir() as path, AccountPool(path / "accounts.sqlite3") as pool:
+            pool.add("a@example.com", COOKIES, STORAGE, quota=3)
+            account = pool.checkout()
+            assert pool.record_use(account.id) == 2
+            pool.release(account.id)
+            assert pool.checkout().uses_remaining == 2
+
+    def test_exhausted_accounts_are_retired(self):
+        with TestResources.temp_dir() as path, AccountPool(path / "accounts.sqlite3") as pool:
+            pool.add("a@example.com", COOKIES, STORAGE, quota=1)
+            account = pool.checkout()
+            assert pool.record_use(account.id) == 0
+            pool.release(account.id)
+            assert pool.checkout() is None
+
+    def test_stale_checkout_is_reissued(self):
+        with TestResources.temp_dir() as path, AccountPool(
+            path / "accounts.sqlite3", checkout_seconds=-1
+        ) as pool:
+            pool.add("a@example.com", COOKIES, STORAGE)
+            first = pool.checkout()
+            assert pool.checkout().id == first.id
+
+    def test_failed_accounts_sit_out_and_come_back(self):
+        with TestResources.temp_dir() as path, AccountPool(
+            path / "accounts.sqlite3", failure_cooldown_seconds=60
+        ) as pool:
+            pool.add("a@example.com", COOKIES, STORAGE, quota=3)
+            account = pool.checkout()
+            assert pool.record_failure(account.id, "chromedriver crashed") == 60
+            assert pool.checkout() is None
+            # every failure in a row doubles the wait
+            assert pool.record_failure(account.id, "chromedriver crashed") == 120
+            # a search that works forgets them
+            pool.record_use(account.id)
+            assert pool.record_failure(account.id, "chromedriver crashed") == 60
+
+        with TestResources.temp_dir() as path, AccountPool(
+            path / "accounts.sqlite3", failure_cooldown_seconds=-1
+        ) as pool:
+            pool.add("a@example.com", COOKIES, STORAGE, quota=3)
+            pool.record_failure(pool.checkout().id, "chromedriver crashed")
+            # not retired, just waiting
+            assert pool.checkout().uses_remaining == 3
+
+    def test_pools_without_failures_are_upgraded(self):
+        with TestResources.temp_dir() as path:
+            connection = sqlite3.connect(path / "accounts.sqlite3")
+            connection.execute(
+                "CREATE TABLE accounts (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, "
+                "cookies TEXT NOT NULL, storage TEXT NOT NULL, uses_remaining INTEGER NOT NULL, "
+                "created REAL NOT NULL, checked_out_until REAL, retired TEXT)"
+            )
+            connection.commit()
+            connection.close()
+            with AccountPool(path / "accounts.sqlite3") as pool:
+                pool.add("a@example.com", COOKIES, STORAGE)
+                assert pool.record_failure(pool.checkout().id, "chromedriver crashed") > 0
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,203 @@
+"""
+Tests for the snapshot archive and re-parsing it.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+import json
+
+import pytest
+
+from amzscoutscrape.archive import SnapshotArchive
+from amzscoutscrape.output import open_input
+from amzscoutscrape.reparse import reparse
+from amzscoutscrape.scrape import parse_listing_html, product_sections_html, products_from_api
+
+from . import TestResources
+
+LISTING = """
+<div class="l-appwrap">
+  <div class="maintable-header">
+    <span class="ng-binding">#</span><span class="ng-binding">Product Name</span>
+    <span class="ng-binding">Price</span>
+  </div>
+  <div class="maintable">
+    <div class="maintable__row">
+      <div class="scout-col"></div><div class="scout-col"></div>
+      <div class="scout-col">1</div>
+      <div class="scout-col">
+        <span class="preview-img ng-scope" style='background-image: url("https://m.media-amazon.com/a.jpg")'></span>
+        <a class="ng-binding" href="/Widget/dp/B000000001">Widget</a>
+      </div>
+      <div class="scout-col">$10.00</div>
+    </div>
+    <div class="maintable__row">
+      <div class="scout-col"></div><div class="scout-col"></div>
+      <div class="scout-col">2</div>
+      <div class="scout-col"><a class="ng-binding" href="/Gadget/dp/B000000002">Gadget</a></div>
+      <div class="scout-col">$5.00</div>
+    </div>
+  </div>
+</div>
+"""
+PRODUCT_PAGE = """
+<html><body>
+  <div id="nav">lots of navigation</div>
+  <div id="productDescription">A fine widget.</div>
+  <div id="feature-bullets">It widgets.</div>
+</body></html>
+"""
+WIDGET_URL = "https://www.amazon.com/Widget/dp/B000000001"
+
+
+class TestArchive:
+    def test_parse_listing_html(self):
+        column_names, products = parse_listing_html(LISTING)
+        assert column_names[:4] == ["#", "Thumbnail Image", "Product Name", "URL"]
+        assert column_names[-2:] == ["Price", "API Data"]
+        assert [product.url for product in products] == [
+            WIDGET_URL,
+            "https://www.amazon.com/Gadget/dp/B000000002",
+        ]
+        assert products[0].image_url == "https://m.media-amazon.com/a.jpg"
+        assert products[0].metrics == ["$10.00"]
+        assert products[1].image_url is None
+
+    def test_products_from_api(self):
+        column_names, dom_products = parse_listing_html(LISTING)
+        records = {
+            "B000000001": {"asin": "B000000001", "title": "Widget", "price": "$10.00"},
+            "B000000002": {"ASIN": "B000000002", "name": "Gadget", "Price": 5, "sales": 3},
+        }
+        products = products_from_api(column_names, records)
+        assert [product.name for product in products] == ["Widget", "Gadget"]
+        assert products[1].url == "https://www.amazon.com/dp/B000000002"
+        assert [product.metrics for product in products] == [["$10.00"], ["5"]]
+        # the same columns as a row read from the table, with the record at the end
+        rows = [product.to_csv_row() for product in products]
+        assert len(rows[0]) == len(dom_products[0].to_csv_row()) == len(column_names)
+        assert json.loads(rows[1][-1]) == records["B000000002"]
+        assert dom_products[0].to_csv_row()[-1] == ""
+
+    def test_products_from_api_needs_every_column(self):
+        records = {"B000000001": {"asin": "B000000001", "price": "$10.00"}}
+        column_names, _ = parse_listing_html(LISTING.replace(">Price<", ">Mystery<"))
+        with pytest.raises(ValueError, match="Mystery"):
+            products_from_api(column_names, records)
+        column_names, _ = parse_listing_html(LISTING.replace(">Price<", ">Rating<"))
+        with pytest.raises(ValueError, match="Rating"):
+            products_from_api(column_names, records)
+
+    def test_objects_are_content_addressed(self):
+        with TestResources.temp_dir() as path:
+            archive = SnapshotArchive(path / "archive")
+            assert archive.put_text("page") == archive.put_text("page")
+            assert archive.get_text(archive.put_text("page")) == "page"
+
+    def test_reparse(self):
+        with TestResources.temp_dir() as path:
+            archive = SnapshotArchive(path / "archive")
+            snapshot = archive.begin("widgets")
+            snapshot.listing = archive.put_text(LISTING)
+            # the gadget's page never made it, like a deep scrape that failed
+            snapshot.products[WIDGET_URL] = archive.put_text(product_sections_html(PRODUCT_PAGE))
+            snapshot.images["https://m.media-amazon.com/a.jpg"] = (
+                archive.put(b"jpeg"),
+                "image/jpeg",
+            )
+            archive.commit(snapshot)
+
+            assert reparse(path / "archive", path / "out.csv.gz", processes=2) == (1, 1)
+            with open_input(path / "out.csv.gz") as fp:
+                header, row = list(csv.reader(fp))
+
+        assert header[-2:] == ["Price", "API Data"]
+        assert row == [
+            "1",
+            "data:image/jpeg;base64,anBlZw==",
+            "Widget",
+            WIDGET_URL,
+            "A fine widget.",
+            "It widgets.",
+            "",
+            "$10.00",
+            "",
+        ]
+
+    def test_reparse_mixed_extraction_modes(self):
+        responses = [
+            {
+                "url": "https://amzscout.net/api",
+                "status": 200,
+                "body": [{"asin": "B000000003", "price": "$7.00"}],
+            }
+        ]
+        with TestResources.temp_dir() as path:
+            archive = SnapshotArchive(path / "archive")
+            for query, api in (("dom", False), ("api", True)):
+                snapshot = archive.begin(query)
+                snapshot.listing = archive.put_text(LISTING)
+                if api:
+                    snapshot.responses = archive.put_text(json.dumps(responses))
+                snapshot.products["https://www.amazon.com/dp/B000000003"] = archive.put_text("")
+                snapshot.products[WIDGET_URL] = archive.put_text("")
+                archive.commit(snapshot)
+
+            assert reparse(path / "archive", path / "out.csv", processes=1) == (2, 2)
+            with open_input(path / "out.csv") as fp:
+                header, dom_row, api_row = list(csv.reader(fp))
+
+        assert len(header) == len(dom_row) == len(api_row)
+        assert dom_row[-2:] == ["$10.00", ""]
+        assert api_row[-2] == "$7.00"
+        assert json.loads(api_row[-1]) == responses[0]["body"][0]
+
+    def test_reparse_reads_the_table_for_unmapped_columns(self):
+        responses = [
+            {
+                "url": "https://amzscout.net/api",
+                "status": 200,
+                "body": [{"asin": "B000000001", "mystery": "$7.00"}],
+            }
+        ]
+        with TestResources.temp_dir() as path:
+            archive = SnapshotArchive(path / "archive")
+            snapshot = archive.begin("widgets")
+            snapshot.listing = archive.put_text(LISTING)
+            snapshot.responses = archive.put_text(json.dumps(responses))
+            snapshot.products[WIDGET_URL] = archive.put_text("")
+            archive.commit(snapshot)
+
+            assert reparse(path / "archive", path / "out.csv", processes=1) == (1, 1)
+            with open_input(path / "out.csv") as fp:
+                header, row = list(csv.reader(fp))
+
+        assert row[-2] == "$10.00"
+        assert json.loads(row[-1]) == responses[0]["body"][0]
+
+    def test_reparse_rejects_other_columns(self):
+        with TestResources.temp_dir() as path:
+            archive = SnapshotArchive(path / "archive")
+            for listing in (LISTING, LISTING.replace(">Price<", ">Sales<")):
+                snapshot = archive.begin("widgets")
+                snapshot.listing = archive.put_text(listing)
+                archive.commit(snapshot)
+            with pytest.raises(ValueError):
+                reparse(path / "archive", path / "out.csv", processes=1)
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,103 @@
+"""
+Tests for blocking the resources the deep scrape doesn't need.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import re
+
+import pytest
+
+from amzscoutscrape.blocking import (
+    DEFAULT_BLOCKED_RESOURCE_TYPES,
+    apply_url_blocklist,
+    blocked_url_patterns,
+    parse_resource_types,
+)
+
+
+def blocked(url, patterns):
+    # Network.setBlockedURLs patterns match the whole URL, and "*" is their only wildcard
+    return any(
+        re.fullmatch(".*".join(map(re.escape, pattern.split("*"))), url) for pattern in patterns
+    )
+
+
+class CdpDriver:
+    def __init__(self):
+        self.commands = []
+
+    def execute_cdp_cmd(self, cmd, args):
+        self.commands.append((cmd, args))
+        return {}
+
+
+class TestBlocking:
+    def test_parse_resource_types(self):
+        assert parse_resource_types(" image, font,,script ") == ("image", "font", "script")
+        assert parse_resource_types("") == ()
+        with pytest.raises(ValueError):
+            parse_resource_types("image,pictures")
+
+    def test_patterns_are_deduplicated(self):
+        patterns = blocked_url_patterns(["image", "image"], ["*.gif", "*/ads/*"])
+        assert len(patterns) == len(set(patterns))
+        assert patterns[-1] == "*/ads/*"
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "https://m.media-amazon.com/images/I/41abc.jpg",
+            "https://m.media-amazon.com/images/G/01/x.gif?v=2",
+            "https://m.media-amazon.com/fonts/ember.woff2",
+            "https://aax-us-east.amazon-adsystem.com/e/dtb/bid",
+            "https://unagi.amazon.com/1/events/com.amazon.csm",
+        ],
+    )
+    def test_blocks_by_default(self, url):
+        assert blocked(url, blocked_url_patterns())
+
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "https://www.amazon.com/dp/B000000001",
+            "https://www.amazon.com/api/data.json",
+            "https://www.amazon.com/gcx/.gifting/home",
+            "https://www.amazon.com/images/I/21abc.css?AUIClients",
+        ],
+    )
+    def test_keeps_by_default(self, url):
+        assert not blocked(url, blocked_url_patterns(DEFAULT_BLOCKED_RESOURCE_TYPES))
+
+    def test_scripts_but_not_json(self):
+        patterns = blocked_url_patterns(["script"])
+        assert blocked("https://m.media-amazon.com/images/I/61xyz.js?AUIClients/Foo", patterns)
+        assert blocked("https://www.amazon.com/app.js", patterns)
+        assert not blocked("https://www.amazon.com/api/config.json", patterns)
+        assert not blocked("https://www.amazon.com/api/config.json?x=1", patterns)
+
+    def test_apply_url_blocklist(self):
+        driver = CdpDriver()
+        assert apply_url_blocklist(driver, ["*.gif"])
+        assert driver.commands == [
+            ("Network.enable", {}),
+            ("Network.setBlockedURLs", {"urls": ["*.gif"]}),
+        ]
+        assert not apply_url_blocklist(driver, [])
+        assert not apply_url_blocklist(object(), ["*.gif"])
+
+
+if __name__ == "__main__":
+    pytest.main()
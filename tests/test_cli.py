@@ -17,9 +17,11 @@ permissions and limitations under the License.
 
 """
 import contextlib
+import csv
 import io
 
 import pytest
+import typer
 
 from amzscoutscrape import cli
 
@@ -34,5 +36,70 @@ class TestCli:
         assert capture.stderr.strip() == ""
 
 
+class FakeDriver:
+    def quit(self):
+        pass
+
+
+class TestGenerate:
+    def test_a_failed_attempt_writes_nothing(self, monkeypatch):
+        attempts = []
+
+        def search_and_write_amazon(driver, csv_writer, query, *, write_headers, **kwargs):
+            attempts.append(query)
+            if write_headers:
+                csv_writer.writerow(["#", "Product Name"])
+            csv_writer.writerow(["1", f"{query} widget"])
+            if attempts.count(query) == 1 and query == "lamp":
+                raise RuntimeError("the panel never loaded")
+            return []
+
+        monkeypatch.setattr(cli, "create_fresh_driver", lambda **kwargs: FakeDriver())
+        monkeypatch.setattr(cli, "search_and_write_amazon", search_and_write_amazon)
+        with TestResources.temp_dir() as path:
+            (path / "queries.txt").write_text("lamp\nchair\n")
+            cli.generate(
+                filename=str(path / "out.csv"),
+                queries_file=str(path / "queries.txt"),
+                retry_backoff=0,
+                block_resources="",
+                block_pattern=[],
+            )
+            with open(path / "out.csv", newline="") as fp:
+                rows = list(csv.reader(fp))
+
+        # the first attempt at "lamp" failed after writing the header and a row; the retry wrote them once
+        assert attempts.count("lamp") == 2
+        assert rows[0] == ["#", "Product Name"]
+        assert sorted(rows[1:]) == [["1", "chair widget"], ["1", "lamp widget"]]
+
+    def test_a_bad_shard_is_a_bad_parameter(self, monkeypatch):
+        monkeypatch.setattr(cli, "create_fresh_driver", lambda **kwargs: FakeDriver())
+        with TestResources.temp_dir() as path:
+            (path / "queries.txt").write_text("lamp\n")
+            with pytest.raises(typer.BadParameter) as e:
+                cli.generate(
+                    filename=str(path / "out.csv"),
+                    queries_file=str(path / "queries.txt"),
+                    shard="4/4",
+                    block_resources="",
+                    block_pattern=[],
+                )
+        assert e.value.param_hint == "--shard"
+
+    def test_a_bad_resource_type_is_a_bad_parameter(self, monkeypatch):
+        monkeypatch.setattr(cli, "create_fresh_driver", lambda **kwargs: FakeDriver())
+        with TestResources.temp_dir() as path:
+            (path / "queries.txt").write_text("lamp\n")
+            with pytest.raises(typer.BadParameter) as e:
+                cli.generate(
+                    filename=str(path / "out.csv"),
+                    queries_file=str(path / "queries.txt"),
+                    block_resources="holograms",
+                    block_pattern=[],
+                )
+        assert e.value.param_hint == "--block-resources"
+
+
 if __name__ == "__main__":
     pytest.main()
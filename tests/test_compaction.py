@@ -0,0 +1,112 @@
+"""
+Tests for merging and deduplicating output files.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+
+import pytest
+
+from amzscoutscrape.compaction import compact
+from amzscoutscrape.output import open_input, open_output
+
+from . import TestResources
+
+HEADER = ["#", "Product Name", "URL", "Price"]
+
+
+def url(asin: str) -> str:
+    return f"https://www.amazon.com/x/dp/{asin}/ref=sr_1_1"
+
+
+def write(path, rows) -> None:
+    with open_output(path) as fp:
+        csv.writer(fp).writerows([HEADER, *rows])
+
+
+class TestCompact:
+    @pytest.mark.parametrize("memory_limit", [1, 1024 * 1024])
+    def test_keeps_newest_row(self, memory_limit):
+        with TestResources.temp_dir() as path:
+            write(
+                path / "old.csv.gz",
+                [
+                    ["1", "Widget", url("B000000002"), "$10"],
+                    ["2", "Gadget", url("B000000001"), "$5"],
+                    ["3", "Widget", url("B000000002"), "$11"],
+                ],
+            )
+            write(path / "new.csv", [["1", "Widget", url("B000000002") + "?th=1", "$12"]])
+
+            report = compact(
+                [path / "old.csv.gz", path / "new.csv"],
+                path / "out.csv",
+                memory_limit=memory_limit,
+            )
+            with open_input(path / "out.csv") as fp:
+                rows = list(csv.reader(fp))
+
+        assert report.rows_read == 4
+        assert report.rows_written == 2
+        assert rows == [
+            HEADER,
+            ["2", "Gadget", url("B000000001"), "$5"],
+            ["1", "Widget", url("B000000002") + "?th=1", "$12"],
+        ]
+
+    def test_merges_in_passes(self):
+        with TestResources.temp_dir() as path:
+            rows = [["1", "Widget", url(f"B0000000{number:02}"), "$1"] for number in range(20)]
+            write(path / "in.csv", rows * 2)
+
+            # every row spills its own run, and only 3 may be open at once
+            report = compact([path / "in.csv"], path / "out.csv", memory_limit=1, max_open_runs=3)
+            with open_input(path / "out.csv") as fp:
+                assert list(csv.reader(fp)) == [HEADER, *rows]
+
+        assert report.runs == 40
+        assert report.merge_passes == 3
+        assert report.rows_written == 20
+
+    def test_skips_malformed_rows(self):
+        with TestResources.temp_dir() as path:
+            write(
+                path / "in.csv",
+                [
+                    ["1", "Widget", url("B000000001"), "$10"],
+                    ["2", "Gad"],  # cut off by a crash
+                    [],
+                    ["3", "Gadget", url("B000000002"), "$5", "extra"],
+                ],
+            )
+            report = compact([path / "in.csv"], path / "out.csv")
+            with open_input(path / "out.csv") as fp:
+                rows = list(csv.reader(fp))
+
+        assert report.malformed_rows == 3
+        assert rows == [HEADER, ["1", "Widget", url("B000000001"), "$10"]]
+
+    def test_mismatched_columns(self):
+        with TestResources.temp_dir() as path:
+            write(path / "a.csv", [])
+            with open_output(path / "b.csv") as fp:
+                csv.writer(fp).writerow(["URL"])
+            with pytest.raises(ValueError):
+                compact([path / "a.csv", path / "b.csv"], path / "out.csv")
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,81 @@
+"""
+Tests for the coordinator queue.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+
+from amzscoutscrape.coordinator import LeaseQueue, LeaseWriter
+
+from . import TestResources
+
+
+class TestLeaseQueue:
+    def test_lease_and_complete(self):
+        with TestResources.temp_dir() as path, LeaseQueue(path / "queue.sqlite3") as queue:
+            assert queue.add(["a", "b", "a"]) == 2
+            assert queue.lease("w1") == "a"
+            assert queue.lease("w2") == "b"
+            assert queue.lease("w3") is None
+
+            writer = LeaseWriter(queue, "a", "w1", expect_header=True)
+            writer.writerow(["#", "Product Name"])
+            writer.writerow(["1", "Widget"])
+            assert writer.commit()
+            assert queue.header() == ["#", "Product Name"]
+            assert queue.export_rows() == [["1", "Widget"]]
+            assert queue.export_rows() == []
+            assert queue.counts()["done"] == 1
+
+    def test_expired_lease_is_reissued(self):
+        with TestResources.temp_dir() as path, LeaseQueue(
+            path / "queue.sqlite3", lease_seconds=-1
+        ) as queue:
+            queue.add(["a"])
+            assert queue.lease("w1") == "a"
+            # the lease is already expired, so the next worker gets it
+            assert queue.lease("w2") == "a"
+            # the first worker lost its lease and can't record rows anymore
+            assert not queue.complete("a", "w1", [["1"]])
+
+    def test_failures_run_out_of_attempts(self):
+        with TestResources.temp_dir() as path, LeaseQueue(
+            path / "queue.sqlite3", max_attempts=2
+        ) as queue:
+            queue.add(["a"])
+            for _ in range(2):
+                assert queue.lease("w1") == "a"
+                queue.fail("a", "w1", "boom")
+            assert queue.lease("w1") is None
+            assert queue.counts()["failed"] == 1
+            assert queue.finished()
+
+    @pytest.mark.parametrize("shared, journal_mode", [(False, "wal"), (True, "delete")])
+    def test_journal_mode(self, shared, journal_mode):
+        with TestResources.temp_dir() as path:
+            with LeaseQueue(path / "queue.sqlite3", shared=shared) as queue:
+                assert (
+                    queue._connection.execute("PRAGMA journal_mode").fetchone()[0] == journal_mode
+                )
+                queue.add(["a"])
+            # a queue that was used on one host can move to a shared volume later
+            with LeaseQueue(path / "queue.sqlite3", shared=True) as queue:
+                assert queue._connection.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+                assert queue.lease("w1") == "a"
+
+
+if __name__ == "__main__":
+    pytest.main()
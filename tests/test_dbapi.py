@@ -0,0 +1,168 @@
+"""
+Tests for the AMZScout database HTTP client.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from requests import HTTPError
+
+from amzscoutscrape.dbapi import DatabaseClient, SearchRequest
+
+PAGE_SIZE = 3
+CATALOG = {
+    "desk lamp": [{"asin": f"B00000000{i}", "title": f"Lamp {i}"} for i in range(7)],
+    "office chair": [{"asin": "B0000000C1", "title": "Chair"}],
+}
+
+
+class _DatabaseStub(BaseHTTPRequestHandler):
+    # the requests that came in, as (path, body)
+    requests: list[tuple[str, dict]] = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append((self.path, body))
+        if self.headers.get("Authorization") != "Bearer token" or "session=abc" not in (
+            self.headers.get("Cookie") or ""
+        ):
+            self.send_response(401)
+            self.end_headers()
+            return
+        products = CATALOG.get(body["filters"]["keywords"][0], [])
+        page = body["page"]
+        data = json.dumps(
+            {"data": {"items": products[page * PAGE_SIZE : (page + 1) * PAGE_SIZE]}}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def stub():
+    _DatabaseStub.requests = []
+    server = HTTPServer(("127.0.0.1", 0), _DatabaseStub)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def search_request(url, query="desk lamp"):
+    return SearchRequest(
+        "POST",
+        f"{url}/api/v1/products/search",
+        {"Authorization": "Bearer token", "Content-Type": "application/json"},
+        json.dumps({"filters": {"keywords": [query]}, "page": 0, "size": PAGE_SIZE}),
+        query,
+    )
+
+
+class TestSearchRequest:
+    def test_for_query_in_the_body(self):
+        request = search_request("https://amzscout.net")
+        method, url, body = request.for_query("office chair", 2)
+        assert method == "POST"
+        assert url == "https://amzscout.net/api/v1/products/search"
+        assert json.loads(body) == {
+            "filters": {"keywords": ["office chair"]},
+            "page": 2,
+            "size": PAGE_SIZE,
+        }
+        assert request.first_page == 0
+
+    def test_for_query_in_the_url(self):
+        request = SearchRequest(
+            "GET", "https://amzscout.net/api/search?q=desk+lamp&pageNumber=1", query="desk lamp"
+        )
+        _, url, body = request.for_query("office chair", 3)
+        assert parse_qs(urlsplit(url).query) == {"q": ["office chair"], "pageNumber": ["3"]}
+        assert body is None
+        assert request.first_page == 1
+
+    def test_unpaginated(self):
+        request = SearchRequest("GET", "https://amzscout.net/api/search?q=lamp", query="lamp")
+        assert request.first_page is None
+
+    def test_from_recorded(self):
+        products = json.dumps({"items": [{"ASIN": "B000000001"}]})
+        recorded = [
+            # static data and requests without the query aren't the search
+            {
+                "method": "GET",
+                "url": "https://amzscout.net/api/user",
+                "status": 200,
+                "response": "{}",
+            },
+            {
+                "method": "GET",
+                "url": "https://amzscout.net/api/top",
+                "status": 200,
+                "response": products,
+            },
+            {
+                "method": "POST",
+                "url": "https://amzscout.net/api/search",
+                "headers": {"Authorization": "Bearer token", "Content-Length": "42"},
+                "body": json.dumps({"keywords": "lamp", "page": 1}),
+                "status": 200,
+                "response": products,
+            },
+        ]
+        request = SearchRequest.from_recorded(recorded, "lamp")
+        assert request is not None
+        assert request.url == "https://amzscout.net/api/search"
+        assert request.headers == {"Authorization": "Bearer token"}
+        assert request.first_page == 1
+        assert SearchRequest.from_recorded(recorded, "chair") is None
+
+
+class TestDatabaseClient:
+    def test_paginates(self, stub):
+        client = DatabaseClient(search_request(stub), {"session": "abc"})
+        records = list(client.search("desk lamp"))
+        assert [record["asin"] for record in records] == [p["asin"] for p in CATALOG["desk lamp"]]
+        # every page until one brings nothing new
+        assert [body["page"] for _, body in _DatabaseStub.requests] == [0, 1, 2, 3]
+
+    def test_other_queries(self, stub):
+        client = DatabaseClient(search_request(stub), {"session": "abc"})
+        assert [record["title"] for record in client.search("office chair")] == ["Chair"]
+        assert list(client.search("nothing")) == []
+
+    def test_max_pages(self, stub):
+        client = DatabaseClient(search_request(stub), {"session": "abc"}, max_pages=2)
+        assert len(list(client.search("desk lamp"))) == 2 * PAGE_SIZE
+
+    def test_session_refused(self, stub):
+        client = DatabaseClient(search_request(stub), {"session": "expired"})
+        with pytest.raises(HTTPError):
+            list(client.search("desk lamp"))
+
+
+if __name__ == "__main__":
+    pytest.main()
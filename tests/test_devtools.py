@@ -0,0 +1,107 @@
+"""
+Tests for the DevTools network capture.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+
+import pytest
+
+from amzscoutscrape.devtools import (
+    CapturedResponse,
+    PerformanceLog,
+    ResponseCapture,
+    products_by_asin,
+)
+
+
+class LoggingDriver:
+    """
+    Plays back DevTools events the way ChromeDriver's performance log hands them out.
+    """
+
+    def __init__(self, events, bodies):
+        self.entries = [{"message": json.dumps({"message": event})} for event in events]
+        self.bodies = bodies
+
+    def get_log(self, log_type):
+        entries, self.entries = self.entries, []
+        return entries
+
+    def execute_cdp_cmd(self, cmd, args):
+        assert cmd == "Network.getResponseBody"
+        return {"body": self.bodies[args["requestId"]], "base64Encoded": False}
+
+
+def response_events(request_id, url, mime_type="application/json"):
+    return [
+        {
+            "method": "Network.responseReceived",
+            "params": {
+                "requestId": request_id,
+                "response": {"url": url, "status": 200, "mimeType": mime_type},
+            },
+        },
+        {"method": "Network.loadingFinished", "params": {"requestId": request_id}},
+    ]
+
+
+class TestResponseCapture:
+    def test_captures_matching_json(self):
+        driver = LoggingDriver(
+            response_events("1", "https://amzscout.net/api/v1/products")
+            + response_events("2", "https://www.amazon.com/some.json")
+            + response_events("3", "https://amzscout.net/logo.png", "image/png"),
+            {"1": '{"items": [{"asin": "B000000001"}]}', "2": "{}", "3": ""},
+        )
+        with ResponseCapture(PerformanceLog(driver)) as capture:
+            assert capture.wait_until_quiet(bool, quiet_seconds=0, timeout=1)
+            assert [response.url for response in capture.responses] == [
+                "https://amzscout.net/api/v1/products"
+            ]
+
+    def test_times_out_without_data(self):
+        driver = LoggingDriver([], {})
+        with ResponseCapture(PerformanceLog(driver)) as capture:
+            assert not capture.wait_until_quiet(bool, quiet_seconds=0, timeout=0.2)
+
+
+class TestProductsByAsin:
+    def test_merges_records_across_responses(self):
+        responses = [
+            CapturedResponse("a", 200, {"data": [{"asin": "b000000001", "price": 10}]}),
+            CapturedResponse("b", 200, [{"ASIN": "B000000001", "sales": 5}, {"asin": ""}]),
+        ]
+        assert products_by_asin(responses) == {
+            "B000000001": {"asin": "b000000001", "price": 10, "ASIN": "B000000001", "sales": 5}
+        }
+
+    def test_skips_nested_variations(self):
+        variations = [{"asin": "B000000002", "price": 11}, {"asin": "B000000003", "price": 12}]
+        responses = [
+            CapturedResponse(
+                "a",
+                200,
+                {"data": [{"asin": "B000000001", "price": 10, "variations": variations}]},
+            )
+        ]
+        products = products_by_asin(responses)
+        assert list(products) == ["B000000001"]
+        assert products["B000000001"]["variations"] == variations
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,110 @@
+"""
+Tests for the pooled HTTP clients.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import urlsplit
+
+import pytest
+
+from amzscoutscrape.httpclient import DNSCache, HttpClient, client_for, close_clients
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://localhost:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+class TestHttpClient:
+    def test_connections_are_reused(self, url):
+        with HttpClient("direct://") as client:
+            for _ in range(5):
+                assert client.get(url, timeout=10).text == "ok"
+            assert client.stats.requests == 5
+            assert client.stats.connections == 1
+            assert client.stats.reused == 4
+
+    def test_threads_share_a_pool(self, url):
+        with HttpClient("direct://", pool_maxsize=4) as client:
+            with ThreadPoolExecutor(4) as executor:
+                assert all(
+                    response.ok for response in executor.map(lambda _: client.get(url), range(40))
+                )
+            assert client.stats.requests == 40
+            assert client.stats.connections <= 4
+            # every connection after the first found the address in the cache
+            assert client.stats.dns_lookups + client.stats.dns_hits == client.stats.connections
+
+    def test_dns_cache(self):
+        cache = DNSCache(ttl=60)
+        assert cache.resolve("127.0.0.1", 80) == ["127.0.0.1"]
+        addresses = cache.resolve("localhost", 80)
+        assert cache.resolve("localhost", 80) == addresses
+        cache.forget("localhost", 80)
+        assert cache._entries == {}
+
+    def test_falls_back_to_the_next_address(self, url, monkeypatch):
+        # the first address refuses connections, like a host whose IPv6 address isn't served
+        resolve = socket.getaddrinfo
+
+        def getaddrinfo(host, port, *args, **kwargs):
+            if host != "localhost":
+                return resolve(host, port, *args, **kwargs)
+            return [
+                (socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))
+                for address in ("127.0.0.2", "127.0.0.2", "127.0.0.1")
+            ]
+
+        monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+        cache = DNSCache(ttl=60)
+        with HttpClient("direct://", dns_cache=cache) as client:
+            assert client.get(url, timeout=10).text == "ok"
+            assert client.stats.connections == 1
+        # duplicates are dropped, and the address that worked goes first next time
+        assert cache.resolve("localhost", urlsplit(url).port) == ["127.0.0.1", "127.0.0.2"]
+
+    def test_one_client_per_proxy(self):
+        try:
+            assert client_for("direct://") is client_for("direct://")
+            assert client_for("direct://") is not client_for(None)
+        finally:
+            close_clients()
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,111 @@
+"""
+Tests for hosting many lanes in one browser.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+
+from amzscoutscrape.lanes import BrowserHost
+
+
+class HostDriver:
+    """
+    Records the DevTools commands sent to the browser, and hands out target IDs.
+    """
+
+    def __init__(self, capabilities=None):
+        self.capabilities = (
+            capabilities
+            if capabilities is not None
+            else {"goog:chromeOptions": {"debuggerAddress": "127.0.0.1:9222"}}
+        )
+        self.commands = []
+        self.targets = 0
+
+    def execute_cdp_cmd(self, cmd, args):
+        self.commands.append((cmd, args))
+        if cmd == "Target.createTarget":
+            self.targets += 1
+            return {"targetId": f"target-{self.targets}"}
+        return {}
+
+
+class LaneDriver:
+    def __init__(self, target_id, fail_on_quit=False):
+        self.target_id = target_id
+        self.fail_on_quit = fail_on_quit
+        self.quit_called = False
+
+    def quit(self):
+        self.quit_called = True
+        if self.fail_on_quit:
+            raise RuntimeError("chromedriver is gone")
+
+
+class FakeHost(BrowserHost):
+    # attaches fake sessions instead of starting chromedriver
+    def __init__(self, driver, *, fail_attach=False, **kwargs):
+        super().__init__(driver, **kwargs)
+        self.fail_attach = fail_attach
+
+    def _attach(self, target_id):
+        if self.fail_attach:
+            raise RuntimeError("could not attach")
+        return LaneDriver(target_id, fail_on_quit=target_id == "target-1")
+
+
+class TestBrowserHost:
+    def test_only_chromium(self):
+        with pytest.raises(NotImplementedError):
+            BrowserHost(HostDriver(capabilities={"browserName": "firefox"}))
+
+    def test_lanes_are_tabs_of_the_default_context(self):
+        driver = HostDriver()
+        with FakeHost(driver) as host:
+            lanes = [host.open_lane(), host.open_lane()]
+            assert [lane.target_id for lane in lanes] == ["target-1", "target-2"]
+            assert [lane.driver.target_id for lane in lanes] == ["target-1", "target-2"]
+            # no browser contexts, which the extension wouldn't run in
+            assert driver.commands == [("Target.createTarget", {"url": "about:blank"})] * 2
+
+    def test_closing_cleans_up_every_lane(self):
+        driver = HostDriver()
+        host = FakeHost(driver)
+        lanes = [host.open_lane(), host.open_lane()]
+        host.close_lane(lanes[1])
+        assert lanes[1].driver.quit_called
+        assert host.lanes == [lanes[0]]
+        # a lane whose session won't quit still has its tab closed
+        host.close()
+        assert host.lanes == []
+        assert [
+            args["targetId"] for cmd, args in driver.commands if cmd == "Target.closeTarget"
+        ] == [
+            "target-2",
+            "target-1",
+        ]
+
+    def test_a_lane_that_cannot_attach_closes_its_tab(self):
+        driver = HostDriver()
+        host = FakeHost(driver, fail_attach=True)
+        with pytest.raises(RuntimeError):
+            host.open_lane()
+        assert host.lanes == []
+        assert driver.commands[-1] == ("Target.closeTarget", {"targetId": "target-1"})
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,117 @@
+"""
+Tests for output files.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+import subprocess
+import sys
+
+import pytest
+
+from amzscoutscrape import output
+from amzscoutscrape.output import has_content, open_input, open_output
+
+from . import TestResources
+
+
+def _append_and_read(path) -> list[list[str]]:
+    for rows in ([["#", "Product Name"], ["1", "Widget"]], [["2", "Gadget, large"]]):
+        with open_output(path, append=has_content(path)) as fp:
+            csv.writer(fp).writerows(rows)
+    with open_input(path) as fp:
+        return list(csv.reader(fp))
+
+
+# writes a row, flushes, starts on a large row and dies without closing the file
+_CRASH = """
+import base64, csv, os, sys
+from amzscoutscrape.output import open_output
+fp = open_output(sys.argv[1])
+writer = csv.writer(fp)
+writer.writerows([["#", "Product Name"], ["1", "Widget"]])
+fp.flush()
+writer.writerow(["2", base64.b64encode(os.urandom(1 << 20)).decode()])
+os._exit(1)
+"""
+
+
+def _crash_resume_and_read(path) -> list[list[str]]:
+    subprocess.run([sys.executable, "-c", _CRASH, str(path)], check=False)
+    with open_output(path, append=has_content(path)) as fp:
+        csv.writer(fp).writerow(["3", "Gadget"])
+    with open_input(path) as fp:
+        return list(csv.reader(fp))
+
+
+class TestOutput:
+    @pytest.mark.parametrize("name", ["out.csv", "out.csv.gz"])
+    def test_append(self, name):
+        with TestResources.temp_dir() as path:
+            rows = _append_and_read(path / name)
+        assert rows == [["#", "Product Name"], ["1", "Widget"], ["2", "Gadget, large"]]
+
+    def test_append_zstd(self):
+        if output.zstandard is None:
+            pytest.skip("zstandard is not installed")
+        with TestResources.temp_dir() as path:
+            rows = _append_and_read(path / "out.csv.zst")
+        assert rows == [["#", "Product Name"], ["1", "Widget"], ["2", "Gadget, large"]]
+
+    @pytest.mark.parametrize("name", ["out.csv.gz", "out.csv.zst"])
+    def test_resume_after_a_crash(self, name):
+        if name.endswith(".zst") and output.zstandard is None:
+            pytest.skip("zstandard is not installed")
+        with TestResources.temp_dir() as path:
+            rows = _crash_resume_and_read(path / name)
+        # the row that was being written when the process died is gone, everything flushed before it isn't
+        assert rows == [["#", "Product Name"], ["1", "Widget"], ["3", "Gadget"]]
+
+    def test_append_only_reads_what_came_after_the_last_flush(self, monkeypatch):
+        scans = []
+        scan_members = output._scan_members
+
+        def recording_scan_members(path, compression, start):
+            scans.append(start)
+            return scan_members(path, compression, start)
+
+        monkeypatch.setattr(output, "_scan_members", recording_scan_members)
+        with TestResources.temp_dir() as path:
+            subprocess.run([sys.executable, "-c", _CRASH, str(path / "out.csv.gz")], check=False)
+            flushed = int((path / "out.csv.gz.flushed").read_text())
+            with open_output(path / "out.csv.gz", append=True) as fp:
+                csv.writer(fp).writerow(["3", "Gadget"])
+            with open_input(path / "out.csv.gz") as fp:
+                rows = list(csv.reader(fp))
+        assert rows == [["#", "Product Name"], ["1", "Widget"], ["3", "Gadget"]]
+        # only the row the crash cut short was decompressed
+        assert scans == [flushed] and flushed > 0
+
+    def test_append_reads_everything_when_the_last_flush_is_wrong(self):
+        with TestResources.temp_dir() as path:
+            with open_output(path / "out.csv.gz") as fp:
+                csv.writer(fp).writerows([["#", "Product Name"], ["1", "Widget"]])
+            # in the middle of the member, as if the file had been replaced
+            (path / "out.csv.gz.flushed").write_text("3")
+            with open_output(path / "out.csv.gz", append=True) as fp:
+                csv.writer(fp).writerow(["2", "Gadget"])
+            with open_input(path / "out.csv.gz") as fp:
+                rows = list(csv.reader(fp))
+        assert rows == [["#", "Product Name"], ["1", "Widget"], ["2", "Gadget"]]
+
+
+if __name__ == "__main__":
+    pytest.main()
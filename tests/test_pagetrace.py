@@ -0,0 +1,188 @@
+"""
+Tests for the per-page network traces.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import io
+import json
+
+import pytest
+
+from amzscoutscrape.devtools import PerformanceLog
+from amzscoutscrape.pagetrace import NetworkTracer, page_kind
+
+SEARCH = "https://www.amazon.com/s?k=desk+lamp"
+PRODUCT = "https://www.amazon.com/Desk-Lamp/dp/B000000001"
+
+
+class LoggingDriver:
+    """
+    Plays back DevTools events the way ChromeDriver's performance log hands them out.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.commands = []
+
+    def load(self, events, webview="tab-1"):
+        self.entries += [
+            {"message": json.dumps({"message": event, "webview": webview})} for event in events
+        ]
+
+    def get_log(self, log_type):
+        entries, self.entries = self.entries, []
+        return entries
+
+    def execute_cdp_cmd(self, cmd, args):
+        self.commands.append(cmd)
+        if cmd == "Performance.getMetrics":
+            return {"metrics": [{"name": "Nodes", "value": 1200}, {"name": "Frames", "value": 3}]}
+        return {}
+
+
+def page_events(loader, url, started, resources):
+    events = [
+        {
+            "method": "Network.requestWillBeSent",
+            "params": {
+                "requestId": loader,
+                "loaderId": loader,
+                "type": "Document",
+                "request": {"url": url},
+                "timestamp": started,
+            },
+        },
+        {
+            "method": "Network.responseReceived",
+            "params": {"requestId": loader, "response": {}, "timestamp": started + 0.2},
+        },
+        {
+            "method": "Network.loadingFinished",
+            "params": {
+                "requestId": loader,
+                "encodedDataLength": 50_000,
+                "timestamp": started + 0.3,
+            },
+        },
+    ]
+    for i, (resource, size) in enumerate(resources):
+        request = f"{loader}.{i}"
+        events.append(
+            {
+                "method": "Network.requestWillBeSent",
+                "params": {
+                    "requestId": request,
+                    "loaderId": loader,
+                    "type": resource,
+                    "request": {"url": f"https://m.media-amazon.com/{i}"},
+                    "timestamp": started + 0.4,
+                },
+            }
+        )
+        if size is None:
+            events.append({"method": "Network.loadingFailed", "params": {"requestId": request}})
+        else:
+            events.append(
+                {
+                    "method": "Network.loadingFinished",
+                    "params": {
+                        "requestId": request,
+                        "encodedDataLength": size,
+                        "timestamp": started + 0.9,
+                    },
+                }
+            )
+    events += [
+        {"method": "Page.domContentEventFired", "params": {"timestamp": started + 0.5}},
+        {"method": "Page.loadEventFired", "params": {"timestamp": started + 1.0}},
+    ]
+    return events
+
+
+class TestPageKind:
+    def test_kinds(self):
+        assert page_kind(SEARCH) == "search"
+        assert page_kind(PRODUCT) == "product"
+        assert page_kind("https://www.amazon.com/gp/product/B000000001") == "product"
+        assert page_kind("https://amzscout.net/") == "other"
+
+
+class TestNetworkTracer:
+    def test_records_a_page(self):
+        driver = LoggingDriver()
+        output = io.StringIO()
+        tracer = NetworkTracer(output)
+        log = PerformanceLog(driver)
+        with tracer.recording(log, query="desk lamp", proxy="http://proxy:8080"):
+            driver.load(
+                page_events(
+                    "L1", SEARCH, 100.0, [("Image", 20_000), ("Image", 10_000), ("Script", None)]
+                )
+            )
+        assert driver.commands == ["Performance.enable", "Performance.getMetrics"]
+
+        (line,) = output.getvalue().splitlines()
+        page = json.loads(line)
+        assert page["url"] == SEARCH
+        assert page["kind"] == "search"
+        assert page["query"] == "desk lamp"
+        assert page["bytes_by_type"] == {"Document": 50_000, "Image": 30_000}
+        assert page["requests_by_type"] == {"Document": 1, "Image": 2, "Script": 1}
+        assert page["bytes"] == 80_000
+        assert page["failed"] == 1
+        assert page["milestones"] == {
+            "response": 200.0,
+            "domcontentloaded": 500.0,
+            "load": 1000.0,
+            "finished": 900.0,
+        }
+
+        report = tracer.report()
+        assert report.metrics_by_query == {"desk lamp": {"Nodes": 1200}}
+        assert "1 pages" in str(report)
+
+    def test_ignores_events_from_before(self):
+        driver = LoggingDriver()
+        tracer = NetworkTracer()
+        driver.load(page_events("L0", PRODUCT, 50.0, []))
+        with tracer.recording(PerformanceLog(driver), query="desk lamp"):
+            pass
+        assert tracer.report().total.pages == 0
+
+    def test_aggregates(self):
+        driver = LoggingDriver()
+        tracer = NetworkTracer()
+        log = PerformanceLog(driver)
+        with tracer.recording(log, query="desk lamp", proxy="http://a:1"):
+            driver.load(page_events("L1", SEARCH, 100.0, [("Image", 10_000)]))
+            driver.load(page_events("L2", PRODUCT, 102.0, [("Image", 5_000)]), webview="tab-2")
+        with tracer.recording(log, query="office chair"):
+            driver.load(page_events("L3", SEARCH, 200.0, []))
+
+        report = tracer.report()
+        assert report.total.pages == 3
+        assert report.total.bytes == 3 * 50_000 + 15_000
+        assert report.by_kind["search"].pages == 2
+        assert report.by_kind["product"].bytes == 55_000
+        assert report.by_query["desk lamp"].pages == 2
+        assert report.by_query["office chair"].bytes == 50_000
+        assert report.by_proxy["http://a:1"].pages == 2
+        assert report.by_proxy["direct"].pages == 1
+        assert report.by_kind["product"].load_ms == 1000.0
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,62 @@
+"""
+Tests for staged pipelines.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import random
+import time
+
+import pytest
+
+from amzscoutscrape.pipeline import Pipeline, Stage
+
+
+def _jitter(x: int) -> int:
+    time.sleep(random.random() / 500)
+    return x
+
+
+class TestPipeline:
+    def test_ordered_output(self):
+        sink: list[int] = []
+        pipeline = Pipeline(
+            [
+                Stage("double", lambda x: _jitter(x * 2), workers=4),
+                Stage("drop odd thirds", lambda x: None if x % 3 == 0 else x, workers=2),
+                Stage("sink", sink.append),
+            ],
+            queue_size=2,
+        )
+        metrics = pipeline.run(range(50))
+        assert sink == [x * 2 for x in range(50) if (x * 2) % 3 != 0]
+        assert metrics[0].processed == 50
+        assert metrics[1].dropped == 17
+        assert metrics[2].processed == len(sink)
+        assert all(m.max_depth <= 2 for m in metrics)
+
+    def test_errors_propagate(self):
+        def explode(x: int) -> int:
+            if x == 5:
+                raise RuntimeError("boom")
+            return x
+
+        pipeline = Pipeline([Stage("explode", explode, workers=2), Stage("sink", lambda x: x)])
+        with pytest.raises(RuntimeError, match="boom"):
+            pipeline.run(range(100))
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,71 @@
+"""
+Tests for the typed post-processing.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+
+import pytest
+
+from amzscoutscrape import postprocess
+from amzscoutscrape.output import open_output
+
+from . import TestResources
+
+pd = pytest.importorskip("pandas")
+
+ROWS = [
+    ["#", "Thumbnail Image", "Product Name", "Price", "Est. Sales", "Rating", "Rank", "Weight"],
+    ["1", "data:...", "Widget", "$1,234.50", "1.2K", "4.5", "#12,345", "12 oz"],
+    ["2", "data:...", "Gadget", "N/A", "87", "4", "3", "1.5 pounds"],
+    ["3", "data:...", "Doohickey", "call us", "lots", "", "-", "heavy"],
+]
+
+
+class TestPostprocess:
+    def test_kind_of(self):
+        assert postprocess.kind_of("Price") == "currency"
+        assert postprocess.kind_of("Est. Revenue") == "currency"
+        assert postprocess.kind_of("Est. Sales") == "count"
+        assert postprocess.kind_of("Product Name") is None
+        assert postprocess.kind_of("Internet") is None
+
+    def test_postprocess_in_chunks(self):
+        with TestResources.temp_dir() as path:
+            with open_output(path / "in.csv.gz") as fp:
+                csv.writer(fp).writerows(ROWS)
+            report = postprocess.postprocess(path / "in.csv.gz", path / "out.csv", chunksize=2)
+            frame = pd.read_csv(path / "out.csv")
+
+        assert report.rows == 3
+        assert report.unparseable == {
+            "#": 0,
+            "Price": 1,
+            "Est. Sales": 1,
+            "Rating": 0,
+            "Rank": 0,
+            "Weight": 1,
+        }
+        assert "Thumbnail Image" not in frame.columns
+        assert frame["Price"].iloc[0] == 1234.5
+        assert frame["Est. Sales"].tolist()[:2] == [1200, 87]
+        assert frame["Rank"].iloc[0] == 12345
+        assert frame["Weight"].iloc[0] == pytest.approx(0.75)
+        assert frame["Weight"].iloc[1] == pytest.approx(1.5)
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,143 @@
+"""
+Tests for the proxy catalog.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+
+from amzscoutscrape.proxy import GEONODE_PAGE_SIZE, ProxyCatalog, fetch_working_geonode_proxy
+
+TTL = 3600.0
+
+
+def geonode_proxy(number):
+    return {
+        "_id": f"proxy-{number}",
+        "ip": f"10.0.{number // 256}.{number % 256}",
+        "port": "1080",
+        "protocols": ["socks5"],
+    }
+
+
+class FakeGeonode:
+    """
+    Serves a list of proxies a page at a time, like the geonode API.
+    """
+
+    def __init__(self, count):
+        self.proxies = [geonode_proxy(number) for number in range(count)]
+        self.pages = []
+
+    def __call__(self, page, limit):
+        self.pages.append(page)
+        return self.proxies[(page - 1) * limit : page * limit], len(self.proxies)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with ProxyCatalog(tmp_path / "proxies.sqlite3", ttl=TTL) as catalog:
+        yield catalog
+
+
+class TestProxyCatalog:
+    def test_fetches_every_page(self, catalog):
+        geonode = FakeGeonode(GEONODE_PAGE_SIZE * 2 + 10)
+        seen = []
+        assert catalog.needs_refresh(now=1000.0)
+        assert catalog.refresh(fetch_page=geonode, on_page=seen.extend, now=1000.0)
+        assert geonode.pages == [1, 2, 3]
+        assert len(seen) == len(catalog.ranked()) == GEONODE_PAGE_SIZE * 2 + 10
+        assert not catalog.needs_refresh(now=1000.0 + TTL / 2)
+        assert catalog.needs_refresh(now=1000.0 + TTL * 2)
+
+    def test_survives_restarts(self, tmp_path):
+        path = tmp_path / "proxies.sqlite3"
+        with ProxyCatalog(path, ttl=TTL) as catalog:
+            catalog.refresh(fetch_page=FakeGeonode(3), now=1000.0)
+            catalog.record("proxy-2", True, 0.5)
+        with ProxyCatalog(path, ttl=TTL) as catalog:
+            assert not catalog.needs_refresh(now=1001.0)
+            assert catalog.ranked()[0].id == "proxy-2"
+            assert catalog.ranked()[0].urls == ["socks5://10.0.0.2:1080"]
+
+    def test_ranking(self, catalog):
+        catalog.refresh(fetch_page=FakeGeonode(4), now=1000.0)
+        catalog.record("proxy-0", False)
+        catalog.record("proxy-1", True, 2.0)
+        catalog.record("proxy-3", True, 0.5)
+        # what works goes first, fastest first, then what was never checked, then what failed
+        assert [proxy.id for proxy in catalog.ranked()] == [
+            "proxy-3",
+            "proxy-1",
+            "proxy-2",
+            "proxy-0",
+        ]
+
+    def test_resumes_an_interrupted_refresh(self, catalog):
+        geonode = FakeGeonode(GEONODE_PAGE_SIZE * 3)
+        pages = []
+        assert not catalog.refresh(
+            fetch_page=geonode,
+            on_page=pages.append,
+            until=lambda: len(pages) == 2,
+            now=1000.0,
+        )
+        assert catalog.needs_refresh(now=1000.0)
+        assert catalog.refresh(fetch_page=geonode, now=1010.0)
+        assert geonode.pages == [1, 2, 3]
+
+    def test_drops_what_left_the_list(self, catalog):
+        geonode = FakeGeonode(3)
+        catalog.refresh(fetch_page=geonode, now=1000.0)
+        catalog.record("proxy-1", True, 1.0, now=1000.0 + TTL * 1.5)
+        geonode.proxies = [geonode_proxy(5)]
+        catalog.refresh(fetch_page=geonode, now=1000.0 + TTL * 2)
+        # proxy-1 isn't listed anymore, but it worked recently
+        assert sorted(proxy.id for proxy in catalog.ranked()) == ["proxy-1", "proxy-5"]
+
+
+class OfflineCatalog(ProxyCatalog):
+    # a stale list that can't be fetched again
+    def needs_refresh(self, now=None):
+        return True
+
+    def refresh(self, **kwargs):
+        raise ConnectionError("geonode is down")
+
+
+class TestFetchWorkingProxy:
+    def test_survives_a_failed_refresh(self, tmp_path):
+        with OfflineCatalog(tmp_path / "proxies.sqlite3", ttl=TTL) as catalog:
+            # nothing listens on port 1, so both protocols are refused
+            catalog.add(
+                [
+                    {
+                        "_id": "closed-proxy",
+                        "ip": "127.0.0.1",
+                        "port": "1",
+                        "protocols": ["http", "https"],
+                    }
+                ]
+            )
+            with pytest.raises(RuntimeError):
+                fetch_working_geonode_proxy(catalog)
+            # one check of the proxy, not one per protocol
+            (proxy,) = catalog.ranked()
+            assert (proxy.successes, proxy.failures) == (0, 1)
+
+
+if __name__ == "__main__":
+    pytest.main()
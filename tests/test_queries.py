@@ -0,0 +1,54 @@
+"""
+Tests for query sources.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+
+from amzscoutscrape.queries import deduplicate, parse_shard, query_stream, shard_of
+
+from . import TestResources
+
+
+class TestQueries:
+    def test_stream_file(self):
+        with TestResources.temp_dir() as path:
+            source = path / "queries.txt"
+            source.write_text("a\n\nb\na\nc\nd\n", encoding="utf-8")
+            assert list(query_stream(str(source))) == ["a", "b", "c", "d"]
+            assert list(query_stream(str(source), dedupe=False)) == ["a", "b", "a", "c", "d"]
+            assert list(query_stream(str(source), skip=1, limit=2)) == ["b", "c"]
+
+    def test_shards_are_disjoint(self):
+        queries = [f"query {i}" for i in range(200)]
+        shards = [[q for q in queries if shard_of(q, 3) == i] for i in range(3)]
+        assert sorted(sum(shards, [])) == sorted(queries)
+        assert all(shards)
+        assert shard_of("query 7", 3) == shard_of("query 7", 3)
+
+    def test_parse_shard(self):
+        assert parse_shard("1/4") == (1, 4)
+        with pytest.raises(ValueError):
+            parse_shard("4/4")
+        with pytest.raises(ValueError):
+            parse_shard("half")
+
+    def test_deduplicate(self):
+        assert list(deduplicate(["x", "y", "x"])) == ["x", "y"]
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,78 @@
+"""
+Tests for query scheduling.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+from time import time
+
+import pytest
+
+from amzscoutscrape.scheduler import QueryHistory, QueryScheduler, read_priorities
+
+from . import TestResources
+
+
+class TestQueryScheduler:
+    def test_user_priorities_go_first(self):
+        scheduler = QueryScheduler(["a", "b", "c"], priorities={"c": 2, "b": 1})
+        assert [task.query for task in scheduler] == ["c", "b", "a"]
+
+    def test_history_orders_by_expected_yield(self):
+        with TestResources.temp_dir() as path, QueryHistory(path / "history.sqlite3") as history:
+            history.record_success("few", 2)
+            history.record_success("many", 50)
+            history.record_success("fresh", 50)
+            # scraped just now, so there is nothing new to expect from it yet
+            scheduler = QueryScheduler(["few", "fresh", "many"], history=history)
+            stale = time() + 30 * 24 * 60 * 60
+            assert scheduler.score("many", stale) < scheduler.score("few", stale)
+            assert scheduler.score("many", stale) < scheduler.score("fresh")
+            assert [task.query for task in scheduler][0] == "many"
+
+    def test_failures_are_retried_elsewhere_then_given_up(self):
+        scheduler = QueryScheduler(["a", "b"], max_attempts=2, retry_backoff=10)
+        first = scheduler.take("w1", now=0)
+        assert first.query == "a"
+        assert scheduler.failed(first, "boom", "w1", now=0)
+        # not ready until the backoff is over
+        assert scheduler.take("w1", now=5).query == "b"
+        assert scheduler.take("w1", now=5) is None
+        assert scheduler.wait(now=5) == 5
+        retry = scheduler.take("w1", now=10)
+        assert retry.query == "a" and retry.attempt == 2 and retry.avoid == "w1"
+        assert not scheduler.failed(retry, "boom", "w2", now=10)
+        assert scheduler.given_up == ["a"]
+        assert scheduler.take("w1", now=100) is None
+        assert scheduler.wait() is None
+
+    def test_prefers_work_that_did_not_fail_on_this_worker(self):
+        scheduler = QueryScheduler(["a", "b"], retry_backoff=0, priorities={"a": 1})
+        first = scheduler.take("w1", now=0)
+        scheduler.failed(first, "boom", "w1", now=0)
+        assert scheduler.take("w1", now=1).query == "b"
+        assert scheduler.take("w1", now=1).query == "a"
+
+    def test_read_priorities(self):
+        with TestResources.temp_dir() as path:
+            (path / "priorities.tsv").write_text("desk lamp\t5\n\nmouse pad\t-1\n")
+            assert read_priorities(path / "priorities.tsv") == {"desk lamp": 5, "mouse pad": -1}
+            (path / "bad.tsv").write_text("desk lamp\n")
+            with pytest.raises(ValueError):
+                read_priorities(path / "bad.tsv")
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,113 @@
+"""
+Tests for waiting on the pages the scrape loads.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+from selenium.common import NoSuchElementException
+from selenium.webdriver.support.wait import WebDriverWait
+
+from amzscoutscrape.scrape import _navigate, _wait_for_product_page, _wait_for_search_page
+
+
+class Element:
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+
+class Document:
+    def __init__(self, url, *, complete, os_circle):
+        self.url = url
+        self.complete = complete
+        self.os_circle = os_circle
+        self.window = {}
+
+
+class NoneStrategyDriver:
+    """
+    Navigates like the "none" page load strategy: ``get`` returns at once, and the old document stays around for a few
+    polls before the new one replaces it.
+    """
+
+    def __init__(self, document, *, commit_after=3):
+        self.document = document
+        self.commit_after = commit_after
+        self.pending = None
+        self.polls = 0
+
+    def get(self, url):
+        # the new page starts out parsing, without the AMZScout button
+        self.pending = Document(url, complete=False, os_circle=False)
+        self.polls = 0
+
+    def _poll(self):
+        self.polls += 1
+        if self.polls > self.commit_after:
+            if self.pending is not None:
+                self.document, self.pending = self.pending, None
+                self.polls = 0
+            else:
+                # and then it finishes parsing, and the extension injects its button
+                self.document.complete = self.document.os_circle = True
+
+    def execute_script(self, script, *args):
+        self._poll()
+        if script.startswith("window."):
+            name = script.removeprefix("window.").split(" = ")[0]
+            self.document.window[name] = True
+            return None
+        if script.startswith("return window."):
+            name = script.removeprefix("return window.").split(" === ")[0]
+            return self.document.window.get(name) is True
+        # the product page's sections check
+        return self.document.complete
+
+    def find_element(self, by, value):
+        self._poll()
+        if value == "os-circle" and self.document.os_circle:
+            return Element()
+        raise NoSuchElementException(value)
+
+
+def wait_for(driver):
+    return WebDriverWait(driver, 5, poll_frequency=0.001)
+
+
+class TestNavigation:
+    def test_search_page_waits_for_the_new_document(self):
+        # the previous search is still showing its AMZScout button
+        driver = NoneStrategyDriver(
+            Document("https://www.amazon.com/s?k=lamp", complete=True, os_circle=True)
+        )
+        _navigate(driver, "https://www.amazon.com/s?k=lamp")
+        _wait_for_search_page(driver, wait_for(driver))
+        assert driver.pending is None
+        assert driver.document.os_circle
+
+    def test_product_page_waits_for_the_new_document(self):
+        # a fresh tab's about:blank is fully loaded and has a body
+        driver = NoneStrategyDriver(Document("about:blank", complete=True, os_circle=False))
+        _navigate(driver, "https://www.amazon.com/dp/B000000001")
+        _wait_for_product_page(driver, wait_for(driver))
+        assert driver.document.url == "https://www.amazon.com/dp/B000000001"
+        assert driver.document.complete
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for the scrape server.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import json
+from contextlib import contextmanager
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from amzscoutscrape.server import DriverPool, ScrapeServer
+
+
+class FakeDriver:
+    def __init__(self):
+        self.closed = False
+
+    def quit(self):
+        self.closed = True
+
+
+def _scrape(driver, writer, query):
+    if query == "broken":
+        raise RuntimeError("no panel")
+    writer.writerow(["#", "Product Name"])
+    for i in range(2):
+        writer.writerow([str(i + 1), f"{query} {i + 1}"])
+
+
+@contextmanager
+def _serving(pool):
+    pool.start()
+    server = ScrapeServer(pool, port=0)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        pool.close()
+
+
+def _post(server, body):
+    request = Request(f"{server.url}/queries", data=json.dumps(body).encode(), method="POST")
+    with urlopen(request, timeout=10) as response:
+        assert response.headers["Content-Type"] == "application/x-ndjson"
+        return [json.loads(line) for line in response]
+
+
+class TestScrapeServer:
+    def test_streams_rows_and_status(self):
+        drivers = []
+
+        def new_driver():
+            drivers.append(FakeDriver())
+            return drivers[-1]
+
+        pool = DriverPool(
+            2, new_driver=new_driver, scrape=_scrape, retire=lambda driver, uses: uses >= 2
+        )
+        with _serving(pool) as server:
+            events = _post(server, {"queries": ["lamp", "broken", "desk"]})
+            assert [event["query"] for event in events] == ["lamp"] * 3 + ["broken"] + ["desk"] * 3
+            assert events[0]["row"] == {"#": "1", "Product Name": "lamp 1"}
+            assert events[2]["status"] == "done" and events[2]["rows"] == 2
+            assert events[3]["status"] == "failed" and "no panel" in events[3]["error"]
+
+            with urlopen(f"{server.url}/status", timeout=10) as response:
+                status = json.load(response)
+            assert status["completed"] == 2
+            assert status["failed"] == 1
+            assert status["rows"] == 4
+            assert status["queue_depth"] == 0
+            assert len(status["drivers"]) == 2
+            assert sum(driver["uses"] for driver in status["drivers"]) <= 3
+        assert all(driver.closed for driver in drivers)
+        # a driver that ran two queries was replaced by a warm one
+        assert len(drivers) >= 3
+
+    def test_rejects_bad_requests(self):
+        pool = DriverPool(1, new_driver=FakeDriver, scrape=_scrape)
+        with _serving(pool) as server:
+            with pytest.raises(HTTPError) as info:
+                _post(server, {"queries": [""]})
+            assert info.value.code == 400
+
+
+if __name__ == "__main__":
+    pytest.main()
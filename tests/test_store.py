@@ -0,0 +1,77 @@
+"""
+Tests for the product store.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import csv
+
+import pytest
+
+from amzscoutscrape.output import open_input
+from amzscoutscrape.scrape import ProductRow
+from amzscoutscrape.store import ProductStore, StoreWriter
+
+from . import TestResources
+
+HEADER = [
+    "#",
+    "Thumbnail Image",
+    "Product Name",
+    "URL",
+    "Description",
+    "About",
+    "Manufacturer",
+    "Price",
+]
+URL = "https://www.amazon.com/Widget/dp/B000000001/ref=sr_1_1"
+
+
+def widget_row(price: str, description: str) -> list[str]:
+    return ["1", "", "Widget", URL, description, "", "", price]
+
+
+class TestProductStore:
+    def test_refresh_reuses_fresh_deep_scrape(self):
+        with TestResources.temp_dir() as path, ProductStore(path / "products.sqlite3") as store:
+            writer = StoreWriter(store, "widgets", expect_header=True)
+            writer.writerow(HEADER)
+            assert writer.cached_sections(ProductRow("1", "Widget", URL, None, [])) is None
+            writer.writerow(widget_row("$10", "A widget"))
+
+            writer = StoreWriter(store, "widgets")
+            assert writer.cached_sections(ProductRow("1", "Widget", URL, None, [])) == (
+                "A widget",
+                "",
+                "",
+            )
+            writer.writerow(widget_row("$12", "A widget"))
+            assert writer.reused == 1
+
+            # the same product is upserted, never appended
+            assert store.count() == 1
+            assert store.export(path / "out.csv.gz") == 1
+            with open_input(path / "out.csv.gz") as fp:
+                assert list(csv.reader(fp)) == [HEADER, widget_row("$12", "A widget")]
+
+    def test_stale_deep_scrape_is_redone(self):
+        with TestResources.temp_dir() as path, ProductStore(path / "products.sqlite3") as store:
+            StoreWriter(store, "widgets").writerow(widget_row("$10", "A widget"))
+            writer = StoreWriter(store, "widgets", ttl=-1)
+            assert writer.cached_sections(ProductRow("1", "Widget", URL, None, [])) is None
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,139 @@
+"""
+Tests for supervised driver sessions and process tree inspection.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from amzscoutscrape import processes
+from amzscoutscrape.processes import (
+    SESSION_ENV,
+    descendants,
+    list_processes,
+    memory_of,
+    orphaned_browsers,
+)
+from amzscoutscrape.supervisor import Supervisor
+
+can_list = processes.psutil is not None or Path("/proc").is_dir()
+
+
+def _uppercase(items, reporter):
+    for item in items:
+        reporter.started(item)
+        reporter.done(item, item.upper())
+
+
+def _hang_or_crash(items, reporter):
+    for item in items:
+        reporter.started(item)
+        if item == "stuck":
+            time.sleep(60)
+        if item == "boom":
+            os._exit(3)
+        reporter.done(item, item.upper())
+
+
+@pytest.mark.skipif(not can_list, reason="needs psutil or /proc")
+class TestProcesses:
+    def test_descendants(self):
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        try:
+            assert child.pid in {info.pid for info in descendants(os.getpid())}
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_memory_of_a_tree(self):
+        alone = memory_of([os.getpid()])
+        assert alone.processes >= 1
+        assert alone.rss > 0
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        try:
+            time.sleep(0.2)
+            with_child = memory_of([os.getpid()])
+            assert with_child.processes == alone.processes + 1
+            assert with_child.rss > alone.rss
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_orphaned_browsers(self, tmp_path):
+        sleep = shutil.which("sleep")
+        if sleep is None:
+            pytest.skip("needs sleep")
+        browser = tmp_path / "chrome"
+        shutil.copy(sleep, browser)
+
+        gone = subprocess.Popen([sys.executable, "-c", "pass"])
+        gone.wait()
+        orphan = subprocess.Popen([browser, "30"], env={**os.environ, SESSION_ENV: str(gone.pid)})
+        owned = subprocess.Popen([browser, "30"], env={**os.environ, SESSION_ENV: str(os.getpid())})
+        try:
+            time.sleep(0.2)
+            found = {info.pid for info in orphaned_browsers(list_processes())}
+            assert orphan.pid in found
+            assert owned.pid not in found
+        finally:
+            for process in (orphan, owned):
+                process.kill()
+                process.wait()
+
+
+class TestSupervisor:
+    def test_runs_everything(self):
+        supervisor = Supervisor(_uppercase, poll_interval=0.05, reap_orphans=False)
+        results = list(supervisor.run(["a", "b", "c"], session_size=2))
+        assert [(result.item, result.result) for result in results] == [
+            ("a", "A"),
+            ("b", "B"),
+            ("c", "C"),
+        ]
+        assert supervisor.interventions == []
+
+    def test_replaces_hung_and_crashed_sessions(self):
+        supervisor = Supervisor(
+            _hang_or_crash,
+            heartbeat_timeout=1.0,
+            max_attempts=2,
+            poll_interval=0.05,
+            reap_orphans=False,
+        )
+        results = {
+            result.item: result for result in supervisor.run(["a", "stuck", "b", "boom", "c"], 5)
+        }
+        assert {item for item, result in results.items() if result.error is None} == {"a", "b", "c"}
+        assert results["stuck"].error is not None
+        assert results["boom"].error is not None
+        kinds = [intervention.kind for intervention in supervisor.interventions]
+        assert kinds.count("hung") == 2
+        assert kinds.count("crashed") == 2
+
+    def test_is_stale(self):
+        supervisor = Supervisor(_uppercase, heartbeat_timeout=10)
+        assert not supervisor.is_stale(100.0, now=105.0)
+        assert supervisor.is_stale(100.0, now=111.0)
+
+
+if __name__ == "__main__":
+    pytest.main()
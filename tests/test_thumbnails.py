@@ -0,0 +1,44 @@
+"""
+Tests for thumbnail transcoding.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+from io import BytesIO
+
+import pytest
+
+from amzscoutscrape.thumbnails import ThumbnailTranscoder, transcode
+
+
+class TestThumbnails:
+    def test_passthrough(self):
+        with ThumbnailTranscoder("passthrough") as transcoder:
+            uri = transcoder.submit(b"\xff\xd8", "image/jpeg").result()
+        assert uri == "data:image/jpeg;base64,/9g="
+
+    def test_downscale(self):
+        image_module = pytest.importorskip("PIL.Image")
+        buffer = BytesIO()
+        image_module.effect_noise((600, 400), 64).convert("RGB").save(buffer, format="JPEG")
+        data, content_type = transcode(buffer.getvalue(), "image/jpeg", "webp", 150, 50)
+        assert content_type == "image/webp"
+        assert len(data) < buffer.tell()
+        with image_module.open(BytesIO(data)) as image:
+            assert max(image.size) == 150
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,64 @@
+"""
+Tests for WebDriver command tracing.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+
+from amzscoutscrape.tracing import CommandTracer, phase
+
+
+class Executor:
+    def execute(self, command, params):
+        return {"value": command}
+
+
+class Driver:
+    def __init__(self):
+        self.command_executor = Executor()
+
+
+class TestCommandTracer:
+    def test_records_phases_and_rows(self):
+        driver = Driver()
+        tracer = CommandTracer()
+        tracer.attach(driver)
+
+        with phase("listing"):
+            for _ in range(3):
+                assert driver.command_executor.execute("getElementText", {}) == {
+                    "value": "getElementText"
+                }
+        driver.command_executor.execute("getTitle", {})
+        tracer.count_rows(3)
+
+        report = tracer.report()
+        assert report.commands == 4
+        assert report.by_phase["listing"].count == 3
+        assert report.by_phase["other"].count == 1
+        assert report.by_command["getElementText"].count == 3
+        assert report.commands_per_row == pytest.approx(4 / 3)
+        # these commands came from outside the package
+        assert [site for site, _ in report.slowest_call_sites()] == ["<outside amzscoutscrape>"]
+        assert "4 WebDriver commands" in str(report)
+
+        tracer.detach(driver)
+        driver.command_executor.execute("getTitle", {})
+        assert tracer.report().commands == 4
+
+
+if __name__ == "__main__":
+    pytest.main()
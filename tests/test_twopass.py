@@ -0,0 +1,150 @@
+"""
+Tests for two-pass scraping.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+
+from amzscoutscrape.twopass import HarvestStore, HarvestWriter, deep_scrape_pass
+
+from . import TestResources
+
+HEADER = ["#", "Thumbnail", "Product Name", "URL", "Description", "About", "Manufacturer", "Price"]
+
+
+def _row(number, asin, price):
+    return [number, "", f"Product {asin}", f"https://www.amazon.com/dp/{asin}", "", "", "", price]
+
+
+class FakeDriver:
+    def quit(self):
+        pass
+
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(list(row))
+
+    def writerows(self, rows):
+        self.rows.extend(list(row) for row in rows)
+
+
+class TestTwoPass:
+    def test_each_product_is_scraped_once_and_joined_back(self):
+        scraped = []
+
+        def scrape_page(driver, url):
+            scraped.append(url)
+            if url.endswith("B000000003"):
+                raise RuntimeError("blocked")
+            return f"about {url[-10:]}", "bullets", "maker"
+
+        with HarvestStore() as store:
+            listings = ListWriter()
+            first = HarvestWriter(store, "lamp", expect_header=True, listings=listings)
+            first.writerow(HEADER)
+            first.writerow(_row("1", "B000000001", "$10"))
+            first.writerow(_row("2", "B000000002", "$20"))
+            assert first.commit() == 2
+            second = HarvestWriter(store, "desk lamp", listings=listings)
+            second.writerow(_row("1", "B000000002", "$20"))
+            second.writerow(_row("2", "B000000003", "$30"))
+            second.commit()
+            # a query that failed never commits, so none of its rows show up
+            HarvestWriter(store, "broken").writerow(_row("1", "B000000004", "$40"))
+
+            assert listings.rows[0] == HEADER and len(listings.rows) == 5
+            assert store.counts() == (4, 3)
+
+            result = deep_scrape_pass(store, new_driver=FakeDriver, scrape_page=scrape_page)
+            assert (result.scraped, result.failed) == (2, 1)
+            assert sorted(scraped) == [f"https://www.amazon.com/dp/B00000000{i}" for i in (1, 2, 3)]
+
+            joined = ListWriter()
+            assert store.write_joined(joined) == 4
+            assert joined.rows[0] == HEADER
+            assert joined.rows[1][4:8] == ["about B000000001", "bullets", "maker", "$10"]
+            assert joined.rows[3][4:8] == ["about B000000002", "bullets", "maker", "$20"]
+            assert joined.rows[4][4:7] == ["", "", ""]
+
+    def test_drivers_that_fail_to_start_are_retried(self):
+        attempts = []
+
+        def new_driver():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise RuntimeError("chrome crashed")
+            return FakeDriver()
+
+        with HarvestStore() as store:
+            writer = HarvestWriter(store, "lamp", expect_header=True)
+            writer.writerow(HEADER)
+            writer.writerow(_row("1", "B000000001", "$10"))
+            writer.commit()
+            result = deep_scrape_pass(
+                store,
+                new_driver=new_driver,
+                scrape_page=lambda driver, url: ("a", "b", "c"),
+                workers=1,
+                retry_backoff=0,
+            )
+            assert (result.scraped, result.driver_failures) == (1, 2)
+            assert store.unscraped() == []
+
+    def test_fails_loudly_without_drivers(self):
+        def new_driver():
+            raise RuntimeError("chrome crashed")
+
+        with HarvestStore() as store:
+            writer = HarvestWriter(store, "lamp", expect_header=True)
+            writer.writerow(HEADER)
+            writer.writerow(_row("1", "B000000001", "$10"))
+            writer.writerow(_row("2", "B000000002", "$20"))
+            writer.commit()
+            with pytest.raises(RuntimeError, match="2 products left"):
+                deep_scrape_pass(store, new_driver=new_driver, workers=2, retry_backoff=0)
+
+    def test_a_persistent_store_only_writes_new_rows(self):
+        with TestResources.temp_dir() as path:
+            database = path / "harvest.sqlite3"
+            with HarvestStore(database) as store:
+                writer = HarvestWriter(store, "lamp", expect_header=True)
+                writer.writerow(HEADER)
+                writer.writerow(_row("1", "B000000001", "$10"))
+                writer.commit()
+                assert store.write_joined(ListWriter()) == 1
+
+            with HarvestStore(database) as store:
+                assert store.harvested("lamp") and not store.harvested("desk lamp")
+                # harvesting a query again replaces its rows
+                writer = HarvestWriter(store, "lamp")
+                writer.writerow(_row("1", "B000000001", "$12"))
+                writer.commit()
+                writer = HarvestWriter(store, "desk lamp")
+                writer.writerow(_row("1", "B000000002", "$20"))
+                writer.commit()
+                assert store.counts() == (2, 2)
+                joined = ListWriter()
+                assert store.write_joined(joined, write_header=False) == 2
+                assert [row[7] for row in joined.rows] == ["$12", "$20"]
+                assert store.write_joined(ListWriter(), write_header=False) == 0
+
+
+if __name__ == "__main__":
+    pytest.main()
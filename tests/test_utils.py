@@ -0,0 +1,106 @@
+"""
+Tests for utility code.
+
+Copyright 2023 Parker Wahle <regulad@regulad.xyz>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License.
+
+"""
+import pytest
+from selenium.common import TimeoutException
+from selenium.webdriver.common.timeouts import Timeouts
+
+from amzscoutscrape.utils import Deadline, DeadlineExceeded, current_deadline, deadline, retry
+
+
+class Driver:
+    def __init__(self):
+        self.timeouts = Timeouts(implicit_wait=60, page_load=60, script=60)
+        self.sets = 0
+
+    def __setattr__(self, name, value):
+        if name == "timeouts" and "timeouts" in self.__dict__:
+            self.__dict__["sets"] += 1
+        super().__setattr__(name, value)
+
+
+class TestDeadline:
+    def test_unbounded(self):
+        budget = Deadline()
+        assert budget.remaining is None
+        assert budget.timeout(5) == 5
+        assert not budget.expired
+
+    def test_timeout_takes_what_is_left(self):
+        budget = Deadline(10)
+        assert 9 < budget.timeout() <= 10
+        assert budget.timeout(2) == 2
+
+    def test_expired(self):
+        budget = Deadline(0)
+        assert budget.expired
+        with pytest.raises(DeadlineExceeded):
+            budget.timeout(5)
+        with pytest.raises(DeadlineExceeded):
+            budget.check()
+
+    def test_sleep_gives_up_right_away(self):
+        with pytest.raises(DeadlineExceeded):
+            Deadline(1).sleep(30)
+
+    def test_nested_deadlines_never_outlast_outer_ones(self):
+        assert current_deadline().remaining is None
+        with deadline(5) as outer:
+            with deadline(100) as inner:
+                assert inner is outer
+            with deadline(1) as inner:
+                assert inner.remaining <= 1
+            assert current_deadline() is outer
+        assert current_deadline().remaining is None
+
+    def test_apply_to_only_when_closer_than_the_driver(self):
+        driver = Driver()
+        limits = driver.timeouts
+        Deadline(100).apply_to(driver, limits)
+        assert driver.sets == 0
+        Deadline(5).apply_to(driver, limits)
+        assert driver.sets == 1
+        assert driver.timeouts.page_load <= 5
+
+    def test_limiting_restores_and_converts(self):
+        driver = Driver()
+        budget = Deadline(0)
+        with pytest.raises(DeadlineExceeded):
+            with budget.limiting(driver):
+                driver.timeouts = Timeouts(implicit_wait=1, page_load=1, script=1)
+                raise TimeoutException("waited too long")
+        assert driver.timeouts.page_load == 60
+
+
+class TestRetry:
+    def test_retry_stops_at_the_deadline(self):
+        calls = []
+
+        @retry(tries=5, backoff_seconds=10)
+        def flaky():
+            calls.append(1)
+            raise ValueError("nope")
+
+        with deadline(1):
+            with pytest.raises(DeadlineExceeded):
+                flaky()
+        assert len(calls) == 1
+
+
+if __name__ == "__main__":
+    pytest.main()